@@ -0,0 +1,9 @@
+"""让性能测试脚本可以在 Saya 之外导入 WapQQ 插件的子模块"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+from manage import import_plugin_package  # noqa: E402
+
+import_plugin_package()
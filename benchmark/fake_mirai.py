@@ -0,0 +1,291 @@
+"""本地的 mirai-api-http 替身：提供 HTTP 与 Websocket 接口，按固定速率推送合成的消息事件，并提供测试用的图片
+
+由 load_test.py 启动；也可单独运行，并将 config.yaml 中的 http_host / ws_host 指向它，用 main.py 启动 bot 手动查看
+用法：python benchmark/fake_mirai.py [--mirai-port 18080] [--rate 50] [--groups 20] [--friends 20]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Any, List, Optional
+
+from aiohttp import web, WSMsgType
+from PIL import Image, ImageDraw
+
+VERIFY_KEY = "ServiceVerifyKey"
+WORDS = ["今天", "晚上", "一起", "吃饭", "吗", "哈哈哈", "好的", "收到", "这个", "怎么", "办", "明天", "开会",
+         "ok", "图片", "看看", "不错", "？", "！", "在吗", "discord", "github", "链接", "已经", "发了"]
+
+
+@dataclass
+class Population:
+    """合成的群、好友与群成员，load_test.py 用相同的参数推算出要访问的页面"""
+    account: int = 1145141919
+    groups: int = 20
+    friends: int = 20
+    members: int = 50  # 每个群的成员数
+    images: int = 50  # 图片服务器上不同图片的数量
+
+    def group_ids(self) -> List[int]:
+        return [100000 + i for i in range(self.groups)]
+
+    def friend_ids(self) -> List[int]:
+        return [200000 + i for i in range(self.friends)]
+
+    def member_ids(self, group_id: int) -> List[int]:
+        return [300000 + (group_id % 1000) * 1000 + i for i in range(self.members)]
+
+    @staticmethod
+    def group(group_id: int) -> dict:
+        return {"id": group_id, "name": f"测试群{group_id}", "permission": "MEMBER"}
+
+    def member(self, member_id: int, group_id: int) -> dict:
+        return {"id": member_id, "memberName": f"成员{member_id}", "specialTitle": "", "permission": "MEMBER",
+                "joinTimestamp": 0, "lastSpeakTimestamp": 0, "muteTimeRemaining": 0, "group": self.group(group_id)}
+
+    @staticmethod
+    def friend(friend_id: int) -> dict:
+        return {"id": friend_id, "nickname": f"好友{friend_id}", "remark": ""}
+
+    @staticmethod
+    def profile(account_id: int) -> dict:
+        return {"nickname": f"用户{account_id}", "email": "", "age": 0, "level": 1, "sign": "", "sex": "UNKNOWN"}
+
+
+def image_url(base_url: str, index: int) -> str:
+    return f"{base_url}/images/{index}"
+
+
+class EventFactory:
+    """按群聊中常见的比例生成事件：多数为群消息，部分为好友消息与 bot 在其他客户端发出的同步消息"""
+
+    def __init__(self, population: Population, base_url: str, friend_ratio: float, sync_ratio: float,
+                 image_ratio: float, seed: int = 0):
+        self.population = population
+        self.base_url = base_url
+        self.friend_ratio = friend_ratio
+        self.sync_ratio = sync_ratio
+        self.image_ratio = image_ratio
+        self.rng = random.Random(seed)
+        self.message_id = 0
+
+    def message_chain(self) -> List[dict]:
+        self.message_id += 1
+        rng = self.rng
+        chain = [{"type": "Source", "id": self.message_id, "time": int(time.time())},
+                 {"type": "Plain", "text": "".join(rng.choice(WORDS) for _ in range(rng.randrange(1, 12)))}]
+        if rng.random() < 0.2:
+            chain.append({"type": "Face", "faceId": rng.randrange(0, 200), "name": "表情"})
+        if rng.random() < self.image_ratio:
+            index = rng.randrange(self.population.images)
+            chain.append({"type": "Image", "imageId": "{%08X-0000-0000-0000-000000000000}.jpg" % index,
+                          "url": image_url(self.base_url, index)})
+        return chain
+
+    def next_event(self) -> dict:
+        rng = self.rng
+        sync = rng.random() < self.sync_ratio
+        if rng.random() < self.friend_ratio:
+            friend = self.population.friend(rng.choice(self.population.friend_ids()))
+            if sync:
+                return {"type": "FriendSyncMessage", "subject": friend, "messageChain": self.message_chain()}
+            return {"type": "FriendMessage", "sender": friend, "messageChain": self.message_chain()}
+        group_id = rng.choice(self.population.group_ids())
+        if sync:
+            return {"type": "GroupSyncMessage", "subject": self.population.group(group_id),
+                    "messageChain": self.message_chain()}
+        member = self.population.member(rng.choice(self.population.member_ids(group_id)), group_id)
+        return {"type": "GroupMessage", "sender": member, "messageChain": self.message_chain()}
+
+
+def make_images(count: int, seed: int = 0) -> List[bytes]:
+    """生成不同尺寸的 JPEG / PNG / GIF ，大致覆盖聊天中的截图、照片与动图"""
+    rng = random.Random(seed)
+    images = []
+    for index in range(count):
+        width, height = rng.randrange(200, 1600), rng.randrange(200, 1600)
+        image = Image.new("RGB", (width, height), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(20):
+            box = sorted(rng.randrange(width) for _ in range(2)), sorted(rng.randrange(height) for _ in range(2))
+            draw.rectangle((box[0][0], box[1][0], box[0][1], box[1][1]),
+                           fill=tuple(rng.randrange(256) for _ in range(3)))
+        buffer = BytesIO()
+        if index % 10 == 9:
+            frames = [image.resize((width // 4, height // 4)).rotate(angle) for angle in range(0, 360, 45)]
+            frames[0].save(buffer, format="GIF", append_images=frames[1:], save_all=True, duration=100, loop=0)
+        elif index % 5 == 4:
+            image.save(buffer, format="PNG")
+        else:
+            image.save(buffer, format="JPEG", quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+class FakeMirai:
+    """保存会话与推送计数，响应 Ariadne 的调用；mirai-api-http 的返回值只模拟 WapQQ 用到的字段"""
+
+    def __init__(self, population: Population, factory: EventFactory, rate: float, images: List[bytes],
+                 autostart: bool):
+        self.population = population
+        self.factory = factory
+        self.rate = rate
+        self.images = images
+        self.sent = 0
+        self.connections = 0
+        self.paused = False
+        self.started: Optional[asyncio.Event] = None
+        self.autostart = autostart  # 为 False 时等待 POST /start 再推送，load_test.py 在 bot 启动完成后调用
+        self.replay_started: Optional[float] = None
+
+    def call(self, command: str, content: dict) -> Any:
+        population = self.population
+        command = command.replace("/", "_")
+        if command == "about":
+            return {"code": 0, "msg": "", "data": {"version": "2.6.2"}}
+        if command in ("botProfile", "memberProfile", "friendProfile", "userProfile"):
+            return population.profile(content.get("memberId") or content.get("target") or population.account)
+        if command == "groupList":
+            return {"code": 0, "msg": "", "data": [population.group(i) for i in population.group_ids()]}
+        if command == "friendList":
+            return {"code": 0, "msg": "", "data": [population.friend(i) for i in population.friend_ids()]}
+        if command == "memberList":
+            group_id = content["target"]
+            return {"code": 0, "msg": "",
+                    "data": [population.member(i, group_id) for i in population.member_ids(group_id)]}
+        if command in ("sendGroupMessage", "sendFriendMessage"):
+            self.factory.message_id += 1
+            return {"code": 0, "msg": "success", "messageId": self.factory.message_id}
+        return {"code": 0, "msg": "success"}
+
+    async def replay(self, send):
+        """按 rate 推送事件；每 10ms 补发到期的事件，速率较高时也不会因逐条 sleep 而偏慢"""
+        await self.started.wait()
+        if self.replay_started is None:
+            self.replay_started = time.monotonic()
+        while not self.paused:
+            due = int((time.monotonic() - self.replay_started) * self.rate) - self.sent
+            for _ in range(due):
+                await send(json.dumps({"syncId": "-1", "data": self.factory.next_event()}, ensure_ascii=False))
+                self.sent += 1
+            await asyncio.sleep(0.01)
+
+    def create_app(self) -> web.Application:
+        routes = web.RouteTableDef()
+
+        @routes.get("/all")
+        async def events(request: web.Request):
+            if request.query.get("verifyKey") != VERIFY_KEY:
+                return web.json_response({"code": 1, "msg": "wrong verify key"})
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            await ws.send_json({"syncId": "", "data": {"code": 0, "session": secrets.token_hex(8)}})
+            self.connections += 1
+            replay = asyncio.create_task(self.replay(ws.send_str)) if self.rate > 0 else None
+            try:
+                async for message in ws:
+                    if message.type != WSMsgType.TEXT:
+                        continue
+                    data = json.loads(message.data)
+                    result = self.call(data["command"], data.get("content") or {})
+                    await ws.send_str(json.dumps({"syncId": data["syncId"], "data": result}, ensure_ascii=False))
+            finally:
+                self.connections -= 1
+                if replay is not None:
+                    replay.cancel()
+            return ws
+
+        @routes.post("/verify")
+        async def verify(request: web.Request):
+            data = await request.json()
+            if data.get("verifyKey") != VERIFY_KEY:
+                return web.json_response({"code": 1, "msg": "wrong verify key"})
+            return web.json_response({"code": 0, "session": secrets.token_hex(8)})
+
+        @routes.post("/bind")
+        async def bind(_: web.Request):
+            return web.json_response({"code": 0, "msg": "success"})
+
+        @routes.get(r"/images/{index:\d+}")
+        async def image(request: web.Request):
+            data = self.images[int(request.match_info["index"]) % len(self.images)]
+            content_type = {b"\xff\xd8": "image/jpeg", b"\x89P": "image/png"}.get(data[:2], "image/gif")
+            return web.Response(body=data, content_type=content_type)
+
+        @routes.get("/stats")
+        async def stats(_: web.Request):
+            """非 mirai-api-http 接口，供 load_test.py 读取已推送的事件数"""
+            return web.json_response({"sent": self.sent, "connections": self.connections, "pid": os.getpid()})
+
+        @routes.post("/start")
+        async def start(_: web.Request):
+            """非 mirai-api-http 接口，开始推送"""
+            self.started.set()
+            return web.json_response({"sent": self.sent})
+
+        @routes.post("/pause")
+        async def pause(_: web.Request):
+            """非 mirai-api-http 接口，停止推送，load_test.py 在结束前调用，以便 bot 写完已收到的消息"""
+            self.paused = True
+            return web.json_response({"sent": self.sent})
+
+        @routes.route("*", "/{command:.+}")
+        async def call(request: web.Request):
+            content = dict(request.query) if request.method == "GET" else await request.json()
+            return web.json_response(self.call(request.match_info["command"], content))
+
+        async def on_startup(_: web.Application):
+            self.started = asyncio.Event()
+            if self.autostart:
+                self.started.set()
+
+        app = web.Application()
+        app.add_routes(routes)
+        app.on_startup.append(on_startup)
+        return app
+
+
+def serve(port: int, rate: float, population: Population, friend_ratio: float, sync_ratio: float,
+          image_ratio: float, autostart: bool = True):
+    """阻塞运行，load_test.py 在子进程中调用"""
+    base_url = f"http://127.0.0.1:{port}"
+    factory = EventFactory(population, base_url, friend_ratio, sync_ratio, image_ratio)
+    fake = FakeMirai(population, factory, rate, make_images(population.images), autostart)
+    web.run_app(fake.create_app(), host="127.0.0.1", port=port, print=None, access_log=None, shutdown_timeout=1)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--mirai-port", type=int, default=18080)
+    parser.add_argument("--rate", type=float, default=50, help="每秒推送的事件数")
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--friends", type=int, default=20)
+    parser.add_argument("--members", type=int, default=50, help="每个群的成员数")
+    parser.add_argument("--images", type=int, default=50, help="图片服务器上不同图片的数量")
+    parser.add_argument("--friend-ratio", type=float, default=0.2)
+    parser.add_argument("--sync-ratio", type=float, default=0.05, help="bot 在其他客户端发出的消息的比例")
+    parser.add_argument("--image-ratio", type=float, default=0.15)
+
+
+def population_of(args: argparse.Namespace, account: int = Population.account) -> Population:
+    return Population(account=account, groups=args.groups, friends=args.friends, members=args.members,
+                      images=args.images)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument("--account", type=int, default=Population.account)
+    args = parser.parse_args()
+    print(f"mirai-api-http 替身已启动：http://127.0.0.1:{args.mirai_port} ，verifyKey 为 {VERIFY_KEY} ，"
+          f"账号为 {args.account}")
+    serve(args.mirai_port, args.rate, population_of(args, args.account), args.friend_ratio, args.sync_ratio,
+          args.image_ratio)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""以本地的 mirai-api-http 替身驱动完整的 bot ，测量消息写入吞吐、网页延迟与数据库大小的变化
+
+bot 与 main.py 一样在本进程中运行；mirai-api-http 替身（兼作图片服务器）与网页压测客户端各在一个子进程中运行，
+避免与 bot 争抢事件循环。数据库与图片缓存放在临时目录中，不会影响 saya/WapQQ 下已有的数据。
+用法：python benchmark/load_test.py [--duration 60] [--rate 50] [--clients 8] [--report-interval 5]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from loguru import logger
+
+root = Path(__file__).parents[1]
+sys.path.insert(0, str(Path(__file__).parent))  # 从其他目录运行时也能导入同目录的 fake_mirai ，spawn 的子进程同样需要
+
+import fake_mirai  # noqa: E402
+from fake_mirai import Population, VERIFY_KEY  # noqa: E402
+# 网页压测客户端请求各页面的比例
+ROUTE_WEIGHTS = {"/": 10, "/group/<id>": 45, "/friend/<id>": 20, "/image_proxy": 25}
+
+
+def percentile(values: List[float], q: float) -> float:
+    return values[max(0, int(len(values) * q) - 1)]
+
+
+def pick_request(rng: random.Random, population: Population, mirai_url: str) -> Tuple[str, str]:
+    """返回 (统计用的路由名, 请求地址)，多数请求第一页，少数向前翻页"""
+    route = rng.choices(list(ROUTE_WEIGHTS), weights=list(ROUTE_WEIGHTS.values()))[0]
+    page = 1 if rng.random() < 0.8 else rng.randrange(2, 6)
+    if route == "/group/<id>":
+        return route, f"/group/{rng.choice(population.group_ids())}?page={page}"
+    if route == "/friend/<id>":
+        return route, f"/friend/{rng.choice(population.friend_ids())}?page={page}"
+    if route == "/image_proxy":
+        url = fake_mirai.image_url(mirai_url, rng.randrange(population.images))
+        size = rng.choice((64, 128, 200))
+        return route, str(httpx.URL("/image_proxy", params={"url": url, "w": size, "h": size}))
+    return route, "/"
+
+
+async def drive_pages(web_url: str, mirai_url: str, population: Population, clients: int,
+                      duration: float) -> Dict[str, Tuple[List[float], int]]:
+    """clients 个并发客户端持续请求，返回 路由名 -> (成功请求的耗时, 失败次数)"""
+    results: Dict[str, Tuple[List[float], int]] = {route: ([], 0) for route in ROUTE_WEIGHTS}
+    stop = time.monotonic() + duration
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=web_url, timeout=30, limits=limits) as client:
+        async def worker(seed: int):
+            rng = random.Random(seed)
+            while time.monotonic() < stop:
+                route, url = pick_request(rng, population, mirai_url)
+                start = time.perf_counter()
+                try:
+                    response = await client.get(url, headers={"Accept": "image/webp,*/*"})
+                    ok = response.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                latencies, errors = results[route]
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    results[route] = (latencies, errors + 1)
+
+        await asyncio.gather(*(worker(seed) for seed in range(clients)))
+    return results
+
+
+def run_page_clients(web_url: str, mirai_url: str, population: Population, clients: int, duration: float,
+                     queue: multiprocessing.Queue):
+    """在子进程中运行网页压测客户端，结果经 queue 返回"""
+    queue.put(asyncio.run(drive_pages(web_url, mirai_url, population, clients, duration)))
+
+
+def isolate(directory: Path):
+    """将数据库、归档与图片缓存改到临时目录，需在 bot 启动前调用"""
+    from saya.WapQQ.dataBase import data_manager
+    from saya.WapQQ.web.image_cache import thumbnail_cache, avatar_cache
+    from saya.WapQQ.web.market_face import market_face_directory
+
+    data_manager.directory = directory
+    thumbnail_cache.path = directory.joinpath("cache", "thumbnails")
+    avatar_cache.path = directory.joinpath("cache", "avatars")
+    market_face_directory.path = directory.joinpath("cache", "market_faces.json")
+
+
+def database_size(directory: Path) -> int:
+    return sum(path.stat().st_size for path in directory.glob("data.db*"))
+
+
+async def stored_messages() -> int:
+    """已写入的消息数，测试期间不删除消息，各表 _id 的最大值之和即为总数，比 COUNT 快得多"""
+    from sqlalchemy import select, func
+    from saya.WapQQ.dataBase import data_manager
+    from saya.WapQQ.dataBase.tables import message_tables
+
+    total = 0
+    for table in message_tables.values():
+        total += await data_manager.storage.fetch_val(select([func.max(table.c._id)])) or 0
+    return total
+
+
+async def wait_until_ready(url: str, timeout: float = 60):
+    async with httpx.AsyncClient() as client:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    raise
+            await asyncio.sleep(0.2)
+
+
+async def run_load(args: argparse.Namespace, population: Population, directory: Path, mirai_url: str):
+    from graia.ariadne.app import Ariadne
+    from saya.WapQQ.web.config import port
+
+    web_url = f"http://127.0.0.1:{port}"
+    try:
+        await wait_until_ready(web_url + "/")
+        queue = multiprocessing.get_context("spawn").Queue()
+        clients = multiprocessing.get_context("spawn").Process(
+            target=run_page_clients, args=(web_url, mirai_url, population, args.clients, args.duration, queue))
+        clients.start()
+        async with httpx.AsyncClient() as client:
+            await client.post(mirai_url + "/start")
+        print(f"{'时间':>6} {'已推送':>8} {'已写入':>8} {'写入/s':>8} {'积压':>6} {'数据库':>10}")
+        started = time.monotonic()
+        first_stored = previous_stored = await stored_messages()
+        previous_time = started
+        async with httpx.AsyncClient(base_url=mirai_url) as client:
+            while time.monotonic() - started < args.duration:
+                await asyncio.sleep(args.report_interval)
+                sent = (await client.get("/stats")).json()["sent"]
+                stored, now = await stored_messages(), time.monotonic()
+                print(f"{now - started:5.0f}s {sent:8d} {stored:8d} "
+                      f"{(stored - previous_stored) / (now - previous_time):8.1f} {sent - stored:6d} "
+                      f"{database_size(directory) / 1024 / 1024:8.1f}MiB")
+                previous_stored, previous_time = stored, now
+            # 停止推送并等待 bot 写完已收到的消息，避免关闭数据库时仍有消息在处理
+            sent = (await client.post("/pause")).json()["sent"]
+        drain_started = time.monotonic()
+        while await stored_messages() < sent and time.monotonic() - drain_started < args.drain_timeout:
+            await asyncio.sleep(0.1)
+        drain_time = time.monotonic() - drain_started
+        stored = await stored_messages()
+        results = await asyncio.to_thread(queue.get)
+        await asyncio.to_thread(clients.join)
+        drained = f"停止推送后 {drain_time:.1f}s 写完积压" if stored >= sent else f"超时后仍有 {sent - stored} 条未写入"
+        print(f"\n共推送 {sent} 条，写入 {stored} 条；测试期间平均写入 "
+              f"{(previous_stored - first_stored) / (previous_time - started):.1f} 条/s ，{drained}；"
+              f"数据库 {database_size(directory) / 1024 / 1024:.1f}MiB")
+        print(f"{'路由':<16} {'请求数':>8} {'失败':>6} {'请求/s':>8} {'p50':>10} {'p99':>10} {'max':>10}")
+        for route, (latencies, errors) in results.items():
+            if not latencies:
+                print(f"{route:<16} {0:8d} {errors:6d}")
+                continue
+            latencies.sort()
+            print(f"{route:<16} {len(latencies):8d} {errors:6d} {len(latencies) / args.duration:8.1f} "
+                  f"{statistics.median(latencies) * 1000:8.2f}ms {percentile(latencies, 0.99) * 1000:8.2f}ms "
+                  f"{latencies[-1] * 1000:8.2f}ms")
+    except Exception as e:
+        logger.exception(f"压测失败：{e!r}")
+    finally:
+        Ariadne.stop()
+
+
+def create_bot(account: int, mirai_url: str):
+    """与 main.py 相同的方式创建 Ariadne 并加载插件"""
+    from creart import create
+    from graia.ariadne.app import Ariadne
+    from graia.ariadne.connection.config import config, HttpClientConfig, WebsocketClientConfig
+    from graia.broadcast import Broadcast
+    from graia.saya import Saya
+    from graia.saya.builtins.broadcast import BroadcastBehaviour
+
+    bcc = create(Broadcast)
+    app = Ariadne(connection=config(account, VERIFY_KEY, HttpClientConfig(host=mirai_url),
+                                    WebsocketClientConfig(host=mirai_url)))
+    saya = Saya(bcc)
+    saya.install_behaviours(BroadcastBehaviour(bcc))
+    with saya.module_context():
+        saya.require("saya.WapQQ")
+    return app, bcc
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    fake_mirai.add_arguments(parser)
+    parser.add_argument("--duration", type=float, default=60, help="单位：秒，网页压测与推送事件的时间")
+    parser.add_argument("--clients", type=int, default=8, help="网页压测的并发数")
+    parser.add_argument("--report-interval", type=float, default=5)
+    parser.add_argument("--drain-timeout", type=float, default=30, help="单位：秒，停止推送后等待写完积压的时间上限")
+    parser.add_argument("--log-level", default="WARNING", help="bot 的日志级别，INFO 时每条消息都会输出日志")
+    parser.add_argument("--keep", type=Path, help="保存数据库与缓存的目录，默认使用临时目录并在结束后删除")
+    args = parser.parse_args()
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+    sys.path.insert(0, str(root))
+
+    population = fake_mirai.population_of(args)
+    mirai_url = f"http://127.0.0.1:{args.mirai_port}"
+    mirai = multiprocessing.get_context("spawn").Process(
+        target=fake_mirai.serve, args=(args.mirai_port, args.rate, population, args.friend_ratio, args.sync_ratio,
+                                       args.image_ratio, False), daemon=True)
+    mirai.start()
+    temporary: Optional[tempfile.TemporaryDirectory] = None
+    if args.keep is None:
+        temporary = tempfile.TemporaryDirectory()
+        directory = Path(temporary.name)
+    else:
+        directory = args.keep
+        directory.mkdir(parents=True, exist_ok=True)
+    try:
+        asyncio.run(wait_until_ready(mirai_url + "/stats"))
+        if httpx.get(mirai_url + "/stats").json().get("pid") != mirai.pid:
+            raise SystemExit(f"端口 {args.mirai_port} 已被其他进程占用，请结束它或使用 --mirai-port 指定其他端口")
+        from graia.ariadne.app import Ariadne
+        from graia.ariadne.event.lifecycle import ApplicationLaunched
+
+        app, bcc = create_bot(population.account, mirai_url)
+        isolate(directory)
+
+        @bcc.receiver(ApplicationLaunched)
+        async def start_load():
+            asyncio.create_task(run_load(args, population, directory, mirai_url))
+
+        Ariadne.launch_blocking()
+    finally:
+        mirai.terminate()
+        mirai.join()
+        if temporary is not None:
+            temporary.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""比较各消息编码的存储大小与解码速度，未安装 msgpack / cbor2 / zstandard 时跳过对应的组合
+
+用法：python benchmark/message_codec.py [--messages 20000] [--repeat 3]
+"""
+import argparse
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, List, Optional, Union
+
+from graia.ariadne.message.chain import MessageChain
+from graia.ariadne.message.element import Plain, At, Face, Image, Forward, ForwardNode
+
+import _plugin  # noqa: F401
+from saya.WapQQ.dataBase.codec import MessageCodec, serializers, compressions, train_dictionary
+
+WORDS = ["今天", "晚上", "一起", "吃饭", "吗", "哈哈哈", "好的", "收到", "这个", "怎么", "办", "明天", "开会",
+         "ok", "图片", "看看", "不错", "？", "！", "在吗", "discord", "github", "链接", "已经", "发了"]
+
+
+def make_chain(rng: random.Random) -> MessageChain:
+    """按群聊中常见的比例生成消息：多数为短文本，部分带 @ 、表情或图片"""
+    elements = []
+    if rng.random() < 0.15:
+        elements.append(At(rng.randrange(10000, 999999999)))
+    elements.append(Plain("".join(rng.choice(WORDS) for _ in range(rng.randrange(1, 12)))))
+    if rng.random() < 0.2:
+        elements.append(Face(id=rng.randrange(0, 300), name="表情"))
+    if rng.random() < 0.15:
+        image_id = "{%08X-%04X-%04X-%04X-%012X}.jpg" % tuple(rng.getrandbits(bits) for bits in (32, 16, 16, 16, 48))
+        elements.append(Image(id=image_id, url=f"http://gchat.qpic.cn/gchatpic_new/0/0-0-{image_id[1:9]}/0?term=2"))
+    return MessageChain(elements)
+
+
+def check_round_trip(name: str, codec: MessageCodec):
+    """合并转发中的节点带有 datetime ，编码后应能还原出相同的消息链"""
+    node = ForwardNode(target=10001, time=datetime.now(), name="发送者",
+                       message=MessageChain([Plain("转发的消息"), At(10002)]))
+    chain = MessageChain([Plain("看看这个"), Forward([node])])
+    decoded = codec.decode(codec.encode(chain))
+    if decoded.json() != chain.json():
+        raise AssertionError(f"{name} 无法还原合并转发消息：{decoded.json()}")
+
+
+def measure(name: str, chains: List[MessageChain], encode: Callable[[MessageChain], Union[str, bytes]],
+            codec: MessageCodec, repeat: int, legacy_size: Optional[int]):
+    start = time.perf_counter()
+    contexts = [encode(chain) for chain in chains]
+    encode_time = time.perf_counter() - start
+    size = sum(len(context.encode() if isinstance(context, str) else context) for context in contexts)
+    decode_obj_time = decode_time = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for context in contexts:
+            codec.decode_obj(context)
+        decode_obj_time = min(decode_obj_time, time.perf_counter() - start)
+        start = time.perf_counter()
+        for context in contexts:
+            codec.decode(context)
+        decode_time = min(decode_time, time.perf_counter() - start)
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory).joinpath("bench.db")
+        connection = sqlite3.connect(path)
+        connection.execute("CREATE TABLE message (_id INTEGER PRIMARY KEY, context VARCHAR)")
+        connection.executemany("INSERT INTO message (context) VALUES (?)", ((context,) for context in contexts))
+        connection.commit()
+        connection.close()
+        db_size = path.stat().st_size
+    count = len(chains)
+    ratio = f"{size / legacy_size:6.1%}" if legacy_size else "   -  "
+    print(f"{name:<24} {size / count:7.1f}B {ratio} db={db_size / 1024:8.0f}KiB "
+          f"encode={count / encode_time:9.0f}/s decode={count / decode_obj_time:9.0f}/s "
+          f"parse={count / decode_time:7.0f}/s")
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    rng = random.Random(0)
+    chains = [make_chain(rng) for _ in range(args.messages)]
+    print(f"{'codec':<24} {'平均大小':>7} {'占比':>6} {'数据库':>12} {'编码':>16} {'解码':>16} {'解码为消息链':>10}")
+    training, chains = chains[:len(chains) // 4], chains[len(chains) // 4:]  # 训练样本不参与测量
+    legacy_size = measure("json (旧版文本)", chains, lambda chain: chain.json(), MessageCodec("json", None, 0),
+                          args.repeat, None)
+    for serializer in serializers.values():
+        if not serializer.available:
+            print(f"{serializer.name:<24} 未安装，跳过")
+            continue
+        for compression in compressions.values():
+            if not compression.available:
+                continue
+            level = {"zlib": 6, "zstd": 3}.get(compression.name, 0)
+            codec = MessageCodec(serializer.name, compression.name, level)
+            name = f"{serializer.name}+{compression.name}" if compression.name else serializer.name
+            check_round_trip(name, codec)
+            measure(name, chains, codec.encode, codec, args.repeat, legacy_size)
+            if compression.name is None:
+                continue
+            samples = [codec.serialize(chain) for chain in training]
+            codec.load_dictionaries([(1, compression.name, train_dictionary(compression.name, samples, 32768))])
+            check_round_trip(f"{name}+dict", codec)
+            measure(f"{name}+dict", chains, codec.encode, codec, args.repeat, legacy_size)
+
+
+if __name__ == "__main__":
+    main()
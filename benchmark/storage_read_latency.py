@@ -0,0 +1,91 @@
+"""比较默认连接方式与 WAL 存储参数下，写入进行时网页读取的延迟
+
+用法：python benchmark/storage_read_latency.py [--duration 10] [--rows 50000]
+"""
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from databases import Database
+from sqlalchemy import create_engine
+
+import _plugin  # noqa: F401
+from saya.WapQQ.dataBase.storage import Storage, StorageProfile
+from saya.WapQQ.dataBase.tables import metadata, GroupMessageTable
+
+CONTEXT = '[{"type": "Plain", "text": "benchmark message"}]'
+
+
+def prepare(path: Path, rows: int) -> str:
+    url = f"sqlite:///{path}"
+    engine = create_engine(url)
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(GroupMessageTable.insert(),
+                           [dict(senderID=i % 50, groupID=1, timestamp=time.time(), context=CONTEXT)
+                            for i in range(rows)])
+    engine.dispose()
+    return url
+
+
+def page_query():
+    return GroupMessageTable.select().where(GroupMessageTable.c.groupID == 1) \
+        .order_by(GroupMessageTable.c._id.desc()).limit(30)
+
+
+async def run(execute, fetch_all, duration: float):
+    latencies = []
+    writes = 0
+    stop = time.monotonic() + duration
+
+    async def writer():
+        nonlocal writes
+        while time.monotonic() < stop:
+            await execute(GroupMessageTable.insert(), dict(senderID=1, groupID=1, timestamp=time.time(),
+                                                           context=CONTEXT))
+            writes += 1
+
+    async def reader():
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            await fetch_all(page_query())
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(writer(), reader(), reader())
+    return latencies, writes
+
+
+def report(name: str, latencies, writes: int, duration: float):
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:<10} reads={len(latencies):<7} p50={statistics.median(latencies) * 1000:8.2f}ms "
+          f"p99={p99 * 1000:8.2f}ms max={latencies[-1] * 1000:8.2f}ms writes/s={writes / duration:8.1f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--rows", type=int, default=50000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        url = prepare(Path(directory).joinpath("default.db"), args.rows)
+        database = Database(url)
+        await database.connect()
+        report("default", *await run(database.execute, database.fetch_all, args.duration), args.duration)
+        await database.disconnect()
+
+        url = prepare(Path(directory).joinpath("wal.db"), args.rows)
+        database = Database(url)
+        await database.connect()
+        storage = Storage(database, StorageProfile())
+        await storage.open()
+        report("wal", *await run(storage.execute, storage.fetch_all, args.duration), args.duration)
+        await storage.close()
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+"""比较线程与进程池生成各类缩略图的耗时、期间事件循环的最大延迟，以及默认格式与 WebP 的输出大小
+
+用法：python benchmark/transcode.py [--concurrency 8] [--processes 2]
+"""
+import argparse
+import asyncio
+import itertools
+import time
+from io import BytesIO
+from typing import Callable, Dict
+
+from PIL import Image
+
+import _plugin  # noqa: F401
+from saya.WapQQ.web.config import max_width, max_height
+from saya.WapQQ.web.transcode import TranscodeEngine
+
+
+def noise(size, mode="RGB") -> Image.Image:
+    """带轻微噪点的渐变图，比纯噪点更接近照片的压缩特性"""
+    gradient = Image.linear_gradient("L").resize(size)
+    channels = [Image.blend(gradient.rotate(90 * i), Image.effect_noise(size, 48), 0.2) for i in range(3)]
+    return Image.merge("RGB", channels).convert(mode)
+
+
+def animated(img_format: str, frames: int, size, **kwargs) -> bytes:
+    images = [noise(size, "RGBA").rotate(i * 6) for i in range(frames)]
+    out = BytesIO()
+    images[0].save(out, format=img_format, save_all=True, append_images=images[1:], duration=40, loop=0, **kwargs)
+    return out.getvalue()
+
+
+def still(img_format: str, size, mode: str) -> bytes:
+    out = BytesIO()
+    noise(size, mode).save(out, format=img_format)
+    return out.getvalue()
+
+
+SAMPLES: Dict[str, Callable[[], bytes]] = {
+    "jpeg 4000x3000": lambda: still("JPEG", (4000, 3000), "RGB"),
+    "png rgba 1500x1500": lambda: still("PNG", (1500, 1500), "RGBA"),
+    "gif 60x480x480": lambda: animated("GIF", 60, (480, 480)),
+    "apng 30x400x400": lambda: animated("PNG", 30, (400, 400)),
+    "webp 30x400x400": lambda: animated("WEBP", 30, (400, 400)),
+}
+
+
+async def measure(engine: TranscodeEngine, data: bytes, concurrency: int, webp: bool):
+    lag = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal lag
+        while running:
+            start = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lag = max(lag, time.perf_counter() - start - 0.005)
+
+    tick = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    results = await asyncio.gather(*(engine.transcode(data, max_width, max_height, webp) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    running = False
+    await tick
+    return elapsed, lag, len(results[0][0])
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--processes", type=int, default=2)
+    args = parser.parse_args()
+    engines = {"thread": TranscodeEngine(0), "process": TranscodeEngine(args.processes)}
+    for engine in engines.values():
+        await engine.start()
+    for name, factory in SAMPLES.items():
+        data = factory()
+        for (engine_name, engine), webp in itertools.product(engines.items(), (False, True)):
+            elapsed, lag, size = await measure(engine, data, args.concurrency, webp)
+            print(f"{name:<20} {engine_name:<8} {'webp' if webp else 'default':<8} "
+                  f"in={len(data) / 1024:9.1f}KiB out={size / 1024:7.1f}KiB "
+                  f"total={elapsed * 1000:8.1f}ms per_image={elapsed * 1000 / args.concurrency:7.1f}ms "
+                  f"max_loop_lag={lag * 1000:7.1f}ms")
+    for engine in engines.values():
+        engine.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,125 @@
+"""WapQQ 维护命令，用法：python manage.py <命令>
+
+backfill-render  为已有消息预渲染 HTML 片段（web/config.py 中的 render_cache）
+backfill-search  为升级前写入的消息补全纯文本，使其可被全文搜索
+build-face-sprite  生成 QQ 表情的雪碧图（web/config.py 中的 face_mode）
+train-message-dictionary  以最近的消息训练压缩字典，之后写入的消息以该字典压缩
+reencode-messages  将已有消息转换为当前配置的编码格式
+archive-messages  按保留策略将旧消息移入归档数据库（dataBase/config.py 中的 retention_*）
+"""
+import argparse
+import asyncio
+import sys
+import types
+from pathlib import Path
+
+root = Path(__file__).parent
+
+
+def import_plugin_package():
+    """saya/WapQQ/__init__.py 需要在 Saya 的 module_context 中执行，这里注册一个空的包对象以跳过它，之后可直接导入子模块"""
+    if str(root) not in sys.path:
+        sys.path.insert(0, str(root))
+    if "saya.WapQQ" not in sys.modules:
+        import saya  # noqa: F401
+
+        package = types.ModuleType("saya.WapQQ")
+        package.__path__ = [str(root.joinpath("saya", "WapQQ"))]
+        sys.modules["saya.WapQQ"] = package
+
+
+async def backfill_render(args: argparse.Namespace):
+    from saya.WapQQ.dataBase import data_manager
+    from saya.WapQQ.web.render import backfill_rendered_messages
+
+    await data_manager.connect()
+    try:
+        count = await backfill_rendered_messages(args.batch_size)
+    finally:
+        await data_manager.shutdown()
+    print(f"共渲染 {count} 条消息")
+
+
+async def backfill_search(args: argparse.Namespace):
+    from saya.WapQQ.dataBase import data_manager
+
+    await data_manager.connect()
+    try:
+        count = await data_manager.backfill_search(args.batch_size)
+    finally:
+        await data_manager.shutdown()
+    print(f"共处理 {count} 条消息")
+
+
+async def build_face_sprite(args: argparse.Namespace):
+    from saya.WapQQ.web.face_sprite import build_face_sprite as build
+
+    print(f"已生成 {await asyncio.to_thread(build)} 个表情的雪碧图")
+
+
+async def train_message_dictionary(args: argparse.Namespace):
+    from saya.WapQQ.dataBase import data_manager
+
+    await data_manager.connect()
+    try:
+        dictionary_id = await data_manager.train_message_dictionary(args.samples, args.size, args.compression)
+    finally:
+        await data_manager.shutdown()
+    print(f"已生成编号为 {dictionary_id} 的压缩字典，可执行 reencode-messages 以新字典重新编码已有消息")
+
+
+async def reencode_messages(args: argparse.Namespace):
+    from saya.WapQQ.dataBase import data_manager
+
+    await data_manager.connect()
+    try:
+        count = await data_manager.reencode_messages(args.batch_size)
+        if args.vacuum:
+            await data_manager.storage.execute("VACUUM")
+    finally:
+        await data_manager.shutdown()
+    print(f"共重新编码 {count} 条消息")
+
+
+async def archive_messages(args: argparse.Namespace):
+    from saya.WapQQ.dataBase import data_manager
+
+    await data_manager.connect()
+    try:
+        count = await data_manager.run_retention(args.batch_size)
+    finally:
+        await data_manager.shutdown()
+    print(f"共归档 {count} 条消息")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WapQQ 维护命令")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill = commands.add_parser("backfill-render", help="为已有消息预渲染 HTML 片段")
+    backfill.add_argument("--batch-size", type=int, default=None, help="每批渲染的消息数")
+    backfill.set_defaults(func=backfill_render)
+    backfill = commands.add_parser("backfill-search", help="为升级前写入的消息补全纯文本")
+    backfill.add_argument("--batch-size", type=int, default=None, help="每个事务处理的消息数")
+    backfill.set_defaults(func=backfill_search)
+    sprite = commands.add_parser("build-face-sprite", help="生成 QQ 表情的雪碧图")
+    sprite.set_defaults(func=build_face_sprite)
+    train = commands.add_parser("train-message-dictionary", help="训练消息编码的压缩字典")
+    train.add_argument("--samples", type=int, default=None, help="作为样本的最近消息数")
+    train.add_argument("--size", type=int, default=None, help="字典大小，单位：字节")
+    train.add_argument("--compression", choices=("zlib", "zstd"), default=None,
+                       help="默认使用 dataBase/config.py 中的 message_compression ，未配置时优先使用 zstd")
+    train.set_defaults(func=train_message_dictionary)
+    reencode = commands.add_parser("reencode-messages", help="将已有消息转换为当前配置的编码格式")
+    reencode.add_argument("--batch-size", type=int, default=None, help="每个事务处理的消息数")
+    reencode.add_argument("--vacuum", action="store_true", help="完成后执行 VACUUM 以回收空间")
+    reencode.set_defaults(func=reencode_messages)
+    archive = commands.add_parser("archive-messages", help="按保留策略将旧消息移入归档数据库")
+    archive.add_argument("--batch-size", type=int, default=None, help="每个事务移动的消息数")
+    archive.set_defaults(func=archive_messages)
+    args = parser.parse_args()
+    import_plugin_package()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
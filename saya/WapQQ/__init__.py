@@ -1,12 +1,20 @@
+from typing import Union
+
+from graia.ariadne.app import Ariadne
 from graia.ariadne.event.lifecycle import ApplicationLaunched, ApplicationShutdowned
 from graia.ariadne.event.message import GroupMessage, FriendMessage, GroupSyncMessage, FriendSyncMessage
+from graia.ariadne.event.mirai import BotJoinGroupEvent, BotLeaveEventActive, BotLeaveEventKick, \
+    BotLeaveEventDisband, GroupNameChangeEvent, FriendNickChangedEvent, MemberCardChangeEvent, BotReloginEvent
 
 from graia.saya import Channel
 from graia.saya.builtins.broadcast.schema import ListenerSchema
 
+from .contact import contact_directory
 from .dataBase import data_manager
+from .metrics import timed_handler, instrument_ariadne
 
 from .web import launch_webserver, stop_webserver
+from .web.live import publish_message
 
 channel = Channel.current()
 
@@ -16,21 +24,28 @@ channel.author("Cubesugarcheese")
 
 
 @channel.use(ListenerSchema(listening_events=[ApplicationLaunched]))
+@timed_handler
 async def launch():
+    instrument_ariadne(Ariadne.current())
     await data_manager.startup()
+    await contact_directory.start()
     await launch_webserver()
 
 
 @channel.use(ListenerSchema(listening_events=[ApplicationShutdowned]))
+@timed_handler
 async def stop():
     await data_manager.shutdown()
+    await contact_directory.stop()
     await stop_webserver()
 
 
 @channel.use(ListenerSchema(listening_events=[GroupMessage]))
+@timed_handler
 async def handle_group_message(message: GroupMessage):
     group = message.sender.group
     member = message.sender
+    contact_directory.update_group(group)
     await data_manager.add_group_message(message)
     if not await data_manager.has_in_group_table(group):
         await data_manager.add_group(group)
@@ -41,29 +56,79 @@ async def handle_group_message(message: GroupMessage):
     await data_manager.update_group_name(group)
     await data_manager.update_account_name(member)
     await data_manager.update_member_name(member)
+    await publish_message("group", group.id, member.id, member.name, message.message_chain,
+                          message.source.time.timestamp())
 
 
 @channel.use(ListenerSchema(listening_events=[FriendMessage]))
+@timed_handler
 async def handle_friend_message(message: FriendMessage):
     friend = message.sender
+    contact_directory.update_friend(friend)
     await data_manager.add_friend_message(message)
-    if not await data_manager.has_in_accountTable(friend):
+    if not await data_manager.has_in_account_table(friend):
         await data_manager.add_account(friend)
     await data_manager.update_account_name(friend)
+    await publish_message("friend", friend.id, friend.id, friend.nickname, message.message_chain,
+                          message.source.time.timestamp())
 
 
 @channel.use(ListenerSchema(listening_events=[GroupSyncMessage]))
-async def handle_group_sync_message(message: GroupSyncMessage):
+@timed_handler
+async def handle_group_sync_message(app: Ariadne, message: GroupSyncMessage):
     group_id = message.subject.id
     await data_manager.add_sync_group_message(message)
     await data_manager.add_bot_member(group_id)
     await data_manager.update_bot_member_name(group_id)
     await data_manager.add_bot_account()
     await data_manager.update_bot_account_name()
+    await publish_message("group", group_id, app.account, await data_manager.get_bot_sender_name(group_id),
+                          message.message_chain)
 
 
 @channel.use(ListenerSchema(listening_events=[FriendSyncMessage]))
-async def handle_friend_sync_message(message: FriendSyncMessage):
+@timed_handler
+async def handle_friend_sync_message(app: Ariadne, message: FriendSyncMessage):
     await data_manager.add_sync_friend_message(message)
     await data_manager.add_bot_account()
     await data_manager.update_bot_account_name()
+    await publish_message("friend", message.subject.id, app.account, await data_manager.get_bot_nickname(),
+                          message.message_chain)
+
+
+@channel.use(ListenerSchema(listening_events=[BotJoinGroupEvent]))
+@timed_handler
+async def handle_bot_join_group(event: BotJoinGroupEvent):
+    contact_directory.update_group(event.group)
+
+
+@channel.use(ListenerSchema(listening_events=[BotLeaveEventActive, BotLeaveEventKick, BotLeaveEventDisband]))
+@timed_handler
+async def handle_bot_leave_group(event: Union[BotLeaveEventActive, BotLeaveEventKick, BotLeaveEventDisband]):
+    contact_directory.remove_group(event.group.id)
+    data_manager.invalidate_bot_profile(event.group.id)
+
+
+@channel.use(ListenerSchema(listening_events=[GroupNameChangeEvent]))
+@timed_handler
+async def handle_group_name_change(event: GroupNameChangeEvent):
+    contact_directory.rename_group(event.group.id, event.current)
+
+
+@channel.use(ListenerSchema(listening_events=[FriendNickChangedEvent]))
+@timed_handler
+async def handle_friend_nick_change(event: FriendNickChangedEvent):
+    contact_directory.update_friend(event.friend)
+
+
+@channel.use(ListenerSchema(listening_events=[MemberCardChangeEvent]))
+@timed_handler
+async def handle_member_card_change(app: Ariadne, event: MemberCardChangeEvent):
+    if event.member.id == app.account:
+        data_manager.invalidate_bot_profile(event.member.group.id)
+
+
+@channel.use(ListenerSchema(listening_events=[BotReloginEvent]))
+@timed_handler
+async def handle_bot_relogin():
+    data_manager.invalidate_bot_profile()
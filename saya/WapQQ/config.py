@@ -0,0 +1,5 @@
+contact_refresh_interval = 300  # 单位：秒，后台刷新群列表与好友列表的间隔
+contact_min_refresh_interval = 10  # 单位：秒，查找不到群或好友时立即刷新，但两次刷新至少间隔该时间
+metrics = True  # 在 /metrics 输出 Prometheus 格式的耗时与缓存统计，修改后需重启
+# 单位：秒，耗时直方图的分桶
+metrics_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
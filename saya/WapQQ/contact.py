@@ -0,0 +1,88 @@
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+from graia.ariadne.app import Ariadne
+from graia.ariadne.model import Group, Friend
+from loguru import logger
+
+from .config import contact_refresh_interval, contact_min_refresh_interval
+
+
+class ContactDirectory:
+    """缓存群列表与好友列表，后台定时刷新，并由群名、好友昵称、进退群等事件即时更新"""
+
+    def __init__(self, refresh_interval: float, min_refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.groups: Dict[int, Group] = {}
+        self.friends: Dict[int, Friend] = {}
+        self._last_refresh = 0.0
+        self._refresh_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """完成首次刷新后在后台定时刷新"""
+        await self.refresh()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("刷新群列表与好友列表失败")
+
+    async def refresh(self):
+        async with self._refresh_lock:
+            app = Ariadne.current()
+            group_list = await app.get_group_list()
+            friend_list = await app.get_friend_list()
+            self.groups = {group.id: group for group in group_list}
+            self.friends = {friend.id: friend for friend in friend_list}
+            self._last_refresh = time.monotonic()
+
+    async def _refresh_if_stale(self):
+        """查找不到时刷新一次，用于尚未收到事件的新群与新好友"""
+        if time.monotonic() - self._last_refresh >= self.min_refresh_interval:
+            await self.refresh()
+
+    def group_list(self) -> List[Group]:
+        return list(self.groups.values())
+
+    def friend_list(self) -> List[Friend]:
+        return list(self.friends.values())
+
+    async def get_group(self, group_id: int) -> Optional[Group]:
+        if group_id not in self.groups:
+            await self._refresh_if_stale()
+        return self.groups.get(group_id)
+
+    async def get_friend(self, friend_id: int) -> Optional[Friend]:
+        if friend_id not in self.friends:
+            await self._refresh_if_stale()
+        return self.friends.get(friend_id)
+
+    def update_group(self, group: Group):
+        self.groups[group.id] = group
+
+    def rename_group(self, group_id: int, name: str):
+        group = self.groups.get(group_id)
+        if group is not None:
+            group.name = name
+
+    def remove_group(self, group_id: int):
+        self.groups.pop(group_id, None)
+
+    def update_friend(self, friend: Friend):
+        self.friends[friend.id] = friend
+
+
+contact_directory = ContactDirectory(refresh_interval=contact_refresh_interval,
+                                     min_refresh_interval=contact_min_refresh_interval)
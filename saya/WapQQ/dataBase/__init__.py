@@ -1,46 +1,181 @@
+import asyncio
 import time as time_module
-from typing import Optional, Union, List
+from typing import Optional, Union, List, Dict, Iterable, Tuple, Callable, AsyncIterator
 from pathlib import Path
 
 from databases import Database, core
+from databases.interfaces import Record
 from graia.ariadne.app import Ariadne
 from graia.ariadne.event.message import GroupMessage, FriendMessage, GroupSyncMessage, FriendSyncMessage, \
     ActiveFriendMessage, ActiveGroupMessage
 from graia.ariadne.model import Group, Friend, Member, Stranger
 from graia.ariadne.message.chain import MessageChain
 from graia.ariadne.exception import UnknownTarget
-from sqlalchemy import create_engine
+from loguru import logger
+from sqlalchemy import create_engine, select, Column, and_, null, func
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.engine import Engine
-
-from .tables import metadata, GroupTable, AccountTable, MemberTable, FriendMessageTable, GroupMessageTable
+from sqlalchemy.sql.dml import Insert
+
+from ..contact import contact_directory
+from ..metrics import timed_methods, datamanager_seconds
+from .archive import ArchiveStore
+from .cache import IdentityCache, LRUCache, CacheStats, MISSING
+from .codec import message_codec, train_dictionary, compressions, CodecUnavailable, Context
+from .config import write_behind, write_behind_batch_size, write_behind_flush_interval, write_behind_queue_size, \
+    identity_cache_size, identity_cache_ttl, journal_mode, synchronous, cache_size, mmap_size, temp_store, \
+    busy_timeout, reader_count, profile_cache_ttl, search_backfill_on_startup, search_backfill_batch_size, \
+    summary_flush_interval, summary_preview_length, message_dictionary_size, message_dictionary_samples, \
+    message_reencode_batch_size, retention, retention_max_age, retention_max_rows, retention_overrides, \
+    retention_interval, retention_batch_size, archive_partition_format, archive_max_attached, export_batch_size
+from .migrations import migrate
+from .search import SearchQuery, SearchResult, plain_text, create_search_tables, build_search
+from .storage import Storage, StorageProfile
+from .summary import ConversationSummaries, ConversationSummary
+from .tables import metadata, GroupTable, AccountTable, MemberTable, FriendMessageTable, GroupMessageTable, \
+    MessageRenderTable, MessageDictionaryTable, MessageArchiveTable, ConversationSummaryTable, message_tables, \
+    conversation_columns
 from .utils import MessageContainer, get_time_by_timestamp
+from .writer import WriteBehindQueue, WriteBehindStats
 
 current_path = Path(__file__).parents[0]
 
 
+@timed_methods(datamanager_seconds)
 class DataManager:
     """数据库管理类"""
     # see https://docs.sqlalchemy.org/en/14/core/engines.html#sqlite
-    DATABASE_URL: str = f"sqlite:///{current_path}/data.db"
-    database: core.Database = Database(DATABASE_URL)
+    DATABASE_URL: str
+    database: core.Database
+    storage: Storage
     engine: Engine
     app: Ariadne
+    writer: Optional[WriteBehindQueue] = None
+    search_available: bool = False
+    search_backfill_task: Optional[asyncio.Task] = None
+    retention_task: Optional[asyncio.Task] = None
+    archive: ArchiveStore
+    message_hooks: List[Callable[[MessageChain], None]]
+    identity_cache: IdentityCache
+    profile_cache: LRUCache
+    summaries: ConversationSummaries
+    group_message_counts: Dict[int, int]
+    friend_message_counts: Dict[int, int]
+    message_count_generation: int
+
+    def __init__(self, directory: Path = current_path):
+        self.directory = directory  # data.db 与归档分区所在的目录，connect 时据此创建连接，可在 connect 前修改
+        # 写入收到的消息后依次调用，不会等待，用于图片预取等后台任务
+        self.message_hooks = []
+        self.identity_cache = IdentityCache(identity_cache_size, identity_cache_ttl)
+        self.profile_cache = LRUCache(identity_cache_size, profile_cache_ttl)  # "bot" -> nickname，groupID -> name
+        self.summaries = ConversationSummaries(summary_preview_length, summary_flush_interval)
+        # 各会话的消息数，首次查询时 COUNT 一次，之后在写入提交后递增
+        self.group_message_counts = {}
+        self.friend_message_counts = {}
+        # 消息表每次提交写入或删除时递增，COUNT 期间有变化则不缓存结果
+        self.message_count_generation = 0
 
     async def startup(self):
         """应在开启 bot 时调用，用于开启数据库连接"""
+        await self.connect()
+        self.app = Ariadne.current()
+        await self.warm_identity_cache()
+        self.summaries.start()
+        if write_behind:
+            self.writer = WriteBehindQueue(self.storage, batch_size=write_behind_batch_size,
+                                           flush_interval=write_behind_flush_interval,
+                                           queue_size=write_behind_queue_size, on_written=self._on_written)
+            self.writer.start()
+        if self.search_available and search_backfill_on_startup:
+            self.search_backfill_task = asyncio.create_task(self.backfill_search())
+        if retention:
+            self.retention_task = asyncio.create_task(self._run_retention_periodically())
+
+    async def connect(self):
+        """开启数据库连接并完成建表与迁移，不依赖 Ariadne ，manage.py 等离线工具只调用这一步"""
+        self.DATABASE_URL = f"sqlite:///{self.directory.joinpath('data.db')}"
+        self.database = Database(self.DATABASE_URL)
+        self.archive = ArchiveStore(self.directory.joinpath("archive"), archive_partition_format,
+                                    archive_max_attached)
         await self.database.connect()
         self.engine = create_engine(self.DATABASE_URL, connect_args={"check_same_thread": False})
         metadata.create_all(self.engine)  # 自动检查是否已经创建表，若无，则创建
-        self.app = Ariadne.current()
+        self.storage = Storage(self.database, StorageProfile(journal_mode=journal_mode, synchronous=synchronous,
+                                                             cache_size=cache_size, mmap_size=mmap_size,
+                                                             temp_store=temp_store, busy_timeout=busy_timeout,
+                                                             reader_count=reader_count))
+        await self.storage.open()
+        await migrate(self.storage)
+        async with self.storage.transaction() as connection:
+            self.search_available = await create_search_tables(connection)
+        await self.summaries.load(self.storage)
+        await self.load_message_dictionaries()
+        await self.archive.open(self.storage)
 
     async def shutdown(self):
         """应在关闭 bot 时调用，用于关闭数据库连接"""
+        if self.search_backfill_task is not None:
+            self.search_backfill_task.cancel()  # 已完成的批次已提交，下次启动时继续
+            self.search_backfill_task = None
+        if self.retention_task is not None:
+            self.retention_task.cancel()  # 每批在单独的事务中完成，中断不会丢失消息
+            self.retention_task = None
+        await self.summaries.stop()
+        if self.writer is not None:
+            await self.writer.stop()  # 保证缓冲中的数据全部写入后再断开连接
+            self.writer = None
+        await self.archive.close()
+        await self.storage.close()
         await self.database.disconnect()
 
+    async def warm_identity_cache(self):
+        """从数据库中读取最近的 Group / Account / Member 预热身份缓存"""
+        self.identity_cache.clear()
+        for key_column, table, cache in ((GroupTable.c.groupID, GroupTable, self.identity_cache.groups),
+                                         (AccountTable.c.accountID, AccountTable, self.identity_cache.accounts)):
+            query = select([key_column, table.c.name]).order_by(table.c._id.desc()).limit(cache.max_size)
+            for key, name in reversed(await self.storage.fetch_all(query)):
+                cache.set(key, name)
+        query = select([MemberTable.c.accountID, MemberTable.c.groupID, MemberTable.c.name]) \
+            .order_by(MemberTable.c._id.desc()).limit(self.identity_cache.members.max_size)
+        for account_id, group_id, name in reversed(await self.storage.fetch_all(query)):
+            self.identity_cache.members.set((account_id, group_id), name)
+
+    def identity_cache_stats(self) -> Dict[str, CacheStats]:
+        """身份缓存与 Bot 资料缓存的命中统计，用于调整缓存大小"""
+        return {**self.identity_cache.stats(), "profile": self.profile_cache.stats()}
+
+    async def _write(self, query, values: Optional[dict] = None):
+        """执行写操作，开启写缓冲时放入队列批量写入，否则直接写入"""
+        if self.writer is not None:
+            await self.writer.put(query, values)
+        else:
+            await self.storage.execute(query, values)
+            self._on_written(query, values)
+
+    def _on_written(self, query, values: Optional[dict]):
+        """写入提交后调用，插入消息时递增对应会话的消息数"""
+        if values is None or not isinstance(query, Insert):
+            return
+        for kind, table in message_tables.items():
+            if query.table is table:
+                self.message_count_generation += 1
+                counts = self.group_message_counts if kind == "group" else self.friend_message_counts
+                self._increase_message_count(counts, values[conversation_columns[kind]])
+
+    def write_behind_stats(self) -> Optional[WriteBehindStats]:
+        """写缓冲的队列深度与写入耗时统计，未开启时返回 None"""
+        if self.writer is None:
+            return None
+        return self.writer.stats()
+
     async def has_in_group_table(self, group: Group) -> bool:
         """检查数据库中是否已有该 Group """
+        if self.identity_cache.groups.get(group.id) is not MISSING:
+            return True
         query = GroupTable.select().where(GroupTable.c.groupID == group.id)
-        result = await self.database.fetch_val(query)
+        result = await self.storage.fetch_val(query)
         if result is not None:
             return True
         else:
@@ -48,8 +183,10 @@ class DataManager:
 
     async def has_in_account_table(self, account: Union[Friend, Stranger, Member]) -> bool:
         """检查数据库中是否已有该 Account """
+        if self.identity_cache.accounts.get(account.id) is not MISSING:
+            return True
         query = AccountTable.select().where(AccountTable.c.accountID == account.id)
-        result = await self.database.fetch_val(query)
+        result = await self.storage.fetch_val(query)
         if result is not None:
             return True
         else:
@@ -57,160 +194,248 @@ class DataManager:
 
     async def has_in_member_table(self, account: Member) -> bool:
         """检查数据库中是否已有该 Member """
-        query = AccountTable.select() \
+        if self.identity_cache.members.get((account.id, account.group.id)) is not MISSING:
+            return True
+        query = MemberTable.select() \
             .where(MemberTable.c.accountID == account.id) \
             .where(MemberTable.c.groupID == account.group.id)
-        result = await self.database.fetch_val(query)
+        result = await self.storage.fetch_val(query)
         if result is not None:
             return True
         else:
             return False
 
     async def add_group(self, group: Group):
-        """往数据库中添加新 Group """
-        query = GroupTable.insert().values(groupID=group.id, name=group.name)
-        await self.database.execute(query)
+        """往数据库中添加新 Group ，已存在时更新名称"""
+        query = insert(GroupTable).values(groupID=group.id, name=group.name) \
+            .on_conflict_do_update(index_elements=[GroupTable.c.groupID], set_={"name": group.name})
+        await self._write(query)
+        self.identity_cache.groups.set(group.id, group.name)
 
     async def add_account(self, account: Union[Friend, Stranger, Member]):
-        """往数据库中添加新 Account """
+        """往数据库中添加新 Account ，已存在时更新名称"""
         if isinstance(account, Member):
             profile = await account.get_profile()
-            query = AccountTable.insert().values(accountID=account.id, name=profile.nickname)
+            name = profile.nickname
         else:
-            query = AccountTable.insert().values(accountID=account.id, name=account.nickname)
-        await self.database.execute(query)
+            name = account.nickname
+        query = insert(AccountTable).values(accountID=account.id, name=name) \
+            .on_conflict_do_update(index_elements=[AccountTable.c.accountID], set_={"name": name})
+        await self._write(query)
+        self.identity_cache.accounts.set(account.id, name)
 
     async def add_member(self, account: Member):
-        """往数据库中添加新 Member """
-        query = MemberTable.insert().values(accountID=account.id, groupID=account.group.id, name=account.name)
-        await self.database.execute(query)
+        """往数据库中添加新 Member ，已存在时更新名称"""
+        query = insert(MemberTable).values(accountID=account.id, groupID=account.group.id, name=account.name) \
+            .on_conflict_do_update(index_elements=[MemberTable.c.accountID, MemberTable.c.groupID],
+                                   set_={"name": account.name})
+        await self._write(query)
+        self.identity_cache.members.set((account.id, account.group.id), account.name)
+
+    async def get_bot_nickname(self) -> str:
+        """获取 Bot 自身的 nickname ，结果在 profile_cache_ttl 内有效"""
+        nickname = self.profile_cache.get("bot")
+        if nickname is MISSING:
+            profile = await self.app.get_bot_profile()
+            nickname = profile.nickname
+            self.profile_cache.set("bot", nickname)
+        return nickname
+
+    async def get_bot_member_name(self, group_id: int) -> Optional[str]:
+        """获取 Bot 自身在 Group 中的 name ，结果在 profile_cache_ttl 内有效，Bot 不在该群时返回 None"""
+        name = self.profile_cache.get(group_id)
+        if name is MISSING:
+            group = await contact_directory.get_group(group_id)
+            if group is None:
+                return None
+            info = await self.app.get_member_profile(self.app.account, group)
+            name = info.nickname
+            self.profile_cache.set(group_id, name)
+        return name
+
+    async def get_bot_sender_name(self, group_id: int) -> str:
+        """Bot 在 Group 中发言时显示的名称，取不到群名片时依次退回 nickname 与账号"""
+        return await self.get_bot_member_name(group_id) or await self.get_bot_nickname() or str(self.app.account)
+
+    def invalidate_bot_profile(self, group_id: Optional[int] = None):
+        """使缓存的 Bot 资料失效，group_id 为 None 时清空全部"""
+        if group_id is None:
+            self.profile_cache.clear()
+        else:
+            self.profile_cache.discard(group_id)
 
     async def add_bot_account(self):
         """往数据库中添加 Bot 自身的账号信息"""
-        profile = await self.app.get_bot_profile()
-        query = AccountTable.insert().values(accountID=self.app.account, name=profile.nickname)
-        await self.database.execute(query)
+        if self.identity_cache.accounts.get(self.app.account) is not MISSING:
+            return
+        name = await self.get_bot_nickname()
+        query = insert(AccountTable).values(accountID=self.app.account, name=name) \
+            .on_conflict_do_update(index_elements=[AccountTable.c.accountID], set_={"name": name})
+        await self._write(query)
+        self.identity_cache.accounts.set(self.app.account, name)
 
     async def add_bot_member(self, group_id: int):
         """往数据库中添加 Bot 自身在 Group 中的的成员信息"""
-        group = await self.app.get_group(group_id)
-        if group is None:
+        key = (self.app.account, group_id)
+        if self.identity_cache.members.get(key) is not MISSING:
+            return
+        name = await self.get_bot_member_name(group_id)
+        if name is None:
             return
-        info = await self.app.get_member_profile(self.app.account, group)
-        name = info.nickname
-        query = MemberTable.select().where(
-            MemberTable.c.accountID == self.app.account
-        ).where(
-            MemberTable.c.groupID == group_id)
-        result = await self.database.fetch_val(query)
-        if result is None:
-            query = MemberTable.insert().values(name=name, accountID=self.app.account, groupID=group_id)
-            await self.database.execute(query)
+        query = insert(MemberTable).values(name=name, accountID=self.app.account, groupID=group_id) \
+            .on_conflict_do_update(index_elements=[MemberTable.c.accountID, MemberTable.c.groupID],
+                                   set_={"name": name})
+        await self._write(query)
+        self.identity_cache.members.set(key, name)
 
     async def update_group_name(self, group: Group):
         """自动检查 GroupName 是否变化，若变化则更新数据库"""
+        if self.identity_cache.groups.get(group.id) == group.name:
+            return
         query = GroupTable.update().values(name=group.name) \
             .where(GroupTable.c.groupID == group.id) \
             .where(GroupTable.c.name != group.name)
-        await self.database.execute(query)
+        await self._write(query)
+        self.identity_cache.groups.set(group.id, group.name)
 
     async def update_account_name(self, account: Union[Friend, Stranger, Member]):
         """自动检查 AccountName 是否变化，若变化则更新数据库"""
+        cached_name = self.identity_cache.accounts.get(account.id)
         if isinstance(account, Member):
+            if cached_name is not MISSING:
+                return  # Member 的 nickname 需要额外请求 profile，缓存有效期内视为未变化
             try:
                 profile = await account.get_profile()
-                query = AccountTable.update().values(name=profile.nickname) \
-                    .where(AccountTable.c.accountID == account.id) \
-                    .where(AccountTable.c.name != profile.nickname)
+                name = profile.nickname
             except UnknownTarget:
-                query = AccountTable.update().values(name=account.name) \
-                    .where(AccountTable.c.accountID == account.id) \
-                    .where(AccountTable.c.name != account.name)
+                name = account.name
         else:
-            query = AccountTable.update().values(name=account.nickname) \
-                .where(AccountTable.c.accountID == account.id) \
-                .where(AccountTable.c.name != account.nickname)
-        await self.database.execute(query)
+            name = account.nickname
+            if cached_name == name:
+                return
+        query = AccountTable.update().values(name=name) \
+            .where(AccountTable.c.accountID == account.id) \
+            .where(AccountTable.c.name != name)
+        await self._write(query)
+        self.identity_cache.accounts.set(account.id, name)
 
     async def update_member_name(self, account: Member):
         """自动检查 MemberName 是否变化，若变化则更新数据库"""
+        key = (account.id, account.group.id)
+        if self.identity_cache.members.get(key) == account.name:
+            return
         query = MemberTable.update().values(name=account.name) \
             .where(MemberTable.c.accountID == account.id) \
             .where(MemberTable.c.groupID == account.group.id) \
             .where(MemberTable.c.name != account.name)
-        await self.database.execute(query)
+        await self._write(query)
+        self.identity_cache.members.set(key, account.name)
 
     async def update_bot_account_name(self):
         """自动检查 Bot 自身 nickname 是否变化，若变化则更新数据库"""
-        profile = await self.app.get_bot_profile()
-        query = AccountTable.update().values(name=profile.nickname) \
+        name = await self.get_bot_nickname()
+        if self.identity_cache.accounts.get(self.app.account) == name:
+            return
+        query = AccountTable.update().values(name=name) \
             .where(AccountTable.c.accountID == self.app.account) \
-            .where(AccountTable.c.name != profile.nickname)
-        await self.database.execute(query)
+            .where(AccountTable.c.name != name)
+        await self._write(query)
+        self.identity_cache.accounts.set(self.app.account, name)
 
     async def update_bot_member_name(self, group_id: int):
         """自动检查 Bot 自身所在 Group 中的 name 是否变化，若变化则更新数据库"""
-        group = await self.app.get_group(group_id)
-        if group is None:
+        name = await self.get_bot_member_name(group_id)
+        if name is None:
+            return
+        key = (self.app.account, group_id)
+        if self.identity_cache.members.get(key) == name:
             return
-        info = await self.app.get_member_profile(self.app.account, group)
-        name = info.nickname
         query = MemberTable.update().values(name=name) \
             .where(MemberTable.c.accountID == self.app.account) \
+            .where(MemberTable.c.groupID == group_id) \
             .where(MemberTable.c.name != name)
-        await self.database.execute(query)
+        await self._write(query)
+        self.identity_cache.members.set(key, name)
 
     async def add_group_message(self, message: GroupMessage):
         """往数据库中添加新 GroupMessage """
-        query = GroupMessageTable.insert().values(senderID=message.sender.id,
-                                                  groupID=message.sender.group.id,
-                                                  timestamp=message.source.time.timestamp(),
-                                                  context=message.message_chain.json())
-        await self.database.execute(query)
+        query = GroupMessageTable.insert()
+        values = dict(senderID=message.sender.id,
+                      groupID=message.sender.group.id,
+                      timestamp=message.source.time.timestamp(),
+                      context=message_codec.encode(message.message_chain),
+                      text=plain_text(message.message_chain))
+        await self._write(query, values)
+        self.summaries.record("group", message.sender.group.id, values["timestamp"], message.message_chain.display,
+                              incoming=True)
+        self._run_message_hooks(message.message_chain)
 
     async def add_friend_message(self, message: FriendMessage):
         """往数据库中添加新 FriendMessage """
-        query = FriendMessageTable.insert().values(senderID=message.sender.id,
-                                                   friendID=message.sender.id,
-                                                   timestamp=message.source.time.timestamp(),
-                                                   context=message.message_chain.json())
-        await self.database.execute(query)
+        query = FriendMessageTable.insert()
+        values = dict(senderID=message.sender.id,
+                      friendID=message.sender.id,
+                      timestamp=message.source.time.timestamp(),
+                      context=message_codec.encode(message.message_chain),
+                      text=plain_text(message.message_chain))
+        await self._write(query, values)
+        self.summaries.record("friend", message.sender.id, values["timestamp"], message.message_chain.display,
+                              incoming=True)
+        self._run_message_hooks(message.message_chain)
 
     async def add_bot_group_message(self, message: ActiveGroupMessage, group_id: int):
         """往数据库中添加 ActiveGroupMessage """
-        query = GroupMessageTable.insert().values(senderID=self.app.account,
-                                                  groupID=group_id,
-                                                  timestamp=time_module.time(),
-                                                  context=message.message_chain.json())
-        await self.database.execute(query)
+        query = GroupMessageTable.insert()
+        values = dict(senderID=self.app.account,
+                      groupID=group_id,
+                      timestamp=time_module.time(),
+                      context=message_codec.encode(message.message_chain),
+                      text=plain_text(message.message_chain))
+        await self._write(query, values)
+        self.summaries.record("group", group_id, values["timestamp"], message.message_chain.display,
+                              incoming=False)
 
     async def add_bot_friend_message(self, message: ActiveFriendMessage, friend_id: int):
         """往数据库中添加 ActiveFriendMessage """
-        query = FriendMessageTable.insert().values(senderID=self.app.account,
-                                                   friendID=friend_id,
-                                                   timestamp=time_module.time(),
-                                                   context=message.message_chain.json())
-        await self.database.execute(query)
+        query = FriendMessageTable.insert()
+        values = dict(senderID=self.app.account,
+                      friendID=friend_id,
+                      timestamp=time_module.time(),
+                      context=message_codec.encode(message.message_chain),
+                      text=plain_text(message.message_chain))
+        await self._write(query, values)
+        self.summaries.record("friend", friend_id, values["timestamp"], message.message_chain.display,
+                              incoming=False)
 
     async def add_sync_group_message(self, message: GroupSyncMessage):
         """往数据库中添加 GroupSyncMessage """
-        query = GroupMessageTable.insert().values(senderID=self.app.account,
-                                                  groupID=message.subject.id,
-                                                  timestamp=time_module.time(),
-                                                  context=message.message_chain.json())
-        await self.database.execute(query)
+        query = GroupMessageTable.insert()
+        values = dict(senderID=self.app.account,
+                      groupID=message.subject.id,
+                      timestamp=time_module.time(),
+                      context=message_codec.encode(message.message_chain),
+                      text=plain_text(message.message_chain))
+        await self._write(query, values)
+        self.summaries.record("group", message.subject.id, values["timestamp"], message.message_chain.display,
+                              incoming=False)
+        self._run_message_hooks(message.message_chain)
 
     async def add_sync_friend_message(self, message: FriendSyncMessage):
         """往数据库中添加 FriendSyncMessage """
-        query = FriendMessageTable.insert().values(senderID=self.app.account,
-                                                   friendID=message.subject.id,
-                                                   timestamp=time_module.time(),
-                                                   context=message.message_chain.json())
-        await self.database.execute(query)
+        query = FriendMessageTable.insert()
+        values = dict(senderID=self.app.account,
+                      friendID=message.subject.id,
+                      timestamp=time_module.time(),
+                      context=message_codec.encode(message.message_chain),
+                      text=plain_text(message.message_chain))
+        await self._write(query, values)
+        self.summaries.record("friend", message.subject.id, values["timestamp"], message.message_chain.display,
+                              incoming=False)
+        self._run_message_hooks(message.message_chain)
 
     async def get_group_name_by_id(self, group_id: int) -> str:
         """通过 groupID 获取群名"""
-        group = await self.app.get_group(group_id)
+        group = await contact_directory.get_group(group_id)
         name = group.name
         return name
 
@@ -231,61 +456,388 @@ class DataManager:
         """通过 accountID 和 groupID 获得成员名"""
         query = MemberTable.select().where(MemberTable.c.groupID == group_id).where(
             MemberTable.c.accountID == account_id)
-        result = await self.database.fetch_one(query)
+        result = await self.storage.fetch_one(query)
         name = result[3]
         return name
 
-    async def get_group_message(self, group: Group, limit: int = 60, page: int = 1) -> List[Optional[MessageContainer]]:
-        query = GroupMessageTable.select().limit(limit) \
-            .order_by(GroupMessageTable.c._id.desc()) \
-            .offset((page - 1) * limit) \
-            .where(GroupMessageTable.c.groupID == group.id)
-        result = await self.database.fetch_all(query)
+    async def get_sender_names(self, account_ids: Iterable[int], group_id: Optional[int] = None) -> Dict[int, str]:
+        """批量获取发送者名称，依次查询 member 表与 account 表，仍缺失的 id 才并发向远端请求"""
+        missing = set(account_ids)
+        names: Dict[int, str] = {}
+        if group_id is not None and missing:
+            query = select([MemberTable.c.accountID, MemberTable.c.name]) \
+                .where(MemberTable.c.groupID == group_id) \
+                .where(MemberTable.c.accountID.in_(missing))
+            names.update({account_id: name for account_id, name in await self.storage.fetch_all(query)})
+            missing -= names.keys()
+        if missing:
+            query = select([AccountTable.c.accountID, AccountTable.c.name]) \
+                .where(AccountTable.c.accountID.in_(missing))
+            names.update({account_id: name for account_id, name in await self.storage.fetch_all(query)})
+            missing -= names.keys()
+        if missing:
+            missing_ids = list(missing)
+            results = await asyncio.gather(*(self.get_account_name_by_id(i) for i in missing_ids))
+            names.update(zip(missing_ids, results))
+        return names
+
+    async def _fetch_message_page(self, kind: str, conversation: Column, conversation_id: int, limit: int,
+                                  page: int, before: Optional[int], after: Optional[int],
+                                  render_version: Optional[str]) -> List[Record]:
+        """按 _id 倒序取一页消息，给出 before / after 时使用游标分页，否则按页码偏移，超出主数据库的部分从归档中读取
+
+        每行末尾附带 render_version 版本的 HTML 片段，没有缓存或 render_version 为 None 时为 NULL
+        """
+        table = message_tables[kind]
+        if render_version is None:
+            query = select([table, null().label("html")])
+        else:
+            render = MessageRenderTable
+            query = select([table, render.c.html]).select_from(table.outerjoin(render, and_(
+                render.c.kind == kind, render.c.messageID == table.c._id, render.c.version == render_version)))
+        query = query.where(conversation == conversation_id).limit(limit)
+        archived = bool(self.archive.segments(kind, conversation_id))
+        if after is not None:
+            # 归档的消息 _id 较小，排在前面
+            rows = await self.archive.fetch_after(kind, conversation_id, after, limit) if archived else []
+            if len(rows) < limit:
+                query = query.where(table.c._id > after).order_by(table.c._id.asc()).limit(limit - len(rows))
+                rows.extend(await self.storage.fetch_all(query))
+            return list(reversed(rows))
+        if before is not None:
+            query = query.where(table.c._id < before).order_by(table.c._id.desc())
+        else:
+            query = query.order_by(table.c._id.desc()).offset((page - 1) * limit)
+        rows = await self.storage.fetch_all(query)
+        if len(rows) < limit and archived:
+            # 主数据库中的消息不足一页，剩余部分从归档中读取
+            offset = 0 if before is not None else \
+                max(0, (page - 1) * limit - await self._count_recent_messages(kind, conversation_id))
+            rows.extend(await self.archive.fetch_before(kind, conversation_id, before, offset, limit - len(rows)))
+        return rows
+
+    async def get_group_message(self, group: Group, limit: int = 60, page: int = 1,
+                                before: Optional[int] = None, after: Optional[int] = None,
+                                render_version: Optional[str] = None) -> List[Optional[MessageContainer]]:
+        result = await self._fetch_message_page("group", GroupMessageTable.c.groupID, group.id,
+                                                limit, page, before, after, render_version)
+        sender_names = await self.get_sender_names({i[1] for i in result}, group_id=group.id)
         message_list: List[Optional[MessageContainer]] = []
         for i in result:
             sender_id = i[1]
-            group_id = i[2]
-            try:
-                sender_name = await self.get_member_name_by_id(account_id=sender_id, group_id=group_id)
-            except UnknownTarget:
-                sender_name = await self.get_account_name_by_id(account_id=sender_id)
-            group_name = await self.get_group_name_by_id(group_id=group_id)
             timestamp = i[3]
             time = get_time_by_timestamp(timestamp)
-            message = MessageChain.parse_raw(i[4])
+            html = i["html"]
+            message = message_codec.decode(i["context"]) if html is None else None
             message_list.append(MessageContainer(time=time, timestamp=timestamp,
-                                                 message=message, sender_id=sender_id, sender_name=sender_name,
-                                                 group_id=group_id, group_name=group_name))
+                                                 message=message, sender_id=sender_id,
+                                                 sender_name=sender_names[sender_id],
+                                                 group_id=group.id, group_name=group.name, message_id=i[0],
+                                                 html=html))
         return message_list
 
-    async def get_friend_message(self, friend: Friend, limit: int = 60) -> List[Optional[MessageContainer]]:
-        query = FriendMessageTable.select().limit(limit) \
-            .order_by(FriendMessageTable.c._id.desc()) \
-            .where(FriendMessageTable.c.friendID == friend.id)
-        result = await self.database.fetch_all(query)
+    async def get_friend_message(self, friend: Friend, limit: int = 60, page: int = 1,
+                                 before: Optional[int] = None, after: Optional[int] = None,
+                                 render_version: Optional[str] = None) -> List[Optional[MessageContainer]]:
+        result = await self._fetch_message_page("friend", FriendMessageTable.c.friendID, friend.id,
+                                                limit, page, before, after, render_version)
+        sender_names = await self.get_sender_names({i[1] for i in result})
         message_list: List[Optional[MessageContainer]] = []
         for i in result:
             sender_id = i[1]
-            sender_name = await self.get_account_name_by_id(account_id=sender_id)
             timestamp = i[3]
             time_ = get_time_by_timestamp(timestamp)
-            message = MessageChain.parse_raw(i[4])
+            html = i["html"]
+            message = message_codec.decode(i["context"]) if html is None else None
             message_list.append(MessageContainer(time=time_, timestamp=timestamp,
-                                                 message=message, sender_id=sender_id, sender_name=sender_name,
-                                                 group_id=None, group_name=None))
+                                                 message=message, sender_id=sender_id,
+                                                 sender_name=sender_names[sender_id],
+                                                 group_id=None, group_name=None, message_id=i[0],
+                                                 html=html))
         return message_list
 
-    async def count_group_message(self, group_id: int) -> int:
-        query = "select COUNT(*) from GroupMessage where groupID = :group_id"
-        values = {"group_id": group_id}
-        result = await self.database.fetch_val(query, values)
+    async def iterate_messages(self, kind: str, conversation_id: int, batch_size: Optional[int] = None,
+                               render_version: Optional[str] = None) -> AsyncIterator[List[MessageContainer]]:
+        """按时间正序分批读取会话的全部消息（含归档），每批批量解析发送者名称，内存占用与会话大小无关
+
+        批次之间以 _id 为游标重新查询，导出期间不会一直占用读连接与 WAL 快照
+        """
+        batch_size = batch_size or export_batch_size
+        conversation = message_tables[kind].c[conversation_columns[kind]]
+        group_id = conversation_id if kind == "group" else None
+        sender_names: Dict[int, str] = {}  # 只随发送者人数增长
+        after = 0
+        while True:
+            rows = list(reversed(await self._fetch_message_page(kind, conversation, conversation_id, batch_size,
+                                                                1, None, after, render_version)))
+            if not rows:
+                return
+            missing = {i["senderID"] for i in rows} - sender_names.keys()
+            if missing:
+                sender_names.update(await self.get_sender_names(missing, group_id=group_id))
+            yield [MessageContainer(time=get_time_by_timestamp(i["timestamp"]), timestamp=i["timestamp"],
+                                    message=message_codec.decode(i["context"]) if i["html"] is None else None,
+                                    sender_id=i["senderID"], sender_name=sender_names[i["senderID"]],
+                                    group_id=group_id, group_name=None, message_id=i["_id"], html=i["html"])
+                   for i in rows]
+            if len(rows) < batch_size:
+                return
+            after = rows[-1]["_id"]
+
+    async def save_rendered_messages(self, kind: str, version: str, rendered: Dict[int, str]):
+        """保存消息 _id -> HTML 片段，已有旧版本时覆盖"""
+        query = insert(MessageRenderTable)
+        query = query.on_conflict_do_update(
+            index_elements=[MessageRenderTable.c.kind, MessageRenderTable.c.messageID],
+            set_={"version": query.excluded.version, "html": query.excluded.html})
+        values = [dict(kind=kind, messageID=message_id, version=version, html=html)
+                  for message_id, html in rendered.items()]
+        if self.writer is not None:
+            for i in values:
+                await self.writer.put(query, i)
+        else:
+            await self.storage.execute_many(query, values)
+
+    async def get_unrendered_messages(self, kind: str, version: str, after: int, limit: int
+                                      ) -> List[Tuple[int, Context]]:
+        """按 _id 顺序取出 _id 大于 after 且没有 version 版本 HTML 片段的消息，返回 (_id, context)"""
+        table = message_tables[kind]
+        render = MessageRenderTable
+        query = select([table.c._id, table.c.context]).select_from(table.outerjoin(render, and_(
+            render.c.kind == kind, render.c.messageID == table.c._id, render.c.version == version))) \
+            .where(and_(render.c._id.is_(None), table.c._id > after)).order_by(table.c._id).limit(limit)
+        return [(i[0], i[1]) for i in await self.storage.fetch_all(query)]
+
+    async def backfill_search(self, batch_size: Optional[int] = None) -> int:
+        """为升级前写入的消息补全纯文本，每批在单独的事务中完成，返回处理的条数"""
+        batch_size = batch_size or search_backfill_batch_size
+        total = 0
+        for kind, table in message_tables.items():
+            while True:
+                # text 为 NULL 的行有部分索引，补全后索引为空，查询代价很小
+                query = select([table.c._id, table.c.context]).where(table.c.text.is_(None)) \
+                    .order_by(table.c._id).limit(batch_size)
+                rows = await self.storage.fetch_all(query)
+                if not rows:
+                    break
+                values = [{"id": i[0], "text": plain_text(message_codec.decode(i[1]))} for i in rows]
+                async with self.storage.transaction() as connection:
+                    await connection.execute_many(f'UPDATE "{table.name}" SET text = :text WHERE _id = :id', values)
+                total += len(rows)
+                logger.info(f"已为 {total} 条消息补全纯文本（{kind} 至 _id {rows[-1][0]}）")
+        return total
+
+    async def load_message_dictionaries(self):
+        query = select([MessageDictionaryTable.c._id, MessageDictionaryTable.c.compression,
+                        MessageDictionaryTable.c.data])
+        message_codec.load_dictionaries((i[0], i[1], i[2]) for i in await self.storage.fetch_all(query))
+
+    async def train_message_dictionary(self, samples: Optional[int] = None, size: Optional[int] = None,
+                                       compression: Optional[str] = None) -> int:
+        """以最近的消息为样本训练字典，之后写入的消息以新字典压缩，返回字典的 _id
+
+        compression 为 None 时使用当前的压缩方式，尚未压缩时优先使用 zstd ，未安装 zstandard 时使用 zlib
+        """
+        samples = samples or message_dictionary_samples
+        size = size or message_dictionary_size
+        compression = compression or message_codec.compression.name or \
+            ("zstd" if compressions["zstd"].available else "zlib")
+        if not compressions[compression].available:
+            raise CodecUnavailable(f"未安装 {compression} 对应的库")
+        payloads: List[bytes] = []
+        for table in message_tables.values():
+            query = select([table.c.context]).order_by(table.c._id.desc()).limit(samples // len(message_tables))
+            rows = await self.storage.fetch_all(query)
+            payloads.extend(message_codec.serialize(message_codec.decode(i[0])) for i in reversed(rows))
+        if not payloads:
+            raise ValueError("数据库中没有消息，无法训练字典")
+        data = await asyncio.to_thread(train_dictionary, compression, payloads, size)
+        dictionary_id = await self.storage.execute(MessageDictionaryTable.insert(),
+                                                   dict(compression=compression, data=data))
+        await self.load_message_dictionaries()
+        return dictionary_id
+
+    async def reencode_messages(self, batch_size: Optional[int] = None) -> int:
+        """将不是当前编码格式的消息重新编码，每批在单独的事务中完成，返回重新编码的条数"""
+        batch_size = batch_size or message_reencode_batch_size
+        total = 0
+        for kind, table in message_tables.items():
+            after = 0
+            while True:
+                query = select([table.c._id, table.c.context]).where(table.c._id > after) \
+                    .order_by(table.c._id).limit(batch_size)
+                rows = await self.storage.fetch_all(query)
+                if not rows:
+                    break
+                after = rows[-1][0]
+                values = [{"id": i[0], "context": message_codec.encode(message_codec.decode(i[1]))}
+                          for i in rows if not message_codec.is_current(i[1])]
+                if values:
+                    async with self.storage.transaction() as connection:
+                        await connection.execute_many(
+                            f'UPDATE "{table.name}" SET context = :context WHERE _id = :id', values)
+                    total += len(values)
+                logger.info(f"已重新编码 {total} 条消息（{kind} 至 _id {after}）")
+        return total
+
+    @staticmethod
+    def retention_policy(kind: str, conversation_id: int) -> Tuple[Optional[float], Optional[int]]:
+        """会话的 (max_age, max_rows) ，未单独配置时使用全局策略"""
+        return retention_overrides.get(f"{kind}:{conversation_id}", (retention_max_age, retention_max_rows))
+
+    async def _run_retention_periodically(self):
+        while True:
+            try:
+                await self.run_retention()
+            except Exception as e:
+                logger.exception(f"归档消息出错：{e!r}")
+            await asyncio.sleep(retention_interval)
+
+    async def run_retention(self, batch_size: Optional[int] = None) -> int:
+        """按保留策略将各会话最旧的消息移入归档，每批在单独的事务中完成，返回移动的条数"""
+        batch_size = batch_size or retention_batch_size
+        total = 0
+        for kind in message_tables:
+            # 会话列表取自 ConversationSummary ，避免扫描消息表
+            query = select([ConversationSummaryTable.c.conversationID]).where(ConversationSummaryTable.c.kind == kind)
+            for (conversation_id,) in await self.storage.fetch_all(query):
+                max_age, max_rows = self.retention_policy(kind, conversation_id)
+                if max_age is None and max_rows is None:
+                    continue
+                while True:
+                    moved = await self._archive_batch(kind, conversation_id, max_age, max_rows, batch_size)
+                    total += moved
+                    if moved < batch_size:
+                        break
+                    await asyncio.sleep(0)  # 批次之间让出写连接
+        if total:
+            logger.info(f"已归档 {total} 条消息")
+        return total
+
+    async def _archive_batch(self, kind: str, conversation_id: int, max_age: Optional[float],
+                             max_rows: Optional[int], batch_size: int) -> int:
+        """移动会话中最旧的一批消息，只移动连续的前缀，保证归档消息的 _id 都小于主数据库中的消息
+
+        消息表没有 AUTOINCREMENT ，SQLite 以表中最大的 _id 加一作为新的 _id ，因此全表 _id 最大的一行始终保留，
+        否则新消息会重用已归档的 _id
+        """
+        table = message_tables[kind]
+        conversation = table.c[conversation_columns[kind]]
+        query = select([table]).where(conversation == conversation_id) \
+            .where(table.c._id < select([func.max(table.c._id)]).scalar_subquery()) \
+            .order_by(table.c._id).limit(batch_size)
+        rows = [dict(i) for i in await self.storage.fetch_all(query)]
+        count = 0
+        if max_age is not None:
+            cutoff = time_module.time() - max_age
+            while count < len(rows) and rows[count]["timestamp"] < cutoff:
+                count += 1
+        if max_rows is not None:
+            excess = await self._count_recent_messages(kind, conversation_id) - max_rows
+            count = max(count, min(excess, len(rows)))
+        if count <= 0:
+            return 0
+        rows = rows[:count]
+        partitions: Dict[str, List[dict]] = {}
+        for row in rows:
+            partitions.setdefault(self.archive.partition_of(row["timestamp"]), []).append(row)
+        # 先写入分区文件再从主数据库删除，中断时最多在两边各有一份，下次归档时覆盖
+        for partition, partition_rows in partitions.items():
+            await asyncio.to_thread(self.archive.write, partition, kind, partition_rows)
+        ids = [row["_id"] for row in rows]
+        archive_query = insert(MessageArchiveTable)
+        archive_query = archive_query.on_conflict_do_update(
+            index_elements=[MessageArchiveTable.c.kind, MessageArchiveTable.c.conversationID,
+                            MessageArchiveTable.c.partition],
+            set_=dict(rows=MessageArchiveTable.c.rows + archive_query.excluded.rows,
+                      minID=func.min(MessageArchiveTable.c.minID, archive_query.excluded.minID),
+                      maxID=func.max(MessageArchiveTable.c.maxID, archive_query.excluded.maxID)))
+        segments = [(partition, len(partition_rows), min(i["_id"] for i in partition_rows),
+                     max(i["_id"] for i in partition_rows)) for partition, partition_rows in partitions.items()]
+        async with self.storage.transaction() as connection:
+            await connection.execute(table.delete().where(table.c._id.in_(ids)))
+            await connection.execute(MessageRenderTable.delete().where(and_(
+                MessageRenderTable.c.kind == kind, MessageRenderTable.c.messageID.in_(ids))))
+            for partition, rows_count, min_id, max_id in segments:
+                await connection.execute(archive_query, dict(kind=kind, conversationID=conversation_id,
+                                                             partition=partition, rows=rows_count,
+                                                             minID=min_id, maxID=max_id))
+        for segment in segments:
+            self.archive.add_segment(kind, conversation_id, *segment)
+        self.message_count_generation += 1
+        counts = self.group_message_counts if kind == "group" else self.friend_message_counts
+        if conversation_id in counts:
+            counts[conversation_id] -= count
+        return count
+
+    async def search_messages(self, query: SearchQuery, limit: int = 30, page: int = 1) -> List[SearchResult]:
+        """全文搜索，多个关键词以空格分隔，需同时包含；结果多取一条，供调用方判断是否还有下一页"""
+        if not self.search_available or not query.keywords.split():
+            return []
+        sql, values = build_search(query, limit + 1, (page - 1) * limit)
+        rows = await self.storage.fetch_all(sql, values)
+        sender_names: Dict[int, str] = {}
+        for conversation_id in {i[1] for i in rows}:
+            ids = {i[2] for i in rows if i[1] == conversation_id}
+            names = await self.get_sender_names(ids, group_id=conversation_id if query.kind == "group" else None)
+            sender_names.update({(conversation_id, k): v for k, v in names.items()})
+        return [SearchResult(message_id=i[0], conversation_id=i[1], sender_id=i[2],
+                             sender_name=sender_names[(i[1], i[2])], timestamp=i[3],
+                             time=get_time_by_timestamp(i[3]), snippet=i[4] or "") for i in rows]
+
+    async def get_latest_message_id(self, kind: str, conversation_id: int) -> Optional[int]:
+        """会话中最新一条消息的 _id ，会话没有消息时返回 None"""
+        table = message_tables[kind]
+        conversation = table.c.groupID if kind == "group" else table.c.friendID
+        query = select([table.c._id]).where(conversation == conversation_id).order_by(table.c._id.desc()).limit(1)
+        return await self.storage.fetch_val(query)
+
+    async def get_message_page(self, kind: str, conversation_id: int, message_id: int, limit: int) -> int:
+        """消息在会话中按页码分页时所在的页"""
+        table = message_tables[kind]
+        conversation = table.c.groupID if kind == "group" else table.c.friendID
+        query = select([func.count()]).select_from(table) \
+            .where(conversation == conversation_id).where(table.c._id > message_id)
+        return await self.storage.fetch_val(query) // limit + 1
+
+    def _run_message_hooks(self, message_chain: MessageChain):
+        for hook in self.message_hooks:
+            try:
+                hook(message_chain)
+            except Exception as e:
+                logger.exception(f"消息钩子 {hook} 出错：{e!r}")
+
+    @staticmethod
+    def _increase_message_count(counts: Dict[int, int], conversation_id: int):
+        """仅在计数已初始化时递增，未初始化的会话在首次查询时 COUNT"""
+        if conversation_id in counts:
+            counts[conversation_id] += 1
+
+    def get_conversation_summary(self, kind: str, conversation_id: int) -> ConversationSummary:
+        """会话的最后活动时间与未读数，只读内存"""
+        return self.summaries.get(kind, conversation_id)
+
+    def mark_conversation_read(self, kind: str, conversation_id: int):
+        self.summaries.mark_read(kind, conversation_id)
+
+    async def _count_recent_messages(self, kind: str, conversation_id: int) -> int:
+        """主数据库中该会话的消息数，不含归档"""
+        counts = self.group_message_counts if kind == "group" else self.friend_message_counts
+        if conversation_id in counts:
+            return counts[conversation_id]
+        table = message_tables[kind]
+        query = f'select COUNT(*) from "{table.name}" where {conversation_columns[kind]} = :conversation_id'
+        generation = self.message_count_generation
+        result = await self.storage.fetch_val(query, {"conversation_id": conversation_id})
+        if self.message_count_generation == generation:
+            counts[conversation_id] = result
         return result
 
+    async def count_group_message(self, group_id: int) -> int:
+        return await self._count_recent_messages("group", group_id) + self.archive.count("group", group_id)
+
     async def count_friend_message(self, friend_id: int) -> int:
-        query = "select COUNT(*) from FriendMessage where friendID = :friend_id"
-        values = {"friend_id": friend_id}
-        result = await self.database.fetch_val(query, values)
-        return result
+        return await self._count_recent_messages("friend", friend_id) + self.archive.count("friend", friend_id)
 
 
 data_manager = DataManager()
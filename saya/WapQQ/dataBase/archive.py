@@ -0,0 +1,172 @@
+import asyncio
+import re
+import sqlite3
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from time import localtime, strftime
+from typing import Dict, List, Optional, Tuple
+
+from databases.core import Connection
+from databases.interfaces import Record
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateTable
+
+from .storage import Storage
+from .tables import MessageArchiveTable, message_tables, conversation_columns
+
+ConversationKey = Tuple[str, int]  # (kind, conversationID)
+
+
+@dataclass
+class ArchiveSegment:
+    """一个会话在一个分区中的消息，同一会话各分区的 _id 范围互不重叠"""
+    partition: str
+    rows: int
+    min_id: int
+    max_id: int
+
+
+class ArchiveStore:
+    """冷消息按时间分区保存在独立的数据库文件中，读取时按需 ATTACH 到专用的只读连接上
+
+    分区文件中的表结构与主数据库的消息表相同，并保留原来的 _id ；
+    各会话在每个分区中的条数与 _id 范围记录在主数据库的 MessageArchive 表中，翻页时据此跳过整个分区
+    """
+
+    def __init__(self, path: Path, partition_format: str, max_attached: int):
+        self.path = path
+        self.partition_format = partition_format
+        self.max_attached = max_attached
+        self.storage: Optional[Storage] = None
+        self._segments: Dict[ConversationKey, List[ArchiveSegment]] = {}  # 按 _id 倒序
+        self._connection: Optional[Connection] = None
+        self._attached: "OrderedDict[str, str]" = OrderedDict()  # 分区 -> schema 名，按最近使用排序
+        self._lock = asyncio.Lock()
+
+    async def open(self, storage: Storage):
+        self.storage = storage
+        self._segments.clear()
+        query = MessageArchiveTable.select()
+        for row in await storage.fetch_all(query):
+            self.add_segment(row["kind"], row["conversationID"], row["partition"], row["rows"],
+                             row["minID"], row["maxID"])
+
+    async def close(self):
+        async with self._lock:
+            if self._connection is not None:
+                await self._connection.__aexit__()
+                self._connection = None
+            self._attached.clear()
+
+    def partition_of(self, timestamp: float) -> str:
+        return strftime(self.partition_format, localtime(timestamp))
+
+    def partition_path(self, partition: str) -> Path:
+        return self.path.joinpath(f"{partition}.db")
+
+    def segments(self, kind: str, conversation_id: int) -> List[ArchiveSegment]:
+        return self._segments.get((kind, conversation_id), [])
+
+    def count(self, kind: str, conversation_id: int) -> int:
+        return sum(segment.rows for segment in self.segments(kind, conversation_id))
+
+    def is_archived(self, kind: str, conversation_id: int, message_id: int) -> bool:
+        """归档的总是会话中 _id 最小的一段，只需与已归档的最大 _id 比较"""
+        segments = self.segments(kind, conversation_id)
+        return bool(segments) and message_id <= segments[0].max_id
+
+    def add_segment(self, kind: str, conversation_id: int, partition: str, rows: int, min_id: int, max_id: int):
+        """记录新归档的消息，与已有的同一分区合并"""
+        segments = self._segments.setdefault((kind, conversation_id), [])
+        for segment in segments:
+            if segment.partition == partition:
+                segment.rows += rows
+                segment.min_id = min(segment.min_id, min_id)
+                segment.max_id = max(segment.max_id, max_id)
+                break
+        else:
+            segments.append(ArchiveSegment(partition=partition, rows=rows, min_id=min_id, max_id=max_id))
+        segments.sort(key=lambda segment: segment.max_id, reverse=True)
+
+    def write(self, partition: str, kind: str, rows: List[dict]):
+        """将消息写入分区文件，在线程中执行；_id 已存在时覆盖，中断后重新归档不会产生重复"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        table = message_tables[kind]
+        conversation = conversation_columns[kind]
+        connection = sqlite3.connect(self.partition_path(partition))
+        try:
+            exists = connection.execute("SELECT count(*) FROM sqlite_master WHERE name = ?", (table.name,)).fetchone()
+            if not exists[0]:
+                connection.execute(str(CreateTable(table).compile(dialect=sqlite.dialect())))
+                connection.execute(f'CREATE INDEX "ix_{table.name}_{conversation}__id" '
+                                   f'ON "{table.name}" ({conversation}, _id DESC)')
+            columns = list(rows[0].keys())
+            connection.executemany(
+                f'INSERT OR REPLACE INTO "{table.name}" ({", ".join(columns)}) '
+                f'VALUES ({", ".join("?" * len(columns))})',
+                [tuple(row[column] for column in columns) for row in rows])
+            connection.commit()
+        finally:
+            connection.close()
+
+    async def _attach(self, partition: str) -> str:
+        """确保分区已 ATTACH ，返回 schema 名；超过上限时 DETACH 最久未使用的分区，调用方需持有锁"""
+        if self._connection is None:
+            self._connection = await self.storage.open_reader()
+        schema = self._attached.get(partition)
+        if schema is not None:
+            self._attached.move_to_end(partition)
+            return schema
+        while len(self._attached) >= self.max_attached:
+            _, detached = self._attached.popitem(last=False)
+            await self._connection.execute(f'DETACH DATABASE "{detached}"')
+        schema = "archive_" + re.sub(r"\W", "_", partition)
+        await self._connection.execute(f'ATTACH DATABASE :path AS "{schema}"',
+                                       {"path": str(self.partition_path(partition))})
+        self._attached[partition] = schema
+        return schema
+
+    async def _fetch(self, kind: str, conversation_id: int, partition: str, condition: str, values: dict,
+                     descending: bool, limit: int, offset: int = 0) -> List[Record]:
+        table = message_tables[kind]
+        conversation = conversation_columns[kind]
+        async with self._lock:
+            schema = await self._attach(partition)
+            # 与主数据库的查询返回相同的列，归档的消息没有缓存的 HTML 片段
+            query = f'SELECT _id, senderID, {conversation}, timestamp, context, text, NULL AS html ' \
+                    f'FROM "{schema}"."{table.name}" WHERE {conversation} = :conversation_id {condition} ' \
+                    f'ORDER BY _id {"DESC" if descending else "ASC"} LIMIT :limit OFFSET :offset'
+            return await self._connection.fetch_all(query, {**values, "conversation_id": conversation_id,
+                                                            "limit": limit, "offset": offset})
+
+    async def fetch_before(self, kind: str, conversation_id: int, before: Optional[int], offset: int,
+                           limit: int) -> List[Record]:
+        """按 _id 倒序读取消息，给出 before 时读取 _id 小于 before 的消息，否则跳过前 offset 条"""
+        result: List[Record] = []
+        for segment in self.segments(kind, conversation_id):
+            if len(result) >= limit:
+                break
+            if before is not None and segment.min_id >= before:
+                continue
+            if before is None and offset >= segment.rows:
+                offset -= segment.rows
+                continue
+            condition, values = ("AND _id < :before", {"before": before}) if before is not None else ("", {})
+            rows = await self._fetch(kind, conversation_id, segment.partition, condition, values,
+                                     descending=True, limit=limit - len(result), offset=offset)
+            offset = 0
+            result.extend(rows)
+        return result
+
+    async def fetch_after(self, kind: str, conversation_id: int, after: int, limit: int) -> List[Record]:
+        """按 _id 正序读取 _id 大于 after 的消息"""
+        result: List[Record] = []
+        for segment in reversed(self.segments(kind, conversation_id)):
+            if len(result) >= limit:
+                break
+            if segment.max_id <= after:
+                continue
+            result.extend(await self._fetch(kind, conversation_id, segment.partition, "AND _id > :after",
+                                            {"after": after}, descending=False, limit=limit - len(result)))
+        return result
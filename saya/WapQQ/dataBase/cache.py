@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+MISSING = object()
+
+
+@dataclass
+class CacheStats:
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    evictions: int
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class LRUCache:
+    """带过期时间的 LRU 缓存，ttl 为 None 时不过期"""
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Any:
+        """命中时返回缓存值，未命中或已过期时返回 MISSING"""
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return MISSING
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> CacheStats:
+        return CacheStats(size=len(self._data), max_size=self.max_size,
+                          hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+class IdentityCache:
+    """缓存数据库中已存在的 Group / Account / Member 及其最近一次见到的名称"""
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.groups = LRUCache(max_size, ttl)  # groupID -> name
+        self.accounts = LRUCache(max_size, ttl)  # accountID -> name
+        self.members = LRUCache(max_size, ttl)  # (accountID, groupID) -> name
+
+    def clear(self):
+        self.groups.clear()
+        self.accounts.clear()
+        self.members.clear()
+
+    def stats(self) -> Dict[str, CacheStats]:
+        return {"group": self.groups.stats(), "account": self.accounts.stats(), "member": self.members.stats()}
@@ -0,0 +1,200 @@
+import json
+import struct
+import zlib
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from graia.ariadne.message.chain import MessageChain
+from loguru import logger
+
+from .config import message_serializer, message_compression, message_compression_level
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 二进制格式的头部：序列化方式、压缩方式、压缩字典的 MessageDictionary._id （不使用字典时为 0）
+HEADER = struct.Struct("<BBH")
+ZLIB_WBITS = -15  # raw deflate ，省去 zlib 的头部与校验和
+ZLIB_MAX_DICTIONARY = 32768  # deflate 的窗口大小，更长的字典没有意义
+
+Context = Union[str, bytes]  # 消息表 context 列中的值
+
+
+class CodecUnavailable(Exception):
+    """数据使用的编码需要未安装的库"""
+
+
+@dataclass
+class Serializer:
+    tag: int
+    name: str
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[bytes], Any]
+    available: bool = True
+
+
+@dataclass
+class Compression:
+    tag: int
+    name: Optional[str]
+    available: bool = True
+
+
+serializers: Dict[str, Serializer] = {
+    "json": Serializer(1, "json", lambda obj: json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode(),
+                       lambda data: json.loads(data.decode())),
+    "msgpack": Serializer(2, "msgpack", lambda obj: msgpack.packb(obj, use_bin_type=True),
+                          lambda data: msgpack.unpackb(data, raw=False), available=msgpack is not None),
+    "cbor": Serializer(3, "cbor", lambda obj: cbor2.dumps(obj), lambda data: cbor2.loads(data),
+                       available=cbor2 is not None),
+}
+compressions: Dict[Optional[str], Compression] = {
+    None: Compression(0, None),
+    "zlib": Compression(1, "zlib"),
+    "zstd": Compression(2, "zstd", available=zstandard is not None),
+}
+serializer_by_tag = {serializer.tag: serializer for serializer in serializers.values()}
+compression_by_tag = {compression.tag: compression for compression in compressions.values()}
+
+
+def chain_to_obj(chain: MessageChain) -> List[dict]:
+    """与 MessageChain.json() 相同的结构，datetime 等字段已转换为 JSON 中的值，省略值为 None 的字段"""
+    return json.loads(chain.json(exclude_none=True))
+
+
+def train_dictionary(compression: str, samples: List[bytes], size: int) -> bytes:
+    """由已序列化的消息训练压缩字典；zlib 没有训练算法，取最近的样本拼接，越靠后的内容引用距离越短"""
+    if compression == "zstd":
+        if zstandard is None:
+            raise CodecUnavailable("训练 zstd 字典需要安装 zstandard")
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    size = min(size, ZLIB_MAX_DICTIONARY)
+    chunks = []
+    total = 0
+    for sample in reversed(samples):
+        if total + len(sample) > size:
+            break
+        chunks.append(sample)
+        total += len(sample)
+    return b"".join(reversed(chunks))
+
+
+class MessageCodec:
+    """消息链与 context 列之间的编解码，旧版写入的 JSON 文本始终可读，新写入的消息使用配置的格式"""
+
+    def __init__(self, serializer: str, compression: Optional[str], level: int):
+        self.serializer = serializers[serializer]
+        self.configured_compression = compressions[compression]
+        self.level = level
+        if not self.serializer.available:
+            logger.warning(f"未安装 {serializer} 对应的库，消息将以 json 格式存储")
+            self.serializer = serializers["json"]
+        if not self.configured_compression.available:
+            logger.warning(f"未安装 {compression} 对应的库，消息将以 zlib 压缩")
+            self.configured_compression = compressions["zlib"]
+        self.compression = self.configured_compression  # 新消息实际使用的压缩方式
+        self.dictionaries: Dict[int, Tuple[Compression, bytes]] = {}
+        self.dictionary_id = 0  # 压缩新消息时使用的字典，0 表示不使用
+        self._zlib_compressor = None
+        self._zstd_compressor = None
+        self._zstd_decompressors: Dict[int, Any] = {}
+        self.load_dictionaries([])
+
+    def load_dictionaries(self, rows: Iterable[Tuple[int, str, bytes]]):
+        """载入 MessageDictionary 表中的字典，新消息使用与配置的压缩方式一致的最新字典；
+
+        未配置压缩方式时，有可用的字典才压缩，使用最新字典的压缩方式
+        """
+        self.dictionaries.clear()
+        self._zstd_decompressors.clear()
+        self.dictionary_id = 0
+        for dictionary_id, compression, data in rows:
+            self.dictionaries[dictionary_id] = (compressions[compression], data)
+            if compressions[compression].available and self.configured_compression.name in (None, compression):
+                self.dictionary_id = max(self.dictionary_id, dictionary_id)
+        if self.dictionary_id:
+            self.compression = self.dictionaries[self.dictionary_id][0]
+        else:
+            self.compression = self.configured_compression
+        self._zlib_compressor = self._zstd_compressor = None
+        if self.compression.name == "zlib":
+            # 预先载入字典，每条消息复制一份压缩状态，比每次重新设置字典快
+            options = dict(zdict=self.dictionaries[self.dictionary_id][1]) if self.dictionary_id else {}
+            self._zlib_compressor = zlib.compressobj(self.level, zlib.DEFLATED, ZLIB_WBITS, **options)
+        elif self.compression.name == "zstd":
+            self._zstd_compressor = zstandard.ZstdCompressor(level=self.level,
+                                                             dict_data=self._zstd_dictionary(self.dictionary_id))
+
+    def _zstd_dictionary(self, dictionary_id: int):
+        if not dictionary_id:
+            return None
+        return zstandard.ZstdCompressionDict(self.dictionaries[dictionary_id][1])
+
+    def _dictionary(self, dictionary_id: int) -> bytes:
+        try:
+            return self.dictionaries[dictionary_id][1]
+        except KeyError:
+            raise CodecUnavailable(f"找不到编号为 {dictionary_id} 的压缩字典") from None
+
+    def serialize(self, chain: MessageChain) -> bytes:
+        """只序列化不压缩，用作训练字典的样本"""
+        return self.serializer.dumps(chain_to_obj(chain))
+
+    def encode(self, chain: MessageChain) -> bytes:
+        payload = self.serialize(chain)
+        dictionary_id = self.dictionary_id
+        if self._zlib_compressor is not None:
+            compressor = self._zlib_compressor.copy()
+            payload = compressor.compress(payload) + compressor.flush()
+        elif self._zstd_compressor is not None:
+            payload = self._zstd_compressor.compress(payload)
+        return HEADER.pack(self.serializer.tag, self.compression.tag, dictionary_id) + payload
+
+    def decode(self, context: Context) -> MessageChain:
+        return MessageChain.parse_obj(self.decode_obj(context))
+
+    def decode_obj(self, context: Context) -> List[dict]:
+        if isinstance(context, str):
+            return json.loads(context)  # 旧版的 MessageChain.json()
+        serializer_tag, compression_tag, dictionary_id = HEADER.unpack_from(context)
+        serializer = serializer_by_tag[serializer_tag]
+        compression = compression_by_tag[compression_tag]
+        if not serializer.available or not compression.available:
+            raise CodecUnavailable(f"解码该消息需要安装 {serializer.name} 与 {compression.name} 对应的库")
+        payload = context[HEADER.size:]
+        if compression.name == "zlib":
+            if dictionary_id:
+                decompressor = zlib.decompressobj(ZLIB_WBITS, zdict=self._dictionary(dictionary_id))
+            else:
+                decompressor = zlib.decompressobj(ZLIB_WBITS)
+            payload = decompressor.decompress(payload) + decompressor.flush()
+        elif compression.name == "zstd":
+            decompressor = self._zstd_decompressors.get(dictionary_id)
+            if decompressor is None:
+                if dictionary_id:
+                    self._dictionary(dictionary_id)
+                decompressor = zstandard.ZstdDecompressor(dict_data=self._zstd_dictionary(dictionary_id))
+                self._zstd_decompressors[dictionary_id] = decompressor
+            payload = decompressor.decompress(payload)
+        return serializer.loads(payload)
+
+    def is_current(self, context: Context) -> bool:
+        """是否已是当前配置的格式，重新编码时跳过"""
+        if isinstance(context, str):
+            return False
+        return HEADER.unpack_from(context) == (self.serializer.tag, self.compression.tag, self.dictionary_id)
+
+
+message_codec = MessageCodec(message_serializer, message_compression, message_compression_level)
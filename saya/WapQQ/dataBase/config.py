@@ -0,0 +1,47 @@
+# 写缓冲（write-behind）：开启后消息与名称更新先进入队列，再按批次在同一事务内写入
+write_behind = False
+write_behind_batch_size = 200  # 队列中积累到该条数时立即写入
+write_behind_flush_interval = 0.5  # 单位：秒，距第一条待写入数据超过该时间时写入
+write_behind_queue_size = 10000  # 队列上限，满时写入方会等待（背压）
+
+# 身份缓存：缓存已存在的 Group / Account / Member 及名称，避免每条消息都查询数据库
+identity_cache_size = 20000  # 每类缓存的最大条目数
+identity_cache_ttl = 600  # 单位：秒，超时后重新向数据库确认；设为 None 则不过期
+profile_cache_ttl = 600  # 单位：秒，Bot 自身资料的缓存时间，发送消息时不再重复请求
+
+# 存储参数，见 https://www.sqlite.org/pragma.html
+journal_mode = "WAL"  # WAL 模式下读取与写入互不阻塞
+synchronous = "NORMAL"  # WAL 模式下使用 NORMAL 不会损坏数据库，仅可能在断电时丢失最后几个事务
+cache_size = -65536  # 每个连接的页缓存，负数时单位为 KiB
+mmap_size = 268435456  # 单位：字节
+temp_store = "MEMORY"
+busy_timeout = 5000  # 单位：毫秒
+reader_count = 4  # 供网页读取使用的只读连接数
+
+# 全文搜索：消息的纯文本写入 text 列，由 FTS5 索引；升级前的消息需要补全纯文本后才能被搜索到
+search_backfill_on_startup = True  # 启动后在后台补全，也可执行 python manage.py backfill-search
+search_backfill_batch_size = 500  # 每个事务处理的消息数
+
+# 会话摘要：主页按最近活动排序并显示未读数，数据常驻内存，定期写入数据库
+summary_flush_interval = 5  # 单位：秒
+summary_preview_length = 40  # 主页显示的最后一条消息的最大字数
+
+# 消息编码：context 列的存储格式，旧版写入的 JSON 文本始终可读，可执行 python manage.py reencode-messages 转换
+message_serializer = "json"  # "json" / "msgpack"（需安装 msgpack） / "cbor"（需安装 cbor2）
+message_compression = None  # None 时训练字典后才压缩 / "zlib" / "zstd"（需安装 zstandard）时始终压缩
+message_compression_level = 6  # zlib 为 0-9 ，zstd 为 1-22
+message_dictionary_size = 32768  # 单位：字节，python manage.py train-message-dictionary 训练的字典大小，zlib 最多使用 32KB
+message_dictionary_samples = 5000  # 训练字典时取最近的消息数
+message_reencode_batch_size = 500  # python manage.py reencode-messages 每个事务处理的消息数
+
+# 保留策略：超出的旧消息移入 archive 目录下按时间分区的数据库，网页中仍可翻页查看，但不再能被全文搜索
+retention = False  # 开启后在后台定期执行，也可执行 python manage.py archive-messages
+retention_max_age = 180 * 24 * 3600  # 单位：秒，早于该时间的消息被归档；None 表示不限
+retention_max_rows = None  # 每个会话在主数据库中保留的最大消息数；None 表示不限
+retention_overrides = {}  # 按会话覆盖，如 {"group:123456": (None, 10000)} ，值为 (max_age, max_rows)
+retention_interval = 3600  # 单位：秒，后台执行的间隔
+retention_batch_size = 1000  # 每个事务移动的消息数
+archive_partition_format = "%Y-%m"  # 分区文件名，以 time.strftime 格式化消息时间，"%Y" 为按年分区
+archive_max_attached = 8  # 同时 ATTACH 的分区数，SQLite 默认最多 10 个
+
+export_batch_size = 500  # 导出聊天记录时每次查询的消息数
@@ -0,0 +1,71 @@
+from typing import Awaitable, Callable, List
+
+from databases.core import Connection
+from loguru import logger
+
+from .storage import Storage
+
+Migration = Callable[[Connection], Awaitable[None]]
+
+# 按顺序排列，第 n 个迁移执行完成后数据库的 user_version 为 n ，已发布的迁移不可修改或调换顺序
+migrations: List[Migration] = []
+
+
+def migration(func: Migration) -> Migration:
+    """注册一个数据库结构迁移"""
+    migrations.append(func)
+    return func
+
+
+async def migrate(storage: Storage):
+    """应在建表之后调用，依次执行尚未执行的迁移，每个迁移在单独的事务中完成"""
+    async with storage.transaction() as connection:
+        version = await connection.fetch_val("PRAGMA user_version")
+    for target, func in enumerate(migrations[version:], start=version + 1):
+        logger.info(f"正在将数据库结构升级至版本 {target}：{func.__doc__}")
+        async with storage.transaction() as connection:
+            await func(connection)
+            await connection.execute(f"PRAGMA user_version = {target}")
+
+
+@migration
+async def add_indexes_and_unique_keys(connection: Connection):
+    """为消息表添加索引，为 account / member / group 去重并添加唯一约束"""
+    # 去重时保留 _id 最大，即最后写入的一行
+    await connection.execute(
+        "DELETE FROM account WHERE _id NOT IN (SELECT MAX(_id) FROM account GROUP BY accountID)")
+    await connection.execute(
+        "DELETE FROM member WHERE _id NOT IN (SELECT MAX(_id) FROM member GROUP BY accountID, groupID)")
+    await connection.execute(
+        'DELETE FROM "group" WHERE _id NOT IN (SELECT MAX(_id) FROM "group" GROUP BY groupID)')
+    # 索引名需与 tables.py 中的声明一致，新建的数据库已由 create_all 创建
+    await connection.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "ix_account_accountID" ON account (accountID)')
+    await connection.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "ix_member_accountID_groupID" ON member (accountID, groupID)')
+    await connection.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "ix_group_groupID" ON "group" (groupID)')
+    await connection.execute(
+        'CREATE INDEX IF NOT EXISTS "ix_GroupMessage_groupID__id" ON "GroupMessage" (groupID, _id DESC)')
+    await connection.execute(
+        'CREATE INDEX IF NOT EXISTS "ix_FriendMessage_friendID__id" ON "FriendMessage" (friendID, _id DESC)')
+
+
+@migration
+async def add_message_text(connection: Connection):
+    """为消息表添加纯文本列，供全文搜索使用，已有消息的纯文本由 backfill_search 补全"""
+    for table in ("GroupMessage", "FriendMessage"):
+        columns = [row[1] for row in await connection.fetch_all(f'PRAGMA table_info("{table}")')]
+        if "text" not in columns:
+            await connection.execute(f'ALTER TABLE "{table}" ADD COLUMN text VARCHAR')
+        await connection.execute(
+            f'CREATE INDEX IF NOT EXISTS "ix_{table}_text_null" ON "{table}" (_id) WHERE text IS NULL')
+
+
+@migration
+async def add_conversation_summary(connection: Connection):
+    """由已有消息生成各会话的最后活动时间，ConversationSummary 表已由 create_all 创建"""
+    for kind, table, conversation in (("group", "GroupMessage", "groupID"), ("friend", "FriendMessage", "friendID")):
+        await connection.execute(
+            f"INSERT OR IGNORE INTO ConversationSummary (kind, conversationID, lastTimestamp, unread, preview) "
+            f"SELECT '{kind}', {conversation}, MAX(timestamp), 0, '' FROM {table} GROUP BY {conversation}")
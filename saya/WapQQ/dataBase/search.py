@@ -0,0 +1,119 @@
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from databases.core import Connection
+from graia.ariadne.message.chain import MessageChain
+from graia.ariadne.message.element import Plain
+from loguru import logger
+
+HIGHLIGHT_START = "\x02"  # snippet 中命中部分的起止标记，由网页转义后替换为 <mark>
+HIGHLIGHT_END = "\x03"
+TRIGRAM_LENGTH = 3  # trigram 分词器只能用索引匹配不短于 3 个字符的词
+
+
+@dataclass
+class SearchQuery:
+    kind: str  # "group" 或 "friend"
+    keywords: str
+    conversation_id: Optional[int] = None
+    sender_id: Optional[int] = None
+    since: Optional[float] = None  # 时间戳，包含
+    until: Optional[float] = None  # 时间戳，不包含
+
+
+@dataclass
+class SearchResult:
+    message_id: int
+    conversation_id: int
+    sender_id: int
+    sender_name: str
+    timestamp: float
+    time: str
+    snippet: str
+
+
+def plain_text(message_chain: MessageChain) -> str:
+    """消息的纯文本投影，即所有 Plain 元素的文本"""
+    return "".join(i.text for i in message_chain.get(Plain))
+
+
+def search_table(kind: str) -> str:
+    return "GroupMessageSearch" if kind == "group" else "FriendMessageSearch"
+
+
+async def create_search_tables(connection: Connection) -> bool:
+    """创建 FTS5 索引表与同步触发器，SQLite 不支持 FTS5 或 trigram 分词器时返回 False
+
+    索引表以消息表的 text 列为外部内容（external content），不重复保存文本；
+    每次启动都会执行，SQLite 升级后也能补建索引
+    """
+    try:
+        await connection.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(text, tokenize='trigram')")
+        await connection.execute("DROP TABLE temp.fts5_probe")
+    except Exception as e:
+        logger.warning(f"当前 SQLite 不支持 FTS5 trigram 分词器，全文搜索不可用：{e}")
+        return False
+    for table, conversation in (("GroupMessage", "groupID"), ("FriendMessage", "friendID")):
+        index = search_table("group" if table == "GroupMessage" else "friend")
+        exists = await connection.fetch_val("SELECT count(*) FROM sqlite_master WHERE name = :name",
+                                            {"name": index})
+        if exists:
+            continue
+        await connection.execute(f'CREATE VIRTUAL TABLE "{index}" USING fts5('
+                                 f"text, content='{table}', content_rowid='_id', tokenize='trigram')")
+        # 空字符串表示消息没有文字，不写入索引
+        await connection.execute(
+            f'CREATE TRIGGER IF NOT EXISTS "{table}_search_insert" AFTER INSERT ON "{table}" '
+            f'WHEN new.text != \'\' BEGIN '
+            f'INSERT INTO "{index}"(rowid, text) VALUES (new._id, new.text); END')
+        await connection.execute(
+            f'CREATE TRIGGER IF NOT EXISTS "{table}_search_delete" AFTER DELETE ON "{table}" '
+            f'WHEN old.text != \'\' BEGIN '
+            f'INSERT INTO "{index}"("{index}", rowid, text) VALUES (\'delete\', old._id, old.text); END')
+        await connection.execute(
+            f'CREATE TRIGGER IF NOT EXISTS "{table}_search_update" AFTER UPDATE OF text ON "{table}" BEGIN '
+            f'INSERT INTO "{index}"("{index}", rowid, text) SELECT \'delete\', old._id, old.text '
+            f'WHERE old.text != \'\'; '
+            f'INSERT INTO "{index}"(rowid, text) SELECT new._id, new.text WHERE new.text != \'\'; END')
+        # 新建索引时已有的 text 不在索引中，从消息表重建一次
+        await connection.execute(f'INSERT INTO "{index}"("{index}") VALUES (\'rebuild\')')
+    return True
+
+
+def build_search(query: SearchQuery, limit: int, offset: int) -> Tuple[str, Dict[str, object]]:
+    """生成搜索语句，结果按相关度排序，没有可用索引的短词时按时间倒序"""
+    table = "GroupMessage" if query.kind == "group" else "FriendMessage"
+    conversation = "groupID" if query.kind == "group" else "friendID"
+    index = search_table(query.kind)
+    words = query.keywords.split()
+    long_words = [i for i in words if len(i) >= TRIGRAM_LENGTH]
+    short_words = [i for i in words if len(i) < TRIGRAM_LENGTH]
+    values: Dict[str, object] = {"limit": limit, "offset": offset}
+    conditions: List[str] = []
+    for number, word in enumerate(short_words):
+        conditions.append(f"m.text LIKE :like{number} ESCAPE '\\'")
+        values[f"like{number}"] = "%" + re.sub(r"([%_\\])", r"\\\1", word) + "%"
+    for column, key in ((conversation, "conversation_id"), ("senderID", "sender_id")):
+        if getattr(query, key) is not None:
+            conditions.append(f"m.{column} = :{key}")
+            values[key] = getattr(query, key)
+    if query.since is not None:
+        conditions.append("m.timestamp >= :since")
+        values["since"] = query.since
+    if query.until is not None:
+        conditions.append("m.timestamp < :until")
+        values["until"] = query.until
+    if long_words:
+        # 每个词作为短语匹配，双引号需写两次
+        values["match"] = " AND ".join('"' + i.replace('"', '""') + '"' for i in long_words)
+        conditions.insert(0, f'"{index}" MATCH :match')
+        sql = (f'SELECT m._id, m.{conversation}, m.senderID, m.timestamp, '
+               f'snippet("{index}", 0, \'{HIGHLIGHT_START}\', \'{HIGHLIGHT_END}\', \'…\', 24) '
+               f'FROM "{index}" JOIN "{table}" m ON m._id = "{index}".rowid '
+               f'WHERE {" AND ".join(conditions)} ORDER BY rank LIMIT :limit OFFSET :offset')
+    else:
+        sql = (f'SELECT m._id, m.{conversation}, m.senderID, m.timestamp, substr(m.text, 1, 64) '
+               f'FROM "{table}" m WHERE {" AND ".join(conditions)} '
+               f'ORDER BY m._id DESC LIMIT :limit OFFSET :offset')
+    return sql, values
@@ -0,0 +1,114 @@
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncGenerator, AsyncIterator, List, Optional, Union
+
+from databases import core
+from databases.core import Connection
+from databases.interfaces import Record
+from sqlalchemy.sql import ClauseElement
+
+Query = Union[ClauseElement, str]
+
+
+@dataclass
+class StorageProfile:
+    """SQLite 连接参数，见 https://www.sqlite.org/pragma.html"""
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    cache_size: int = -65536  # 负数时单位为 KiB
+    mmap_size: int = 268435456
+    temp_store: str = "MEMORY"
+    busy_timeout: int = 5000  # 单位：毫秒
+    reader_count: int = 4
+
+    def pragmas(self) -> List[str]:
+        return [f"PRAGMA synchronous = {self.synchronous}",
+                f"PRAGMA cache_size = {self.cache_size}",
+                f"PRAGMA mmap_size = {self.mmap_size}",
+                f"PRAGMA temp_store = {self.temp_store}",
+                f"PRAGMA busy_timeout = {self.busy_timeout}"]
+
+
+class Storage:
+    """持有一个写连接与若干读连接，开启 WAL 后网页的读取不会被 bot 的写入阻塞"""
+
+    def __init__(self, database: core.Database, profile: StorageProfile):
+        self.database = database
+        self.profile = profile
+        self.writer: Optional[Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: "asyncio.Queue[Connection]" = asyncio.Queue()
+        self._reader_list: List[Connection] = []
+
+    async def open(self):
+        self.writer = await self._open_connection()
+        await self.writer.execute(f"PRAGMA journal_mode = {self.profile.journal_mode}")
+        for _ in range(self.profile.reader_count):
+            reader = await self.open_reader()
+            self._reader_list.append(reader)
+            self._readers.put_nowait(reader)
+
+    async def close(self):
+        async with self._write_lock:
+            if self.writer is not None:
+                await self.writer.__aexit__()
+                self.writer = None
+        for reader in self._reader_list:
+            await reader.__aexit__()
+        self._reader_list.clear()
+        self._readers = asyncio.Queue()
+
+    async def _open_connection(self) -> Connection:
+        # databases 默认每次查询都新建并关闭一个 sqlite 连接，这里创建不绑定到当前 task 的长连接
+        connection = Connection(self.database._backend)
+        await connection.__aenter__()
+        for pragma in self.profile.pragmas():
+            await connection.execute(pragma)
+        return connection
+
+    async def open_reader(self) -> Connection:
+        """新建一个只读连接，不放入连接池，由调用方负责关闭"""
+        reader = await self._open_connection()
+        await reader.execute("PRAGMA query_only = ON")
+        return reader
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Connection]:
+        """独占写连接并开启事务，事务内的语句需通过返回的连接执行"""
+        async with self._write_lock:
+            async with self.writer.transaction():
+                yield self.writer
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[Connection]:
+        connection = await self._readers.get()
+        try:
+            yield connection
+        finally:
+            self._readers.put_nowait(connection)
+
+    async def execute(self, query: Query, values: Optional[dict] = None) -> Any:
+        async with self._write_lock:
+            return await self.writer.execute(query, values)
+
+    async def execute_many(self, query: Query, values: list):
+        async with self._write_lock:
+            await self.writer.execute_many(query, values)
+
+    async def fetch_all(self, query: Query, values: Optional[dict] = None) -> List[Record]:
+        async with self.reader() as connection:
+            return await connection.fetch_all(query, values)
+
+    async def fetch_one(self, query: Query, values: Optional[dict] = None) -> Optional[Record]:
+        async with self.reader() as connection:
+            return await connection.fetch_one(query, values)
+
+    async def fetch_val(self, query: Query, values: Optional[dict] = None, column: Any = 0) -> Any:
+        async with self.reader() as connection:
+            return await connection.fetch_val(query, values, column=column)
+
+    async def iterate(self, query: Query, values: Optional[dict] = None) -> AsyncGenerator[Record, None]:
+        async with self.reader() as connection:
+            async for record in connection.iterate(query, values):
+                yield record
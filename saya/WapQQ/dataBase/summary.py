@@ -0,0 +1,99 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+from sqlalchemy.dialects.sqlite import insert
+
+from .storage import Storage
+from .tables import ConversationSummaryTable
+
+ConversationKey = Tuple[str, int]  # (kind, conversationID) ，kind 为 "group" 或 "friend"
+
+
+@dataclass
+class ConversationSummary:
+    last_timestamp: float = 0.0
+    unread: int = 0
+    preview: str = ""
+
+
+class ConversationSummaries:
+    """各会话最后一条消息的时间、摘要与未读数，常驻内存，由后台任务定期写入 ConversationSummary 表"""
+
+    def __init__(self, preview_length: int, flush_interval: float):
+        self.preview_length = preview_length
+        self.flush_interval = flush_interval
+        self.storage: Optional[Storage] = None
+        self._summaries: Dict[ConversationKey, ConversationSummary] = {}
+        self._dirty: Set[ConversationKey] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    async def load(self, storage: Storage):
+        self.storage = storage
+        self._summaries.clear()
+        self._dirty.clear()
+        query = ConversationSummaryTable.select()
+        for row in await storage.fetch_all(query):
+            self._summaries[(row["kind"], row["conversationID"])] = ConversationSummary(
+                last_timestamp=row["lastTimestamp"], unread=row["unread"], preview=row["preview"])
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台任务，并写入尚未保存的变更"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception(f"会话摘要写入失败：{e!r}")
+
+    async def flush(self):
+        if not self._dirty or self.storage is None:
+            return
+        keys, self._dirty = self._dirty, set()
+        values = [dict(kind=kind, conversationID=conversation_id, lastTimestamp=summary.last_timestamp,
+                       unread=summary.unread, preview=summary.preview)
+                  for (kind, conversation_id), summary in ((key, self._summaries[key]) for key in keys)]
+        query = insert(ConversationSummaryTable)
+        query = query.on_conflict_do_update(
+            index_elements=[ConversationSummaryTable.c.kind, ConversationSummaryTable.c.conversationID],
+            set_=dict(lastTimestamp=query.excluded.lastTimestamp, unread=query.excluded.unread,
+                      preview=query.excluded.preview))
+        try:
+            async with self.storage.transaction() as connection:
+                await connection.execute_many(query, values)
+        except Exception:
+            self._dirty |= keys  # 下次重试
+            raise
+
+    def record(self, kind: str, conversation_id: int, timestamp: float, preview: str, incoming: bool):
+        """记录一条新消息；自己发出的消息说明已经看过该会话，未读数清零"""
+        key = (kind, conversation_id)
+        summary = self._summaries.setdefault(key, ConversationSummary())
+        summary.last_timestamp = max(summary.last_timestamp, timestamp)
+        summary.preview = preview[:self.preview_length]
+        summary.unread = summary.unread + 1 if incoming else 0
+        self._dirty.add(key)
+
+    def mark_read(self, kind: str, conversation_id: int):
+        key = (kind, conversation_id)
+        summary = self._summaries.get(key)
+        if summary is not None and summary.unread:
+            summary.unread = 0
+            self._dirty.add(key)
+
+    def get(self, kind: str, conversation_id: int) -> ConversationSummary:
+        return self._summaries.get((kind, conversation_id)) or ConversationSummary()
+
+    def sort_by_activity(self, kind: str, contacts: List) -> List:
+        """按最后一条消息的时间倒序排列联系人，没有消息的排在最后并保持原有顺序"""
+        return sorted(contacts, key=lambda contact: self.get(kind, contact.id).last_timestamp, reverse=True)
@@ -1,4 +1,4 @@
-from sqlalchemy import MetaData, Table, Column, Integer, String, Float
+from sqlalchemy import MetaData, Table, Column, Integer, String, Float, Index, LargeBinary
 
 
 metadata = MetaData()
@@ -34,7 +34,8 @@ FriendMessageTable = Table(
     Column("senderID", Integer),
     Column("friendID", Integer),
     Column("timestamp", Float),
-    Column("context", String)
+    Column("context", String),  # 旧版为 MessageChain.json() 文本，新写入的消息为 codec.py 编码的二进制
+    Column("text", String)  # 消息的纯文本，供全文搜索使用，为 NULL 时表示尚未提取
 )
 
 GroupMessageTable = Table(
@@ -44,5 +45,69 @@ GroupMessageTable = Table(
     Column("senderID", Integer),
     Column("groupID", Integer),
     Column("timestamp", Float),
-    Column("context", String)
+    Column("context", String),  # 旧版为 MessageChain.json() 文本，新写入的消息为 codec.py 编码的二进制
+    Column("text", String)  # 消息的纯文本，供全文搜索使用，为 NULL 时表示尚未提取
 )
+
+# 消息渲染后的 HTML 片段，kind 为 "group" 或 "friend" ，version 为模板的哈希，版本不一致时视为不存在
+MessageRenderTable = Table(
+    "MessageRender",
+    metadata,
+    Column("_id", Integer, primary_key=True),
+    Column("kind", String),
+    Column("messageID", Integer),
+    Column("version", String),
+    Column("html", String)
+)
+
+# 各会话最后一条消息的时间、摘要与未读数，主页据此排序，无需扫描消息表
+ConversationSummaryTable = Table(
+    "ConversationSummary",
+    metadata,
+    Column("_id", Integer, primary_key=True),
+    Column("kind", String),
+    Column("conversationID", Integer),
+    Column("lastTimestamp", Float),
+    Column("unread", Integer),
+    Column("preview", String)
+)
+
+# 消息编码使用的压缩字典，_id 记录在每条消息的头部，字典一旦写入不可修改或删除
+MessageDictionaryTable = Table(
+    "MessageDictionary",
+    metadata,
+    Column("_id", Integer, primary_key=True),
+    Column("compression", String),
+    Column("data", LargeBinary)
+)
+
+# 归档到分区数据库中的消息，每个会话在每个分区中一行，见 archive.py
+MessageArchiveTable = Table(
+    "MessageArchive",
+    metadata,
+    Column("_id", Integer, primary_key=True),
+    Column("kind", String),
+    Column("conversationID", Integer),
+    Column("partition", String),
+    Column("rows", Integer),
+    Column("minID", Integer),
+    Column("maxID", Integer)
+)
+
+message_tables = {"group": GroupMessageTable, "friend": FriendMessageTable}  # MessageRender.kind -> 消息表
+conversation_columns = {"group": "groupID", "friend": "friendID"}  # kind -> 消息表中的会话列
+
+# 已有数据库的索引由 migrations.py 添加，修改此处时需同时添加新的迁移
+Index("ix_account_accountID", AccountTable.c.accountID, unique=True)
+Index("ix_member_accountID_groupID", MemberTable.c.accountID, MemberTable.c.groupID, unique=True)
+Index("ix_group_groupID", GroupTable.c.groupID, unique=True)
+Index("ix_GroupMessage_groupID__id", GroupMessageTable.c.groupID, GroupMessageTable.c._id.desc())
+Index("ix_FriendMessage_friendID__id", FriendMessageTable.c.friendID, FriendMessageTable.c._id.desc())
+Index("ix_GroupMessage_text_null", GroupMessageTable.c._id, sqlite_where=GroupMessageTable.c.text.is_(None))
+Index("ix_FriendMessage_text_null", FriendMessageTable.c._id, sqlite_where=FriendMessageTable.c.text.is_(None))
+# MessageRender 为新增的表，已有数据库中由 create_all 连同索引一并创建
+Index("ix_MessageRender_kind_messageID", MessageRenderTable.c.kind, MessageRenderTable.c.messageID, unique=True)
+Index("ix_ConversationSummary_kind_conversationID", ConversationSummaryTable.c.kind,
+      ConversationSummaryTable.c.conversationID, unique=True)
+Index("ix_MessageArchive_kind_conversationID_partition", MessageArchiveTable.c.kind,
+      MessageArchiveTable.c.conversationID, MessageArchiveTable.c.partition, unique=True)
@@ -9,11 +9,13 @@ from graia.ariadne.message.chain import MessageChain
 class MessageContainer:
     time: str
     timestamp: float
-    message: MessageChain
+    message: Optional[MessageChain]  # 已有缓存的 HTML 片段时不再解析，为 None
     sender_id: int
     sender_name: str
     group_id: Optional[int]
     group_name: Optional[str]
+    message_id: int
+    html: Optional[str] = None
 
 
 def get_time_by_timestamp(timestamp: float) -> str:
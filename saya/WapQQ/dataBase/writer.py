@@ -0,0 +1,150 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Optional, List, Tuple, Dict, Any, Callable
+
+from loguru import logger
+from sqlalchemy.sql import ClauseElement
+from sqlalchemy.sql.dml import Insert
+
+from .storage import Storage
+
+PendingWrite = Tuple[ClauseElement, Optional[Dict[str, Any]]]
+WrittenCallback = Callable[[ClauseElement, Optional[Dict[str, Any]]], None]
+
+
+@dataclass
+class WriteBehindStats:
+    queue_depth: int
+    flush_count: int
+    flushed_rows: int
+    failed_rows: int
+    last_flush_latency: float
+    max_flush_latency: float
+    total_flush_latency: float
+
+
+class WriteBehindQueue:
+    """写缓冲队列，将写操作攒批后在同一事务中写入数据库"""
+
+    def __init__(self, storage: Storage, batch_size: int, flush_interval: float, queue_size: int,
+                 on_written: Optional[WrittenCallback] = None):
+        self.storage = storage
+        self.on_written = on_written  # 每条数据提交成功后调用，丢弃的数据不会调用
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: "asyncio.Queue[Optional[PendingWrite]]" = asyncio.Queue(maxsize=queue_size)
+        self._task: Optional[asyncio.Task] = None
+        self.flush_count = 0
+        self.flushed_rows = 0
+        self.failed_rows = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台任务，并保证队列中剩余的数据全部写入"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def put(self, query: ClauseElement, values: Optional[Dict[str, Any]] = None):
+        """加入队列，队列已满时等待，以此向上游施加背压"""
+        await self._queue.put((query, values))
+
+    def stats(self) -> WriteBehindStats:
+        return WriteBehindStats(queue_depth=self._queue.qsize(),
+                                flush_count=self.flush_count,
+                                flushed_rows=self.flushed_rows,
+                                failed_rows=self.failed_rows,
+                                last_flush_latency=self.last_flush_latency,
+                                max_flush_latency=self.max_flush_latency,
+                                total_flush_latency=self.total_flush_latency)
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch: List[PendingWrite] = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self.flush(batch)
+        # 收到停止信号后，把剩余数据一并写入
+        remaining: List[PendingWrite] = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                remaining.append(item)
+        if remaining:
+            await self.flush(remaining)
+
+    async def flush(self, batch: List[PendingWrite]):
+        """在一个事务中写入一批数据，连续的同表 insert 合并为 execute_many"""
+        start = time.perf_counter()
+        try:
+            async with self.storage.transaction() as connection:
+                for query, values_list in self._group(batch):
+                    if values_list is None:
+                        await connection.execute(query)
+                    else:
+                        await connection.execute_many(query, values_list)
+        except Exception:
+            logger.exception(f"批量写入 {len(batch)} 条数据失败，改为逐条写入")
+            await self._flush_one_by_one(batch)
+        else:
+            self.flushed_rows += len(batch)
+            if self.on_written is not None:
+                for query, values in batch:
+                    self.on_written(query, values)
+        latency = time.perf_counter() - start
+        self.flush_count += 1
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self.total_flush_latency += latency
+
+    async def _flush_one_by_one(self, batch: List[PendingWrite]):
+        for query, values in batch:
+            try:
+                await self.storage.execute(query, values)
+            except Exception:
+                logger.exception(f"写入失败，已丢弃：{query}")
+                self.failed_rows += 1
+            else:
+                self.flushed_rows += 1
+                if self.on_written is not None:
+                    self.on_written(query, values)
+
+    @staticmethod
+    def _group(batch: List[PendingWrite]) -> List[Tuple[ClauseElement, Optional[List[Dict[str, Any]]]]]:
+        groups: List[Tuple[ClauseElement, Optional[List[Dict[str, Any]]]]] = []
+        last_table: Optional[str] = None
+        for query, values in batch:
+            if isinstance(query, Insert) and values is not None:
+                table = query.table.name
+                if table == last_table:
+                    groups[-1][1].append(values)
+                else:
+                    groups.append((query, [values]))
+                    last_table = table
+            else:
+                groups.append((query.values(**values) if values else query, None))
+                last_table = None
+        return groups
@@ -0,0 +1,227 @@
+import functools
+import inspect
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from graia.ariadne.app import Ariadne
+from graia.broadcast.entities.event import Dispatchable
+
+from .config import metrics, metrics_buckets
+
+LabelValues = Tuple[str, ...]
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """只增不减的计数"""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{format_labels(self.labels, values)} {format_value(value)}"
+                     for values, value in self._values.items())
+        return lines
+
+
+class Histogram:
+    """按固定分桶统计耗时，记录一次只需一次二分查找与几次加法，可以常开"""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = metrics_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各分桶的计数（不累加，最后一项为超出最大分桶的计数）, 总和]
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *label_values: str):
+        item = self._values.get(label_values)
+        if item is None:
+            item = self._values[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+        item[0][bisect_left(self.buckets, value)] += 1
+        item[1][0] += value
+
+    @contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        for values, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(names, values + (format_value(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, values)} {format_value(total[0])}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, values)} {cumulative}")
+        return lines
+
+
+@dataclass
+class MetricFamily:
+    """由 collector 在抓取时生成的一组数值，用于导出已有的统计信息"""
+    name: str
+    kind: str  # "gauge" 或 "counter"
+    documentation: str
+    labels: Tuple[str, ...] = ()
+    samples: List[Tuple[LabelValues, float]] = field(default_factory=list)
+
+    def add(self, value: float, *label_values: str) -> "MetricFamily":
+        self.samples.append((label_values, value))
+        return self
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{self.name}{format_labels(self.labels, values)} {format_value(value)}"
+                     for values, value in self.samples)
+        return lines
+
+
+Collector = Callable[[], Iterable[MetricFamily]]
+
+
+class MetricsRegistry:
+    """保存所有指标，按 Prometheus 文本格式输出"""
+
+    def __init__(self):
+        self._metrics: List = []
+        self._collectors: List[Collector] = []
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Histogram:
+        metric = Histogram(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Collector):
+        """collector 在每次抓取时调用，返回当时的数值"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for family in collector():
+                lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+datamanager_seconds = registry.histogram("wapqq_datamanager_seconds", "DataManager 方法的耗时", ("method",))
+ariadne_call_seconds = registry.histogram("wapqq_ariadne_call_seconds", "调用 mirai-api-http 的耗时", ("command",))
+ariadne_call_errors = registry.counter("wapqq_ariadne_call_errors_total", "调用 mirai-api-http 失败的次数",
+                                       ("command",))
+handler_seconds = registry.histogram("wapqq_event_handler_seconds", "事件处理函数的耗时", ("handler", "event"))
+handler_errors = registry.counter("wapqq_event_handler_errors_total", "事件处理函数抛出异常的次数",
+                                  ("handler", "event"))
+http_request_seconds = registry.histogram("wapqq_http_request_seconds", "网页请求的耗时，流式响应只计到开始发送",
+                                          ("route", "method", "status"))
+image_fetch_seconds = registry.histogram("wapqq_image_fetch_seconds", "图片代理下载原图的耗时")
+image_transcode_seconds = registry.histogram("wapqq_image_transcode_seconds", "生成缩略图的耗时", ("executor",))
+
+
+def timed_methods(histogram: Histogram):
+    """类装饰器，记录类中每个公开的协程方法的耗时，以方法名为标签"""
+
+    def wrap(method_name: str, method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, method_name)
+
+        return wrapper
+
+    def decorator(cls):
+        if not metrics:
+            return cls
+        for name, value in list(vars(cls).items()):
+            if not name.startswith("_") and inspect.iscoroutinefunction(value):
+                setattr(cls, name, wrap(name, value))
+        return cls
+
+    return decorator
+
+
+def timed_handler(handler):
+    """事件处理函数的装饰器，以事件类型为标签记录耗时；保留原函数签名，Broadcast 仍按参数注解分派"""
+    if not metrics:
+        return handler
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        event = next((value for value in (*args, *kwargs.values()) if isinstance(value, Dispatchable)), None)
+        event_name = type(event).__name__ if event is not None else ""
+        start = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(handler.__name__, event_name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, handler.__name__, event_name)
+
+    return wrapper
+
+
+def instrument_ariadne(app: Ariadne):
+    """替换 app.connection.call ，按 command 记录每次 API 调用的耗时，重复调用不会重复包装"""
+    if not metrics:
+        return
+    connection = app.connection
+    call = connection.call
+    if getattr(call, "instrumented", False):
+        return
+
+    @functools.wraps(call)
+    async def instrumented_call(command: str, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await call(command, *args, **kwargs)
+        except Exception:
+            ariadne_call_errors.inc(command)
+            raise
+        finally:
+            ariadne_call_seconds.observe(time.perf_counter() - start, command)
+
+    instrumented_call.instrumented = True
+    connection.call = instrumented_call
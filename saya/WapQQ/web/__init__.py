@@ -4,9 +4,17 @@ from pathlib import Path
 
 from uvicorn import Config
 
-from .config import host, port
+from .config import host, port, prefetch_images
+from .http_client import http_client
+from .face_sprite import prepare_face_sprite
+from .image_cache import thumbnail_cache, avatar_cache
+from .live import live_hub
+from .market_face import market_face_directory
+from .prefetch import thumbnail_prefetcher
+from .transcode import transcode_engine
 from .utils import NoSignalServer
 from .webserver import quart
+from ..dataBase import data_manager
 
 task: Task
 server: NoSignalServer
@@ -15,12 +23,22 @@ current_path = Path(__file__).parents[0]
 
 async def launch_webserver():
     global server, task
+    await http_client.open()
+    await thumbnail_cache.load()
+    await avatar_cache.load()
+    await market_face_directory.load()
+    await asyncio.to_thread(prepare_face_sprite)
+    await transcode_engine.start()
+    if prefetch_images:
+        thumbnail_prefetcher.start()
+        data_manager.message_hooks.append(thumbnail_prefetcher.submit)
     server = NoSignalServer(Config(quart, host=host, port=port, log_config=None, reload=False))
     task = asyncio.create_task(server.serve())
 
 
 async def stop_webserver():
     global server, task
+    live_hub.close()
     server.should_exit = True
     times = 0
     while not task.done():
@@ -31,3 +49,8 @@ async def stop_webserver():
             break
         await asyncio.sleep(0.1)
         times += 1
+    if thumbnail_prefetcher.submit in data_manager.message_hooks:
+        data_manager.message_hooks.remove(thumbnail_prefetcher.submit)
+    await thumbnail_prefetcher.stop()
+    await http_client.close()
+    transcode_engine.shutdown()
@@ -4,3 +4,41 @@ chat_limit = 30
 use_image_proxy = True
 max_width = 200
 max_height = 200
+image_cache_memory_size = 32 * 1024 * 1024  # 单位：字节，内存中缩略图缓存的上限
+image_cache_disk_size = 512 * 1024 * 1024  # 单位：字节，磁盘上缩略图缓存的上限
+image_cache_max_age = 7 * 24 * 60 * 60  # 单位：秒，浏览器缓存缩略图的时间
+http_max_connections = 100  # 对外请求的连接池上限
+http_max_keepalive_connections = 20
+http_keepalive_expiry = 30  # 单位：秒
+http_timeout = 10  # 单位：秒
+http2 = True  # 需要安装 h2 ，未安装时自动使用 HTTP/1.1
+http_per_host_limit = 8  # 对同一主机的最大并发请求数
+transcode_processes = 2  # 处理大图与动图的进程数，为 0 时仅使用线程
+transcode_process_threshold = 1000000  # 像素数超过该值的静态图片交给进程池处理，动图总是交给进程池
+transcode_max_frames = 100  # 动图帧数上限，超过时均匀丢帧并保留总时长
+transcode_max_pixels = 16000000  # 单帧像素数上限，超过时拒绝处理
+thumbnail_size_buckets = (64, 128, 200, 320, 480)  # 图片代理的 ?w=&h= 参数会向上取整到其中之一，且不超过 max_width / max_height
+thumbnail_webp_quality = 75  # 浏览器声明支持 WebP 时，缩略图统一输出为 WebP
+thumbnail_jpeg_quality = 80
+render_cache = True  # 缓存每条消息渲染后的 HTML 片段，修改 macro.jinja2 后旧片段自动失效
+render_backfill_batch_size = 500  # python manage.py backfill-render 每批渲染的消息数
+live_max_subscribers = 200  # 实时推送的连接总数上限，超过时返回 503
+live_max_conversation_subscribers = 50  # 单个会话的连接数上限
+live_queue_size = 100  # 每个连接待发送的消息数上限，客户端跟不上时断开并通知其刷新页面
+live_heartbeat_interval = 15  # 单位：秒，无新消息时发送心跳，以便及时发现已断开的连接
+minify_html = True  # 使用 htmlmin 压缩页面中的空白与注释
+compress_min_size = 512  # 单位：字节，小于该大小的响应不压缩
+gzip_level = 6
+brotli_quality = 5  # 需要安装 brotli 或 brotlicffi ，未安装时只使用 gzip
+static_max_age = 30 * 24 * 60 * 60  # 单位：秒，/resources 下静态文件的浏览器缓存时间，样式表的链接带有内容哈希
+avatar_size = 70  # 单位：像素，头像显示为 35px ，按两倍大小生成以适配高分辨率屏幕
+avatar_cache_disk_size = 64 * 1024 * 1024  # 单位：字节，磁盘上头像缓存的上限
+avatar_refresh_interval = 24 * 60 * 60  # 单位：秒，超过该时间后重新获取头像，也是浏览器缓存头像的时间
+face_mode = "sprite"  # "sprite" 时 QQ 表情使用雪碧图，整套表情只需一次请求；"image" 时每个表情单独请求图片
+face_size = 25  # 单位：像素，表情的显示大小，雪碧图按两倍大小生成
+prefetch_images = False  # 收到消息时在后台下载图片并生成缩略图，首次查看时无需等待，也避免图片链接过期
+prefetch_workers = 2  # 预取的并发数，应小于 http_per_host_limit ，为浏览器的请求保留连接
+prefetch_queue_size = 1000  # 待预取图片数上限，队列满时丢弃新图片
+prefetch_bandwidth = 1024 * 1024  # 单位：字节/秒，预取的下载带宽上限
+prefetch_max_size = 10 * 1024 * 1024  # 单位：字节，超过该大小的图片不生成缩略图
+prefetch_webp = True  # 同时生成 WebP 与原格式的缩略图，为 False 时只生成原格式
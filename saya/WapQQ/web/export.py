@@ -0,0 +1,77 @@
+import csv
+import json
+from io import StringIO
+from typing import AsyncIterator, Callable, Dict, List, Tuple
+
+from markupsafe import escape
+
+from .config import render_cache
+from .render import render_version, render_message, render_chat_item
+from .utils import current_path
+from ..dataBase import data_manager
+from ..dataBase.codec import chain_to_obj
+from ..dataBase.search import plain_text
+from ..dataBase.utils import MessageContainer
+
+Batches = AsyncIterator[List[MessageContainer]]
+CSV_COLUMNS = ("id", "time", "timestamp", "sender_id", "sender_name", "text")
+
+
+async def export_jsonl(batches: Batches, **_) -> AsyncIterator[bytes]:
+    """每行一条消息，message 与数据库中保存的消息链结构相同"""
+    async for batch in batches:
+        yield "".join(json.dumps(dict(id=i.message_id, time=i.time, timestamp=i.timestamp, sender_id=i.sender_id,
+                                      sender_name=i.sender_name, text=plain_text(i.message),
+                                      message=chain_to_obj(i.message)), ensure_ascii=False) + "\n"
+                      for i in batch).encode()
+
+
+async def export_csv(batches: Batches, **_) -> AsyncIterator[bytes]:
+    """只导出纯文本，图片等元素被忽略"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")  # BOM ，Excel 据此识别 UTF-8
+    writer.writerow(CSV_COLUMNS)
+    async for batch in batches:
+        writer.writerows((i.message_id, i.time, i.timestamp, i.sender_id, i.sender_name, plain_text(i.message))
+                         for i in batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+async def export_html(batches: Batches, title: str, account: int, base_url: str) -> AsyncIterator[bytes]:
+    """与消息页相同的排版，样式内联；图片与头像仍指向 WapQQ ，需要能访问 WapQQ 时才能显示"""
+    style = current_path.joinpath("resources", "css", "global.css").read_text(encoding="utf-8")
+    sprite = current_path.joinpath("resources", "qq-face-sprite", "sprite.css")
+    if sprite.exists():
+        style += sprite.read_text(encoding="utf-8")
+    yield (f'<!DOCTYPE html>\n<html lang="zh">\n<head>\n<meta charset="utf-8">\n'
+           f'<meta name="referrer" content="never">\n<base href="{escape(base_url)}">\n'
+           f"<title>{escape(title)}</title>\n<style>{style}</style>\n</head>\n<body>\n"
+           f"<h3>{escape(title)}</h3>\n").encode()
+    async for batch in batches:
+        items = []
+        for i in batch:
+            if i.html is None:
+                i.html = await render_message(i.message)
+            items.append(await render_chat_item(i, account))
+        yield ("\n".join(items) + "\n").encode()
+    yield b"</body>\n</html>\n"
+
+
+# format 参数 -> (Content-Type ，生成函数)
+exporters: Dict[str, Tuple[str, Callable[..., AsyncIterator[bytes]]]] = {
+    "jsonl": ("application/x-ndjson; charset=utf-8", export_jsonl),
+    "csv": ("text/csv; charset=utf-8", export_csv),
+    "html": ("text/html; charset=utf-8", export_html),
+}
+
+
+def export_stream(kind: str, conversation_id: int, export_format: str, **kwargs) -> AsyncIterator[bytes]:
+    """按批读取并逐批输出，HTML 优先使用缓存的消息片段"""
+    _, exporter = exporters[export_format]
+    version = render_version if export_format == "html" and render_cache else None
+    return exporter(data_manager.iterate_messages(kind, conversation_id, render_version=version), **kwargs)
@@ -0,0 +1,59 @@
+import math
+from typing import Optional, Set
+
+from PIL import Image
+from loguru import logger
+
+from .config import face_mode, face_size
+from .utils import current_path
+
+face_path = current_path.joinpath("resources", "qq-face")
+sprite_path = current_path.joinpath("resources", "qq-face-sprite")  # 由 build_face_sprite 生成，不纳入版本控制
+sprite_image = sprite_path.joinpath("sprite.png")
+sprite_css = sprite_path.joinpath("sprite.css")
+
+
+def face_ids() -> Set[int]:
+    return {int(i.stem) for i in face_path.glob("*.png") if i.stem.isdigit()}
+
+
+def build_face_sprite() -> int:
+    """将 qq-face 下的静态表情按 face_id 顺序拼成一张雪碧图，并生成对应的样式表，返回表情数"""
+    ids = sorted(face_ids())
+    cell = face_size * 2  # 适配高分辨率屏幕
+    columns = math.ceil(math.sqrt(len(ids)))
+    rows = math.ceil(len(ids) / columns)
+    sheet = Image.new("RGBA", (columns * cell, rows * cell))
+    css = []
+    for index, face_id in enumerate(ids):
+        row, column = divmod(index, columns)
+        with Image.open(face_path.joinpath(f"{face_id}.png")) as face:
+            face = face.convert("RGBA")
+            face.thumbnail((cell, cell), Image.Resampling.LANCZOS)
+            sheet.paste(face, (column * cell + (cell - face.width) // 2, row * cell + (cell - face.height) // 2))
+        css.append(f".face-{face_id}{{background-position:-{column * face_size}px -{row * face_size}px}}")
+    sprite_path.mkdir(parents=True, exist_ok=True)
+    # 表情颜色较少，量化为 256 色后肉眼几乎无差别，体积约为 RGBA 的五分之一
+    sheet.quantize(256, method=Image.Quantize.FASTOCTREE).save(sprite_image, format="PNG", optimize=True)
+    version = sprite_image.stat().st_mtime_ns
+    css.insert(0, f".face-sprite{{display:inline-block;width:{face_size}px;height:{face_size}px;"
+                  f"background:url(sprite.png?v={version}) no-repeat;"
+                  f"background-size:{columns * face_size}px {rows * face_size}px}}")
+    sprite_css.write_text("\n".join(css) + "\n", encoding="utf-8")
+    return len(ids)
+
+
+def prepare_face_sprite():
+    """雪碧图模式下，雪碧图不存在或比表情文件旧时重新生成，应在启动网页服务时调用"""
+    if face_mode != "sprite":
+        return
+    if sprite_css.exists():
+        built = sprite_css.stat().st_mtime
+        if all(i.stat().st_mtime <= built for i in face_path.glob("*.png")):
+            return
+    count = build_face_sprite()
+    logger.info(f"已生成 {count} 个 QQ 表情的雪碧图")
+
+
+# 模板中用于判断表情是否在雪碧图中，不在其中（如新增的表情）时仍使用单独的图片
+sprite_face_ids: Optional[Set[int]] = face_ids() if face_mode == "sprite" else None
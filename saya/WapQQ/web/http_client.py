@@ -0,0 +1,47 @@
+import asyncio
+from typing import Dict, Optional
+
+from httpx import AsyncClient, Limits, Response, Timeout, URL
+from loguru import logger
+
+from .config import http_max_connections, http_max_keepalive_connections, http_keepalive_expiry, http_timeout, \
+    http2, http_per_host_limit
+
+
+class HttpClient:
+    """网页服务共用的 httpx 客户端，复用连接并限制对同一主机的并发请求数"""
+
+    def __init__(self, per_host_limit: int):
+        self.per_host_limit = per_host_limit
+        self.client: Optional[AsyncClient] = None
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    async def open(self):
+        use_http2 = http2
+        if use_http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("未安装 h2 ，对外请求将使用 HTTP/1.1")
+                use_http2 = False
+        self.client = AsyncClient(http2=use_http2,
+                                  timeout=Timeout(http_timeout),
+                                  limits=Limits(max_connections=http_max_connections,
+                                                max_keepalive_connections=http_max_keepalive_connections,
+                                                keepalive_expiry=http_keepalive_expiry))
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def get(self, url: str, **kwargs) -> Response:
+        host = URL(url).host
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._host_semaphores[host] = asyncio.Semaphore(self.per_host_limit)
+        async with semaphore:
+            return await self.client.get(url, **kwargs)
+
+
+http_client = HttpClient(per_host_limit=http_per_host_limit)
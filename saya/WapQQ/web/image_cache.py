@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from loguru import logger
+
+from .config import image_cache_memory_size, image_cache_disk_size, avatar_cache_disk_size
+
+current_path = Path(__file__).parents[0]
+
+
+@dataclass
+class CachedImage:
+    data: bytes
+    mimetype: str
+    etag: str
+
+
+@dataclass
+class ImageCacheStats:
+    memory_bytes: int
+    disk_bytes: int
+    memory_hits: int
+    disk_hits: int
+    misses: int
+
+
+def make_etag(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class ImageCache:
+    """两级图片缓存：内存中的 LRU 与磁盘上按内容寻址的存储，二者都有字节数上限"""
+
+    def __init__(self, path: Path, memory_size: int, disk_size: int):
+        self.path = path  # 可在 load 前修改
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self._memory: "OrderedDict[str, CachedImage]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._disk_lock = threading.Lock()
+        self._pending: Dict[str, "asyncio.Future[CachedImage]"] = {}
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def blob_path(self) -> Path:
+        """文件名为内容的 sha256"""
+        return self.path.joinpath("blobs")
+
+    @property
+    def key_path(self) -> Path:
+        """文件名为 key 的 sha256 ，内容为 "<内容 sha256> <mimetype>" """
+        return self.path.joinpath("keys")
+
+    async def load(self):
+        """创建缓存目录并统计磁盘占用，应在启动网页服务时调用"""
+        await asyncio.to_thread(self._load)
+
+    def _load(self):
+        self.blob_path.mkdir(parents=True, exist_ok=True)
+        self.key_path.mkdir(parents=True, exist_ok=True)
+        self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.blob_path))
+
+    @staticmethod
+    def make_key(url: str, width: int, height: int, variant: str = "") -> str:
+        return hashlib.sha256(f"{url}|{width}x{height}|{variant}".encode()).hexdigest()
+
+    async def contains(self, key: str) -> bool:
+        """是否已缓存，不会改变 LRU 顺序"""
+        if key in self._memory:
+            return True
+        return await asyncio.to_thread(self._exists_on_disk, key)
+
+    def _exists_on_disk(self, key: str) -> bool:
+        try:
+            etag = self.key_path.joinpath(key).read_text(encoding="utf-8").split(" ", 1)[0]
+        except FileNotFoundError:
+            return False
+        return self.blob_path.joinpath(etag).exists()
+
+    async def get_or_create(self, key: str, factory: Callable[[], Awaitable[Tuple[bytes, str]]]) -> CachedImage:
+        """依次查找内存与磁盘，均未命中时调用 factory 生成，同一 key 的并发请求只会调用一次 factory"""
+        image = self._memory.get(key)
+        if image is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return image
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            image = await asyncio.to_thread(self._read_disk, key)
+            if image is not None:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+                data, mimetype = await factory()
+                image = CachedImage(data=data, mimetype=mimetype, etag=make_etag(data))
+                await asyncio.to_thread(self._write_disk, key, image)
+            self._remember(key, image)
+            future.set_result(image)
+            return image
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # 无其他等待者时避免 "exception was never retrieved" 警告
+            raise
+        finally:
+            del self._pending[key]
+
+    def stats(self) -> ImageCacheStats:
+        return ImageCacheStats(memory_bytes=self._memory_bytes, disk_bytes=self._disk_bytes,
+                               memory_hits=self.memory_hits, disk_hits=self.disk_hits, misses=self.misses)
+
+    def _remember(self, key: str, image: CachedImage):
+        if len(image.data) > self.memory_size:
+            return
+        self._memory[key] = image
+        self._memory_bytes += len(image.data)
+        while self._memory_bytes > self.memory_size:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted.data)
+
+    def _read_disk(self, key: str) -> Optional[CachedImage]:
+        key_file = self.key_path.joinpath(key)
+        try:
+            etag, mimetype = key_file.read_text(encoding="utf-8").split(" ", 1)
+            blob = self.blob_path.joinpath(etag)
+            data = blob.read_bytes()
+            os.utime(blob)  # 以修改时间记录最近使用时间，供淘汰时排序
+        except (FileNotFoundError, ValueError):
+            key_file.unlink(missing_ok=True)  # 指向的内容已被淘汰
+            return None
+        return CachedImage(data=data, mimetype=mimetype, etag=etag)
+
+    def _write_disk(self, key: str, image: CachedImage):
+        blob = self.blob_path.joinpath(image.etag)
+        with self._disk_lock:
+            if not blob.exists():
+                blob.write_bytes(image.data)
+                self._disk_bytes += len(image.data)
+            self.key_path.joinpath(key).write_text(f"{image.etag} {image.mimetype}", encoding="utf-8")
+            if self._disk_bytes > self.disk_size:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        """按最近使用时间删除最旧的文件，直到占用降到上限的九成，再删除指向这些文件的 key 文件"""
+        entries = sorted(os.scandir(self.blob_path), key=lambda entry: entry.stat().st_mtime)
+        target = self.disk_size * 0.9
+        evicted = set()
+        for entry in entries:
+            if self._disk_bytes <= target:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._disk_bytes -= size
+            evicted.add(entry.name)
+        removed_keys = 0
+        for entry in os.scandir(self.key_path):
+            try:
+                with open(entry.path, encoding="utf-8") as file:
+                    etag = file.read().split(" ", 1)[0]
+                if etag in evicted:
+                    os.remove(entry.path)
+                    removed_keys += 1
+            except FileNotFoundError:
+                continue
+        logger.debug(f"图片缓存淘汰 {len(evicted)} 个文件与 {removed_keys} 个 key ，当前占用 {self._disk_bytes} 字节")
+
+
+thumbnail_cache = ImageCache(current_path.joinpath("cache", "thumbnails"),
+                             memory_size=image_cache_memory_size, disk_size=image_cache_disk_size)
+avatar_cache = ImageCache(current_path.joinpath("cache", "avatars"),
+                          memory_size=image_cache_memory_size // 4, disk_size=avatar_cache_disk_size)
@@ -0,0 +1,132 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Optional, Set, Tuple
+
+from graia.ariadne.app import Ariadne
+from graia.ariadne.message.chain import MessageChain
+
+from .config import live_max_subscribers, live_max_conversation_subscribers, live_queue_size
+from .render import render_message, render_chat_item
+from ..dataBase.utils import get_time_by_timestamp
+
+RELOAD = b"event: reload\ndata: \n\n"  # 通知客户端刷新整页
+CLOSE = b""  # 服务关闭，结束推送
+HEARTBEAT = b": ping\n\n"
+
+
+@dataclass
+class LiveStats:
+    subscribers: int
+    conversations: int
+    published: int
+    overflowed: int  # 因客户端跟不上而被断开的连接数
+    rejected: int  # 因超过连接数上限而被拒绝的连接数
+
+
+class Subscription:
+    """一个 Server-Sent Events 连接，待发送的消息放在有界队列中"""
+
+    def __init__(self, queue_size: int):
+        self.queue: "asyncio.Queue[bytes]" = asyncio.Queue(queue_size)
+
+    def push(self, event: bytes) -> bool:
+        """队列已满时清空队列并只保留刷新通知，返回 False"""
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RELOAD)
+            return False
+
+    async def events(self, heartbeat_interval: float) -> AsyncIterator[bytes]:
+        while True:
+            try:
+                event = await asyncio.wait_for(self.queue.get(), heartbeat_interval)
+            except asyncio.TimeoutError:
+                yield HEARTBEAT
+                continue
+            if event is CLOSE:
+                return
+            yield event
+            if event is RELOAD:
+                return
+
+
+class LiveHub:
+    """按会话分发新消息的 HTML 片段，每条消息只渲染、编码一次"""
+
+    def __init__(self, max_subscribers: int, max_conversation_subscribers: int, queue_size: int):
+        self.max_subscribers = max_subscribers
+        self.max_conversation_subscribers = max_conversation_subscribers
+        self.queue_size = queue_size
+        self._subscribers: Dict[Tuple[str, int], Set[Subscription]] = {}
+        self._count = 0
+        self.published = 0
+        self.overflowed = 0
+        self.rejected = 0
+
+    def subscribe(self, kind: str, conversation_id: int) -> Optional[Subscription]:
+        """超过连接数上限时返回 None"""
+        subscribers = self._subscribers.setdefault((kind, conversation_id), set())
+        if self._count >= self.max_subscribers or len(subscribers) >= self.max_conversation_subscribers:
+            self.rejected += 1
+            if not subscribers:
+                del self._subscribers[(kind, conversation_id)]
+            return None
+        subscription = Subscription(self.queue_size)
+        subscribers.add(subscription)
+        self._count += 1
+        return subscription
+
+    def unsubscribe(self, kind: str, conversation_id: int, subscription: Subscription):
+        subscribers = self._subscribers.get((kind, conversation_id))
+        if subscribers is None or subscription not in subscribers:
+            return
+        subscribers.remove(subscription)
+        self._count -= 1
+        if not subscribers:
+            del self._subscribers[(kind, conversation_id)]
+
+    def has_subscribers(self, kind: str, conversation_id: int) -> bool:
+        return (kind, conversation_id) in self._subscribers
+
+    def publish(self, kind: str, conversation_id: int, fragment: str):
+        """以 SSE 格式编码后放入该会话所有连接的队列，不会等待"""
+        subscribers = self._subscribers.get((kind, conversation_id))
+        if not subscribers:
+            return
+        event = "".join(f"data: {line}\n" for line in fragment.splitlines()).encode() + b"\n"
+        self.published += 1
+        for subscription in subscribers:
+            if not subscription.push(event):
+                self.overflowed += 1
+
+    def close(self):
+        """结束所有推送，应在关闭网页服务前调用，否则 uvicorn 会等待这些连接"""
+        for subscribers in self._subscribers.values():
+            for subscription in subscribers:
+                while not subscription.queue.empty():
+                    subscription.queue.get_nowait()
+                subscription.queue.put_nowait(CLOSE)
+
+    def stats(self) -> LiveStats:
+        return LiveStats(subscribers=self._count, conversations=len(self._subscribers), published=self.published,
+                         overflowed=self.overflowed, rejected=self.rejected)
+
+
+live_hub = LiveHub(max_subscribers=live_max_subscribers,
+                   max_conversation_subscribers=live_max_conversation_subscribers, queue_size=live_queue_size)
+
+
+async def publish_message(kind: str, conversation_id: int, sender_id: int, sender_name: str, message: MessageChain,
+                          timestamp: Optional[float] = None):
+    """渲染一条新消息并推送给正在查看该会话的客户端，没有客户端时不做任何事"""
+    if not live_hub.has_subscribers(kind, conversation_id):
+        return
+    timestamp = time.time() if timestamp is None else timestamp
+    item = dict(sender_id=sender_id, sender_name=sender_name, time=get_time_by_timestamp(timestamp),
+                html=await render_message(message))
+    live_hub.publish(kind, conversation_id, await render_chat_item(item, Ariadne.current().account))
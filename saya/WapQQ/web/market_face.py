@@ -0,0 +1,80 @@
+import asyncio
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+from loguru import logger
+
+from .http_client import http_client
+from .utils import current_path
+
+MarketFaceUrls = Dict[str, str]  # 表情名称 -> 图片地址
+
+
+class MarketFaceDirectory:
+    """魔法表情的图片地址，每个 face_id 只请求一次 parcel 元数据，结果保存在磁盘上"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._faces: Dict[str, MarketFaceUrls] = {}  # 以字符串形式的 face_id 为键，与 json 一致
+        self._pending: Dict[int, "asyncio.Future[MarketFaceUrls]"] = {}
+
+    async def load(self):
+        self._faces = await asyncio.to_thread(self._load)
+
+    def _load(self) -> Dict[str, MarketFaceUrls]:
+        try:
+            return json.loads(self.path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning(f"魔法表情缓存 {self.path} 已损坏，将重新获取")
+            return {}
+
+    def _save(self, faces: Dict[str, MarketFaceUrls]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix(".tmp")
+        temp_path.write_text(json.dumps(faces, ensure_ascii=False), encoding="utf-8")
+        os.replace(temp_path, self.path)
+
+    async def get_url(self, face_id: int, name: str) -> Optional[str]:
+        """返回表情图片地址，表情不存在时返回 None ，请求元数据失败时抛出异常"""
+        urls = self._faces.get(str(face_id))
+        if urls is None:
+            pending = self._pending.get(face_id)
+            if pending is not None:
+                urls = await asyncio.shield(pending)
+            else:
+                urls = await self._fetch(face_id)
+        return urls.get(name)
+
+    async def _fetch(self, face_id: int) -> MarketFaceUrls:
+        future = asyncio.get_running_loop().create_future()
+        self._pending[face_id] = future
+        try:
+            url = f"https://i.gtimg.cn/club/item/parcel/{face_id % 10}/{face_id}_android.json"
+            meta = (await http_client.get(url)).json()
+            urls = {}
+            for i in meta["imgs"]:
+                height: int = i["wHeightInPhone"]
+                width: int = i["wWidthInPhone"]
+                item_id: str = i["id"]
+                urls[i["name"]] = \
+                    f"https://i.gtimg.cn/club/item/parcel/item/{item_id[:2]}/{item_id}/{height}x{width}.png"
+            self._faces[str(face_id)] = urls
+            await asyncio.to_thread(self._save, dict(self._faces))
+            future.set_result(urls)
+            return urls
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # 无其他等待者时避免 "exception was never retrieved" 警告
+            raise
+        finally:
+            del self._pending[face_id]
+
+
+market_face_directory = MarketFaceDirectory(current_path.joinpath("cache", "market_faces.json"))
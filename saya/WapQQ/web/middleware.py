@@ -0,0 +1,102 @@
+import gzip
+import hashlib
+from typing import Dict, Optional
+
+import htmlmin
+from graia.ariadne.app import Ariadne
+from quart import Response, request
+from quart.wrappers.response import DataBody
+
+from .config import minify_html, compress_min_size, gzip_level, brotli_quality, use_image_proxy, face_mode
+from .utils import current_path
+from ..dataBase import data_manager
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+resources_path = current_path.joinpath("resources")
+COMPRESSIBLE_MIMETYPES = {"text/html", "text/css", "text/plain", "text/javascript", "application/javascript",
+                          "application/json", "image/svg+xml"}
+
+
+def get_template_version() -> str:
+    """所有模板与渲染参数的哈希，任一变化时页面的 ETag 随之变化"""
+    digest = hashlib.sha256(f"{use_image_proxy}|{face_mode}".encode())
+    for template in sorted(resources_path.joinpath("templates").glob("*.jinja2")):
+        digest.update(template.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+template_version = get_template_version()
+_static_versions: Dict[str, str] = {}
+
+
+def static_url(filename: str) -> str:
+    """带内容哈希的静态文件链接，文件修改后链接随之变化，因此可以长时间缓存"""
+    version = _static_versions.get(filename)
+    if version is None:
+        version = hashlib.sha256(resources_path.joinpath(filename).read_bytes()).hexdigest()[:8]
+        _static_versions[filename] = version
+    return f"/resources/{filename}?v={version}"
+
+
+async def conversation_etag(kind: str, conversation_id: int, name: str) -> str:
+    """会话页面的 ETag ，由会话最新一条消息的 _id 、会话名称、查询参数与模板版本决定"""
+    latest = await data_manager.get_latest_message_id(kind, conversation_id)
+    key = f"{kind}|{conversation_id}|{latest}|{name}|{request.query_string.decode()}|" \
+          f"{Ariadne.current().account}|{template_version}"
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def not_modified(etag: str) -> Optional[Response]:
+    """浏览器缓存的页面仍然有效时返回 304 响应，否则返回 None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    set_page_cache_headers(response, etag)
+    return response
+
+
+def set_page_cache_headers(response: Response, etag: str):
+    # 压缩后的内容与编码有关，因此使用弱 ETag
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+
+def choose_encoding() -> Optional[str]:
+    encodings = request.accept_encodings
+    if brotli is not None and encodings["br"] > 0 and encodings["br"] >= encodings["gzip"]:
+        return "br"
+    if encodings["gzip"] > 0:
+        return "gzip"
+    return None
+
+
+async def optimize_response(response: Response) -> Response:
+    """after_request 钩子：压缩 HTML 页面，并按 Accept-Encoding 使用 brotli 或 gzip 压缩响应"""
+    if request.path.startswith("/resources/"):
+        response.cache_control.public = True
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or not isinstance(response.response, DataBody):
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200 or "Content-Encoding" in response.headers:
+        return response
+    data = await response.get_data()
+    if minify_html and response.mimetype == "text/html":
+        data = htmlmin.minify(data.decode(response.charset), remove_comments=True).encode(response.charset)
+    encoding = choose_encoding() if len(data) >= compress_min_size else None
+    if encoding == "br":
+        data = brotli.compress(data, quality=brotli_quality)
+    elif encoding == "gzip":
+        data = gzip.compress(data, compresslevel=gzip_level)
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.set_data(data)
+    return response
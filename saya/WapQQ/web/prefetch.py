@@ -0,0 +1,165 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, List, Optional
+
+from PIL import UnidentifiedImageError
+from graia.ariadne.message.chain import MessageChain
+from graia.ariadne.message.element import Image
+from httpx import HTTPError
+from loguru import logger
+
+from .config import max_width, max_height, prefetch_workers, prefetch_queue_size, prefetch_bandwidth, \
+    prefetch_max_size, prefetch_webp
+from .http_client import http_client
+from .image_cache import ImageCache, thumbnail_cache
+from .transcode import transcode_engine, ImageTooLarge
+
+
+@dataclass
+class PrefetchStats:
+    queued: int
+    submitted: int
+    dropped: int  # 队列已满而被丢弃的图片数
+    fetched: int
+    skipped: int  # 已在缓存中的图片数
+    failed: int
+    bytes: int
+
+
+class TokenBucket:
+    """按字节计的令牌桶，允许透支，透支后等待令牌补足再继续"""
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    async def wait(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    def consume(self, size: int):
+        self.tokens -= size
+
+
+class ThumbnailPrefetcher:
+    """收到消息时在后台下载其中的图片并写入缩略图缓存
+
+    有浏览器请求 /image_proxy 时暂停预取，并限制并发数与带宽，不与实时请求争抢连接与进程池
+    """
+
+    def __init__(self, cache: ImageCache, workers: int, queue_size: int, bandwidth: int):
+        self.cache = cache
+        self.workers = workers
+        self.queue_size = queue_size
+        self.bucket = TokenBucket(bandwidth)
+        self._queue: Optional["asyncio.Queue[str]"] = None
+        self._tasks: List[asyncio.Task] = []
+        self._recent: "OrderedDict[str, None]" = OrderedDict()  # 最近提交过的链接，避免重复预取
+        self._live_requests = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.submitted = 0
+        self.dropped = 0
+        self.fetched = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def start(self):
+        self._queue = asyncio.Queue(self.queue_size)
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def submit(self, message_chain: MessageChain):
+        """提取消息中的图片并放入队列，不会等待；未启动时不做任何事"""
+        if self._queue is None:
+            return
+        for image in message_chain.get(Image):
+            url = image.url
+            if url is None or url in self._recent:
+                continue
+            self._recent[url] = None
+            if len(self._recent) > self.queue_size:
+                self._recent.popitem(last=False)
+            try:
+                self._queue.put_nowait(url)
+                self.submitted += 1
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+    @asynccontextmanager
+    async def live_request(self) -> AsyncIterator[None]:
+        """包裹浏览器发起的图片请求，期间预取暂停"""
+        self._live_requests += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self._live_requests -= 1
+            if self._live_requests == 0:
+                self._idle.set()
+
+    def stats(self) -> PrefetchStats:
+        return PrefetchStats(queued=self._queue.qsize() if self._queue is not None else 0,
+                             submitted=self.submitted, dropped=self.dropped, fetched=self.fetched,
+                             skipped=self.skipped, failed=self.failed, bytes=self.bytes)
+
+    async def _run(self):
+        while True:
+            url = await self._queue.get()
+            await self._idle.wait()
+            await self.bucket.wait()
+            try:
+                await self.warm(url)
+            except asyncio.CancelledError:
+                raise
+            except (HTTPError, UnidentifiedImageError, ImageTooLarge) as e:
+                self.failed += 1
+                logger.debug(f"预取图片失败 {url}：{e!r}")
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f"预取图片失败 {url}：{e!r}")
+
+    async def warm(self, url: str):
+        """生成与 /image_proxy 默认尺寸相同的缩略图，同一图片只下载一次"""
+        variants = ["webp", ""] if prefetch_webp else [""]
+        keys = [(variant, self.cache.make_key(url, max_width, max_height, variant)) for variant in variants]
+        missing = [(variant, key) for variant, key in keys if not await self.cache.contains(key)]
+        if not missing:
+            self.skipped += 1
+            return
+        data = await self.download(url)
+        if data is None:
+            return
+        for variant, key in missing:
+            await self.cache.get_or_create(
+                key, lambda webp=bool(variant): transcode_engine.transcode(data, max_width, max_height, webp))
+        self.fetched += 1
+
+    async def download(self, url: str) -> Optional[bytes]:
+        response = await http_client.get(url)
+        response.raise_for_status()
+        data = response.content
+        self.bucket.consume(len(data))
+        self.bytes += len(data)
+        if len(data) > prefetch_max_size:
+            self.skipped += 1
+            return None
+        return data
+
+
+thumbnail_prefetcher = ThumbnailPrefetcher(thumbnail_cache, workers=prefetch_workers,
+                                           queue_size=prefetch_queue_size, bandwidth=prefetch_bandwidth)
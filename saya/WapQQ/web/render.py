@@ -0,0 +1,71 @@
+import hashlib
+from typing import List, Optional, Union
+
+from graia.ariadne.message.chain import MessageChain
+from jinja2 import Environment, FileSystemLoader
+from loguru import logger
+
+from .config import use_image_proxy, render_backfill_batch_size, face_mode
+from .face_sprite import sprite_face_ids
+from .utils import current_path
+from ..dataBase import data_manager
+from ..dataBase.codec import message_codec
+from ..dataBase.tables import message_tables
+from ..dataBase.utils import MessageContainer
+
+template_path = current_path.joinpath("resources", "templates")
+# 与 Quart 的模板环境一致（.jinja2 文件不自动转义），保证缓存的片段与直接渲染的结果相同
+environment = Environment(loader=FileSystemLoader(str(template_path)), enable_async=True)
+environment.globals["face_sprite"] = sprite_face_ids
+FRAGMENT_SOURCE = '{% import "macro.jinja2" as macro %}{{ macro.message(message, use_image_proxy) }}'
+fragment_template = environment.from_string(FRAGMENT_SOURCE)
+chat_item_template = environment.get_template("chat_item.jinja2")
+
+
+def get_render_version() -> str:
+    """模板与渲染参数的哈希，任一变化时已缓存的片段在读取时视为不存在"""
+    source = template_path.joinpath("macro.jinja2").read_bytes() + FRAGMENT_SOURCE.encode()
+    return hashlib.sha256(source + f"{use_image_proxy}|{face_mode}".encode()).hexdigest()[:16]
+
+
+render_version = get_render_version()
+
+
+async def render_message(message: MessageChain) -> str:
+    return (await fragment_template.render_async(message=message, use_image_proxy=use_image_proxy)).strip()
+
+
+async def render_chat_item(item: Union[MessageContainer, dict], account: int) -> str:
+    """渲染消息页中的一条消息（头像、发送者与消息内容），item 需带有 html"""
+    return (await chat_item_template.render_async(i=item, account=account, use_image_proxy=use_image_proxy)).strip()
+
+
+async def fill_rendered(kind: str, conversation_id: int, message_list: List[MessageContainer]):
+    """为没有缓存片段的消息渲染 HTML ，并写回数据库供之后的请求使用；已归档的消息不在主数据库中，只渲染不保存"""
+    rendered = {}
+    for container in message_list:
+        if container.html is None:
+            container.html = await render_message(container.message)
+            if not data_manager.archive.is_archived(kind, conversation_id, container.message_id):
+                rendered[container.message_id] = container.html
+    if rendered:
+        await data_manager.save_rendered_messages(kind, render_version, rendered)
+
+
+async def backfill_rendered_messages(batch_size: Optional[int] = None) -> int:
+    """为已有的消息渲染当前版本的 HTML 片段，返回渲染的条数"""
+    batch_size = batch_size or render_backfill_batch_size
+    total = 0
+    for kind in message_tables:
+        last_id = 0
+        while True:
+            rows = await data_manager.get_unrendered_messages(kind, render_version, after=last_id, limit=batch_size)
+            if not rows:
+                break
+            rendered = {message_id: await render_message(message_codec.decode(context))
+                        for message_id, context in rows}
+            await data_manager.save_rendered_messages(kind, render_version, rendered)
+            last_id = rows[-1][0]
+            total += len(rows)
+            logger.info(f"已渲染 {total} 条消息（{kind} 至 _id {last_id}）")
+    return total
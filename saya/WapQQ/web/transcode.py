@@ -0,0 +1,126 @@
+import asyncio
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+from PIL import Image, ImageSequence
+from loguru import logger
+
+from .config import transcode_processes, transcode_process_threshold, transcode_max_frames, transcode_max_pixels, \
+    thumbnail_webp_quality, thumbnail_jpeg_quality
+from ..metrics import image_transcode_seconds
+
+DEFAULT_FRAME_DURATION = 100  # 单位：毫秒，帧未声明时长时使用，与浏览器的行为一致
+
+
+class ImageTooLarge(Exception):
+    """单帧像素数超过 transcode_max_pixels"""
+
+
+def thumbnail_frames(image: Image.Image, size: Tuple[int, int], max_frames: int) -> Tuple[List[Image.Image], List[int]]:
+    """逐帧缩放，不预先复制全部原始帧；帧数超过上限时均匀丢帧，被丢弃帧的时长并入前一帧"""
+    step = max(1, math.ceil(getattr(image, "n_frames", 1) / max_frames))
+    frames: List[Image.Image] = []
+    durations: List[int] = []
+    for index, frame in enumerate(ImageSequence.Iterator(image)):
+        duration = frame.info.get("duration") or DEFAULT_FRAME_DURATION
+        if index % step:
+            durations[-1] += duration
+            continue
+        thumbnail = frame.convert("RGBA")
+        thumbnail.thumbnail(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+        frames.append(thumbnail)
+        durations.append(duration)
+    return frames, durations
+
+
+def has_alpha(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+
+
+def transcode(data: bytes, max_width: int, max_height: int, webp: bool = False) -> Tuple[bytes, str]:
+    """生成缩略图，返回图片内容与 mimetype ，会在进程池中执行；webp 为 True 时输出 WebP"""
+    image = Image.open(BytesIO(data))
+    if image.width * image.height > transcode_max_pixels:
+        raise ImageTooLarge(f"{image.width}x{image.height}")
+    size = (max_width, max_height)
+    after_image = BytesIO()
+    if getattr(image, "is_animated", False):
+        # Gif / APNG / WEBP
+        frames, durations = thumbnail_frames(image, size, transcode_max_frames)
+        if webp:
+            img_format = "WEBP"
+            options = dict(quality=thumbnail_webp_quality, method=4)
+        else:
+            img_format = image.format if image.format in ("GIF", "PNG") else "GIF"
+            options = dict(disposal=2) if img_format == "GIF" else {}
+        frames[0].save(after_image, format=img_format, append_images=frames[1:], save_all=True,
+                       duration=durations, loop=0, **options)
+        return after_image.getvalue(), Image.MIME[img_format]
+    if image.format == "JPEG":
+        image.draft("RGB", size)  # 解码时直接按 1/2 、1/4 或 1/8 缩小
+    image.thumbnail(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    if webp:
+        img_format = "WEBP"
+        image = image.convert("RGBA" if has_alpha(image) else "RGB")
+        image.save(after_image, format=img_format, quality=thumbnail_webp_quality, method=4)
+    elif has_alpha(image):
+        img_format = "PNG"
+        image.save(after_image, format=img_format, optimize=True)
+    else:
+        img_format = "JPEG"
+        if image.mode not in ("RGB", "L", "CMYK"):
+            image = image.convert("RGB")
+        image.save(after_image, format=img_format, quality=thumbnail_jpeg_quality, optimize=True, progressive=True)
+    return after_image.getvalue(), Image.MIME[img_format]
+
+
+def is_heavy(data: bytes) -> bool:
+    """只读取文件头判断是否需要交给进程池，动图逐帧缩放与编码，总是交给进程池"""
+    with Image.open(BytesIO(data)) as image:
+        if getattr(image, "is_animated", False):
+            return True
+        return image.width * image.height > transcode_process_threshold
+
+
+def ready() -> int:
+    """预先启动子进程时提交的空任务"""
+    return multiprocessing.current_process().pid
+
+
+class TranscodeEngine:
+    """缩略图生成，耗时的大图与动图交给进程池，避免与事件循环争抢 GIL"""
+
+    def __init__(self, processes: int):
+        self.processes = processes
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    async def start(self):
+        """创建进程池并启动全部子进程，避免第一个大图请求等待 fork"""
+        if self.processes <= 0:
+            return
+        # 子进程无法在 Saya 上下文之外重新导入本插件，因此只能使用 fork
+        if "fork" not in multiprocessing.get_all_start_methods():
+            logger.warning("当前平台不支持 fork ，缩略图将在线程中生成")
+            return
+        self._pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("fork"))
+        # ProcessPoolExecutor 在首次提交任务时才 fork ，提交空任务提前触发
+        await asyncio.gather(*(asyncio.wrap_future(self._pool.submit(ready)) for _ in range(self.processes)))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def transcode(self, data: bytes, max_width: int, max_height: int, webp: bool = False) -> Tuple[bytes, str]:
+        if self._pool is not None and await asyncio.to_thread(is_heavy, data):
+            with image_transcode_seconds.time("process"):
+                return await asyncio.get_running_loop().run_in_executor(self._pool, transcode, data,
+                                                                        max_width, max_height, webp)
+        with image_transcode_seconds.time("thread"):
+            return await asyncio.to_thread(transcode, data, max_width, max_height, webp)
+
+
+transcode_engine = TranscodeEngine(processes=transcode_processes)
@@ -1,18 +1,34 @@
-import asyncio
-from io import BytesIO
+import time
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List
+from typing import Optional, Tuple, Union
+from urllib.parse import urlencode
 
-from PIL.ImageFile import ImageFile
-from PIL import Image, ImageSequence, UnidentifiedImageError
+from PIL import UnidentifiedImageError
 from graia.ariadne import Ariadne
 from graia.ariadne.message.chain import MessageChain
-from httpx import AsyncClient
 from httpx import RequestError
-from quart import Quart, redirect, Response, request, render_template
+from markupsafe import Markup, escape
+from quart import Quart, redirect, Response, request, render_template, make_response, g
 
-from .config import use_image_proxy, max_height, max_width, chat_limit
+from .config import use_image_proxy, max_height, max_width, chat_limit, image_cache_max_age, thumbnail_size_buckets, \
+    render_cache, live_heartbeat_interval, static_max_age, avatar_size, avatar_refresh_interval
+from .http_client import http_client
+from .image_cache import thumbnail_cache, avatar_cache, CachedImage
+from .live import live_hub, publish_message
+from .export import exporters, export_stream
+from .face_sprite import sprite_face_ids
+from .market_face import market_face_directory
+from .prefetch import thumbnail_prefetcher
+from .middleware import optimize_response, static_url, conversation_etag, not_modified, set_page_cache_headers
+from .render import render_version, fill_rendered
+from .transcode import transcode_engine, ImageTooLarge
+from ..config import metrics
+from ..contact import contact_directory
 from ..dataBase import data_manager
+from ..dataBase.search import SearchQuery, HIGHLIGHT_START, HIGHLIGHT_END
+from ..dataBase.utils import get_time_by_timestamp
+from ..metrics import registry, MetricFamily, http_request_seconds, image_fetch_seconds
 
 current_path = Path(__file__).parents[0]
 quart = Quart("WapQQ",
@@ -20,16 +36,38 @@ quart = Quart("WapQQ",
               static_url_path="/resources",
               static_folder=current_path.joinpath("resources").absolute().__str__()
               )
+quart.config["SEND_FILE_MAX_AGE_DEFAULT"] = timedelta(seconds=static_max_age)
+
+
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+async def observe_request(response: Response) -> Response:
+    """按路由模板记录耗时，避免把 URL 中的 ID 作为标签"""
+    start = g.get("request_start")
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        http_request_seconds.observe(time.perf_counter() - start, route, request.method, str(response.status_code))
+    return response
+
+
+if metrics:
+    quart.before_request(start_request_timer)
+    quart.after_request(observe_request)  # after_request 按注册的相反顺序执行，先注册的计入压缩的耗时
+quart.after_request(optimize_response)
+quart.add_template_global(static_url)
+quart.add_template_global(sprite_face_ids, "face_sprite")
 
 
 @quart.get("/")
 async def show_main_page() -> str:
     application: Ariadne = Ariadne.current()
     account = application.account
-    group_list = await application.get_group_list()
-    friend_list = await application.get_friend_list()
-    return await render_template("main_page.jinja2",
-                                 account=account, group_list=group_list, friend_list=friend_list)
+    group_list = data_manager.summaries.sort_by_activity("group", contact_directory.group_list())
+    friend_list = data_manager.summaries.sort_by_activity("friend", contact_directory.friend_list())
+    return await render_template("main_page.jinja2", account=account, group_list=group_list,
+                                 friend_list=friend_list, summary=data_manager.get_conversation_summary)
 
 
 @quart.get("/send_error")
@@ -38,47 +76,115 @@ async def show_send_error_page() -> str:
 
 
 @quart.get("/group/<int:group_id>")
-async def show_group_page(group_id: int) -> str:
+async def show_group_page(group_id: int) -> Union[str, Response]:
     application: Ariadne = Ariadne.current()
-    page = int(request.args.get("page")) if request.args.get("page") is not None else 1
-    group_list = await application.get_group_list()
-    status = "error"
-    current_group = None
-    for group in group_list:
-        if group_id == group.id:
-            current_group = group
-            status = "ok"
-            break
+    page = request.args.get("page", 1, type=int)
+    before = request.args.get("before", type=int)
+    after = request.args.get("after", type=int)
+    version = render_version if render_cache else None
+    current_group = await contact_directory.get_group(group_id)
+    status = "ok" if current_group is not None else "error"
     if status == "error":
         return await render_template("message_page.jinja2", status=status)
-    message_container_list = await data_manager.get_group_message(current_group, limit=chat_limit, page=page)
-    max_page = ((await data_manager.count_group_message(group_id)) // chat_limit) + 1
-    return await render_template("message_page.jinja2", messageContainer_list=message_container_list,
-                                 group_name=current_group.name, id=group_id, type='group',
-                                 status=status, account=application.account,
-                                 use_image_proxy=use_image_proxy, page=page, max_page=max_page)
+    if page == 1:
+        data_manager.mark_conversation_read("group", group_id)
+    etag = await conversation_etag("group", group_id, current_group.name)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    message_container_list = await data_manager.get_group_message(current_group, limit=chat_limit, page=page,
+                                                                  before=before, after=after, render_version=version)
+    if render_cache:
+        await fill_rendered("group", group_id, message_container_list)
+    max_page = get_max_page(await data_manager.count_group_message(group_id))
+    response = Response(await render_template("message_page.jinja2", messageContainer_list=message_container_list,
+                                              group_name=current_group.name, id=group_id, type='group',
+                                              status=status, account=application.account,
+                                              use_image_proxy=use_image_proxy, page=page, max_page=max_page))
+    set_page_cache_headers(response, etag)
+    return response
 
 
 @quart.get("/friend/<int:friend_id>")
-async def show_friend_page(friend_id: int) -> str:
+async def show_friend_page(friend_id: int) -> Union[str, Response]:
     application: Ariadne = Ariadne.current()
-    page = int(request.args.get("page")) if request.args.get("page") is not None else 1
-    friend_list = await application.get_friend_list()
-    status = "error"
-    current_friend = None
-    for friend in friend_list:
-        if friend_id == friend.id:
-            current_friend = friend
-            status = "ok"
-            break
+    page = request.args.get("page", 1, type=int)
+    before = request.args.get("before", type=int)
+    after = request.args.get("after", type=int)
+    version = render_version if render_cache else None
+    current_friend = await contact_directory.get_friend(friend_id)
+    status = "ok" if current_friend is not None else "error"
     if status == "error":
         return await render_template("message_page.jinja2", status=status)
-    message_container_list = await data_manager.get_friend_message(current_friend)
-    max_page = ((await data_manager.count_group_message(friend_id)) // chat_limit) + 1
-    return await render_template("message_page.jinja2", messageContainer_list=message_container_list,
-                                 friend_name=current_friend.nickname, id=friend_id, type='friend',
-                                 status=status, account=application.account,
-                                 use_image_proxy=use_image_proxy, page=page, max_page=max_page)
+    if page == 1:
+        data_manager.mark_conversation_read("friend", friend_id)
+    etag = await conversation_etag("friend", friend_id, current_friend.nickname)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    message_container_list = await data_manager.get_friend_message(current_friend, limit=chat_limit, page=page,
+                                                                   before=before, after=after, render_version=version)
+    if render_cache:
+        await fill_rendered("friend", friend_id, message_container_list)
+    max_page = get_max_page(await data_manager.count_friend_message(friend_id))
+    response = Response(await render_template("message_page.jinja2", messageContainer_list=message_container_list,
+                                              friend_name=current_friend.nickname, id=friend_id, type='friend',
+                                              status=status, account=application.account,
+                                              use_image_proxy=use_image_proxy, page=page, max_page=max_page))
+    set_page_cache_headers(response, etag)
+    return response
+
+
+@quart.get("/group/<int:group_id>/message/<int:message_id>")
+async def show_group_message(group_id: int, message_id: int):
+    page = await data_manager.get_message_page("group", group_id, message_id, chat_limit)
+    return redirect(f"/group/{group_id}?page={page}")
+
+
+@quart.get("/friend/<int:friend_id>/message/<int:message_id>")
+async def show_friend_message(friend_id: int, message_id: int):
+    page = await data_manager.get_message_page("friend", friend_id, message_id, chat_limit)
+    return redirect(f"/friend/{friend_id}?page={page}")
+
+
+@quart.get("/search")
+async def search() -> str:
+    keywords = request.args.get("q", "").strip()
+    kind = "friend" if request.args.get("kind") == "friend" else "group"
+    page = max(1, request.args.get("page", 1, type=int))
+    since = parse_date(request.args.get("since"))
+    until = parse_date(request.args.get("until"))
+    query = SearchQuery(kind=kind, keywords=keywords,
+                        conversation_id=request.args.get("id", type=int),
+                        sender_id=request.args.get("sender", type=int),
+                        since=since.timestamp() if since is not None else None,
+                        until=(until + timedelta(days=1)).timestamp() if until is not None else None)
+    results = await data_manager.search_messages(query, limit=chat_limit, page=page) if keywords else []
+    if kind == "group":
+        names = {i.id: i.name for i in contact_directory.group_list()}
+    else:
+        names = {i.id: i.nickname for i in contact_directory.friend_list()}
+    query_string = urlencode([(k, v) for k, v in request.args.items(multi=True) if k != "page"])
+    return await render_template("search.jinja2", available=data_manager.search_available, args=request.args,
+                                 kind=kind, keywords=keywords, results=results[:chat_limit], names=names,
+                                 page=page, has_next=len(results) > chat_limit, query_string=query_string)
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime]:
+    """解析 YYYY-MM-DD ，无法解析时视为未填写"""
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        return None
+
+
+@quart.template_filter("highlight")
+def highlight(snippet: str) -> Markup:
+    """转义搜索结果摘要，并将命中部分标记为 <mark>"""
+    return Markup(str(escape(snippet)).replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_END, "</mark>"))
+
+
+quart.add_template_filter(get_time_by_timestamp, "timestamp_time")
 
 
 @quart.post("/send_group_message/<int:group_id>")
@@ -92,6 +198,8 @@ async def send_group_message(group_id: int):
     await data_manager.add_bot_group_message(bot_message, group_id)
     await data_manager.add_bot_member(group_id)
     await data_manager.update_bot_member_name(group_id)
+    await publish_message("group", group_id, application.account,
+                          await data_manager.get_bot_sender_name(group_id), bot_message.message_chain)
     return redirect(f"/group/{group_id}")
 
 
@@ -106,23 +214,145 @@ async def send_friend_message(friend_id: int):
     await data_manager.add_bot_friend_message(bot_message, friend_id)
     await data_manager.add_bot_account()
     await data_manager.update_bot_account_name()
+    await publish_message("friend", friend_id, application.account,
+                          await data_manager.get_bot_nickname(), bot_message.message_chain)
     return redirect(f"/friend/{friend_id}")
 
 
+@quart.get("/group/<int:group_id>/events")
+async def group_events(group_id: int):
+    if await contact_directory.get_group(group_id) is None:
+        return Response("unknown group", status=404)
+    return await live_response("group", group_id)
+
+
+@quart.get("/friend/<int:friend_id>/events")
+async def friend_events(friend_id: int):
+    if await contact_directory.get_friend(friend_id) is None:
+        return Response("unknown friend", status=404)
+    return await live_response("friend", friend_id)
+
+
+async def live_response(kind: str, conversation_id: int) -> Response:
+    """以 Server-Sent Events 推送该会话的新消息，超过连接数上限时返回 503"""
+    subscription = live_hub.subscribe(kind, conversation_id)
+    if subscription is None:
+        return Response("too many subscribers", status=503, headers={"Retry-After": "30"})
+
+    async def stream():
+        try:
+            async for event in subscription.events(live_heartbeat_interval):
+                yield event
+        finally:
+            live_hub.unsubscribe(kind, conversation_id, subscription)
+            data_manager.mark_conversation_read(kind, conversation_id)  # 推送期间收到的消息已经显示在页面上
+
+    response = await make_response(stream(), {"Content-Type": "text/event-stream", "Cache-Control": "no-cache",
+                                              "X-Accel-Buffering": "no"})
+    response.timeout = None  # 推送连接不受 Quart 默认的响应超时限制
+    return response
+
+
+@quart.get("/export/group/<int:group_id>")
+async def export_group(group_id: int):
+    current_group = await contact_directory.get_group(group_id)
+    if current_group is None:
+        return Response("unknown group", status=404)
+    return await export_response("group", group_id, f"群：{current_group.name}({group_id})")
+
+
+@quart.get("/export/friend/<int:friend_id>")
+async def export_friend(friend_id: int):
+    current_friend = await contact_directory.get_friend(friend_id)
+    if current_friend is None:
+        return Response("unknown friend", status=404)
+    return await export_response("friend", friend_id, f"好友：{current_friend.nickname}({friend_id})")
+
+
+async def export_response(kind: str, conversation_id: int, title: str) -> Response:
+    """以分块传输流式输出会话的全部聊天记录，?format= 为 jsonl （默认）、csv 或 html"""
+    export_format = request.args.get("format", "jsonl")
+    if export_format not in exporters:
+        return Response("illegal param", status=400)
+    mimetype, _ = exporters[export_format]
+    stream = export_stream(kind, conversation_id, export_format, title=title,
+                           account=Ariadne.current().account, base_url=request.host_url)
+    response = await make_response(stream, {
+        "Content-Type": mimetype, "Cache-Control": "no-store",
+        "Content-Disposition": f'attachment; filename="{kind}-{conversation_id}.{export_format}"'})
+    response.timeout = None  # 大的会话导出时间可能超过 Quart 默认的响应超时
+    return response
+
+
 @quart.get("/image_proxy")
 async def image_proxy():
     url = request.args.get("url")
+    if url is None:
+        return Response("illegal param", status=403)
+    width, height = get_thumbnail_size()
+    webp = accepts_webp()
+    key = thumbnail_cache.make_key(url, width, height, "webp" if webp else "")
     try:
-        async with AsyncClient() as client:
-            r = await client.get(url)
-        image: ImageFile = Image.open(BytesIO(r.content))
-        mimetype = image.get_format_mimetype()
+        async with thumbnail_prefetcher.live_request():
+            image = await thumbnail_cache.get_or_create(key, lambda: fetch_thumbnail(url, width, height, webp))
     except RequestError:
         return Response("invalid url", status=403)
     except UnidentifiedImageError:
         return Response("content not support, must image", status=403)
-    img_bytes = await asyncio.to_thread(lambda: thumbnail_image(image))
-    return Response(img_bytes.getvalue(), mimetype=mimetype)
+    except ImageTooLarge:
+        return Response("image too large", status=403)
+    return image_response(image)
+
+
+@quart.get("/avatar/<int:account_id>")
+async def avatar_proxy(account_id: int):
+    """缩小到显示尺寸的头像，每 avatar_refresh_interval 重新获取一次"""
+    webp = accepts_webp()
+    period = int(time.time() // avatar_refresh_interval)
+    key = avatar_cache.make_key(str(account_id), avatar_size, avatar_size, f"{'webp' if webp else ''}|{period}")
+    url = f"https://q2.qlogo.cn/headimg_dl?dst_uin={account_id}&spec=100"
+    try:
+        image = await avatar_cache.get_or_create(key, lambda: fetch_thumbnail(url, avatar_size, avatar_size, webp))
+    except (RequestError, UnidentifiedImageError, ImageTooLarge):
+        return Response("avatar not available", status=404)
+    return image_response(image, max_age=avatar_refresh_interval)
+
+
+async def fetch_thumbnail(url: str, width: int, height: int, webp: bool) -> Tuple[bytes, str]:
+    with image_fetch_seconds.time():
+        r = await http_client.get(url)
+    return await transcode_engine.transcode(r.content, width, height, webp)
+
+
+def get_thumbnail_size() -> Tuple[int, int]:
+    """读取 ?w=&h= 参数并向上取整到 thumbnail_size_buckets ，避免为任意尺寸分别生成缓存"""
+    def to_bucket(value: int, limit: int) -> int:
+        for bucket in thumbnail_size_buckets:
+            if value <= bucket:
+                return min(bucket, limit)
+        return limit
+
+    width = request.args.get("w", max_width, type=int)
+    height = request.args.get("h", max_height, type=int)
+    return to_bucket(width, max_width), to_bucket(height, max_height)
+
+
+def accepts_webp() -> bool:
+    """仅在 Accept 中明确列出 image/webp 时输出 WebP ，只发送 */* 的旧浏览器不一定支持"""
+    return any(value == "image/webp" and quality > 0 for value, quality in request.accept_mimetypes)
+
+
+def image_response(image: CachedImage, max_age: int = image_cache_max_age) -> Response:
+    """带 ETag 与 Cache-Control 的图片响应，浏览器携带相同 ETag 时返回 304"""
+    if image.etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(image.data, mimetype=image.mimetype)
+    response.set_etag(image.etag)
+    response.vary.add("Accept")
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response
 
 
 @quart.get("/market_face/<int:face_id>")
@@ -130,54 +360,66 @@ async def market_face_proxy(face_id: int):
     name = request.args.get("name")
     if name is None:
         return Response("illegal param", status=403)
-    async with AsyncClient() as client:
-        meta = (await client.get(f"https://i.gtimg.cn/club/item/parcel/{face_id % 10}/{face_id}_android.json")).json()
-        for i in meta["imgs"]:
-            if i["name"] == name:
-                height: int = i["wHeightInPhone"]
-                width: int = i["wWidthInPhone"]
-                item_id: str = i["id"]
-                face_url = f"https://i.gtimg.cn/club/item/parcel/item/{item_id[:2]}/{item_id}/{height}x{width}.png"
-                return redirect(face_url)
-
-
-def thumbnail_dynamic_image(image: ImageFile, img_format: str = "GIF") -> BytesIO:
-    imgs: List[ImageFile] = [frame.copy() for frame in ImageSequence.Iterator(image)]
-    img_frames: List[ImageFile] = []
-    for i in imgs:
-        i.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
-        img_frames.append(i)
-    after_image = BytesIO()
-    img_frames[0].save(
-        after_image,
-        format=img_format,
-        append_images=img_frames[1:],
-        save_all=True,
-        duration=60,
-        loop=0,
-        optimize=False,
-        quality=100
-    )
-    return after_image
-
-
-def thumbnail_image(image: ImageFile) -> BytesIO:
-    after_image = BytesIO()
-    if image.mode == "P":  # ['1', 'L', 'I', 'F', 'P', 'RGB', 'RGBA', 'CMYK', 'YCbCr' ]
-        # Gif
-        after_image = thumbnail_dynamic_image(image, "GIF")
-    elif image.mode == "RGBA":
-        if image.get_format_mimetype() == "image/apng":
-            # APNG
-            after_image = thumbnail_dynamic_image(image, "PNG")
-        elif image.format == "WEBP":
-            # WEBP
-            after_image = thumbnail_dynamic_image(image, "WEBP")
-        else:
-            # normal PNG
-            image.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
-            image.save(after_image, format="PNG")
-    else:
-        image.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
-        image.save(after_image, format="JPEG")
-    return after_image
+    try:
+        face_url = await market_face_directory.get_url(face_id, name)
+    except (RequestError, ValueError, KeyError):
+        return Response("market face not available", status=404)
+    if face_url is None:
+        return Response("market face not found", status=404)
+    response = redirect(face_url)
+    # 同一表情的图片地址不会变化
+    response.cache_control.public = True
+    response.cache_control.max_age = static_max_age
+    return response
+
+
+@quart.get("/metrics")
+async def show_metrics():
+    """Prometheus 格式的指标，关闭 metrics 时返回 404"""
+    if not metrics:
+        return Response("metrics disabled", status=404)
+    return Response(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def collect_stats():
+    """将各模块已有的统计信息转换为指标，仅在抓取时读取"""
+    image_cache = MetricFamily("wapqq_image_cache_requests_total", "counter", "缩略图缓存的查找次数",
+                               ("cache", "result"))
+    image_cache_bytes = MetricFamily("wapqq_image_cache_bytes", "gauge", "缩略图缓存占用的空间", ("cache", "level"))
+    for name, cache in (("thumbnail", thumbnail_cache), ("avatar", avatar_cache)):
+        stats = cache.stats()
+        image_cache.add(stats.memory_hits, name, "memory").add(stats.disk_hits, name, "disk") \
+            .add(stats.misses, name, "miss")
+        image_cache_bytes.add(stats.memory_bytes, name, "memory").add(stats.disk_bytes, name, "disk")
+    identity_cache = MetricFamily("wapqq_identity_cache_requests_total", "counter", "身份缓存的查找次数",
+                                  ("cache", "result"))
+    identity_cache_size = MetricFamily("wapqq_identity_cache_entries", "gauge", "身份缓存的条目数", ("cache",))
+    for name, stats in data_manager.identity_cache_stats().items():
+        identity_cache.add(stats.hits, name, "hit").add(stats.misses, name, "miss")
+        identity_cache_size.add(stats.size, name)
+    families = [image_cache, image_cache_bytes, identity_cache, identity_cache_size]
+    writer = data_manager.write_behind_stats()
+    if writer is not None:
+        families.append(MetricFamily("wapqq_write_behind_queue_depth", "gauge", "写缓冲中待写入的操作数")
+                        .add(writer.queue_depth))
+        families.append(MetricFamily("wapqq_write_behind_rows_total", "counter", "写缓冲写入的操作数", ("result",))
+                        .add(writer.flushed_rows, "flushed").add(writer.failed_rows, "failed"))
+    live = live_hub.stats()
+    families.append(MetricFamily("wapqq_live_subscribers", "gauge", "实时推送的连接数").add(live.subscribers))
+    families.append(MetricFamily("wapqq_live_events_total", "counter", "实时推送的事件数", ("result",))
+                    .add(live.published, "published").add(live.overflowed, "overflowed")
+                    .add(live.rejected, "rejected"))
+    prefetch = thumbnail_prefetcher.stats()
+    families.append(MetricFamily("wapqq_prefetch_queue_depth", "gauge", "待预取的图片数").add(prefetch.queued))
+    families.append(MetricFamily("wapqq_prefetch_images_total", "counter", "预取图片的结果", ("result",))
+                    .add(prefetch.fetched, "fetched").add(prefetch.skipped, "skipped")
+                    .add(prefetch.failed, "failed").add(prefetch.dropped, "dropped"))
+    return families
+
+
+if metrics:
+    registry.register_collector(collect_stats)
+
+
+def get_max_page(message_count: int) -> int:
+    return max(1, (message_count + chat_limit - 1) // chat_limit)